@@ -0,0 +1,303 @@
+# Benchmark suite driving the application's hot paths through the Flask test client against a seeded database.
+# Run it from the project's root directory, against a dedicated MongoDB database (its name must contain 'bench', as the
+# benchmark deletes and recreates its data) or against an in-memory stand-in:
+#
+#     python -m benchmarks.run --mongo-uri mongodb://localhost:27017/mapster_benchmark
+#     python -m benchmarks.run --mongomock
+#
+# For every route it reports latency percentiles, throughput, database commands per request and response bytes. With MongoDB,
+# commands are counted by the command listener of metrics.py; mongomock has no command monitoring, so its collection operations
+# are counted instead (a query counts once, however many batches a real server would return it in).
+# '--save-baseline' stores the results in benchmarks/baseline.json; later runs are compared with it, and the command exits with
+# status 1 if a route's median or 90th percentile latency regressed by more than '--tolerance'. Latencies depend on the machine
+# and the database, so the baseline is recorded locally and not committed.
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from benchmarks.seed import seed, PASSWORD, WORDS, AREA
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Endpoint of every benchmarked route, under which its database commands are counted.
+ENDPOINTS = {
+    'index': 'main.index',
+    'search': 'main.search',
+    'view_itinerary': 'itineraries.view_itinerary',
+    'sync_itineraries': 'api.sync_itineraries',
+    'toggle_like': 'api.toggle_like',
+    'save_itinerary': 'itineraries.save_itinerary'
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Mapster application's main routes against a seeded database.")
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/mapster_benchmark', help="URI of the benchmark database")
+    parser.add_argument('--mongomock', action='store_true', help="use an in-memory mongomock database instead of MongoDB")
+    parser.add_argument('--force', action='store_true', help="allow a database whose name does not contain 'bench'")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--itineraries', type=int, default=500)
+    parser.add_argument('--waypoints', type=int, default=8, help="waypoints per itinerary")
+    parser.add_argument('--likes', type=int, default=2000)
+    parser.add_argument('--images', type=int, help="distinct map images shared among itineraries (default: 50, none with --mongomock,"
+                                                   " whose GridFS emulation does not work with every pymongo version)")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per route")
+    parser.add_argument('--warmup', type=int, default=10, help="unmeasured requests per route before measuring")
+    parser.add_argument('--seed', type=int, default=42, help="seed of the generated data and request parameters")
+    parser.add_argument('--routes', help="comma-separated routes to run (all by default)")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline file to compare with or save to")
+    parser.add_argument('--save-baseline', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed latency increase over the baseline (0.25 = 25%%)")
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+# Returns the settings of the application built for a benchmark. Settings that only matter for a real deployment get placeholder values,
+# and background maintenance and the slow-request log are disabled so that they do not interfere with measurements.
+# mongomock has no capped collections, so change events are not relayed between processes with '--mongomock' (see events.py).
+def benchmark_settings(mongo_uri, mongomock=False):
+    import config
+    return {
+        'MONGO_URI': mongo_uri,
+        'SECRET_KEY': getattr(config, 'SECRET_KEY', None) or 'benchmark',
+        'GOOGLE_CONSUMER_KEY': getattr(config, 'GOOGLE_CONSUMER_KEY', None) or 'benchmark',
+        'GOOGLE_CONSUMER_SECRET': getattr(config, 'GOOGLE_CONSUMER_SECRET', None) or 'benchmark',
+        'MAINTENANCE_ENABLED': False,
+        'SLOW_REQUEST_SECONDS': 0,
+        'CHANGE_RELAY_ENABLED': not mongomock
+    }
+
+
+# Collection methods counted as database operations with '--mongomock'.
+MONGOMOCK_OPERATIONS = (
+    'find', 'find_one', 'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete', 'insert_one', 'insert_many',
+    'update_one', 'update_many', 'replace_one', 'delete_one', 'delete_many', 'bulk_write', 'aggregate', 'count_documents',
+    'estimated_document_count', 'distinct'
+)
+
+
+# Counts the operations of mongomock collections by the endpoint of the request issuing them ('<background>' outside requests).
+# Operations that mongomock implements with others (e.g. 'find_one' with 'find') count once.
+class OperationCounter:
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def install(self, collection_class):
+        for name in MONGOMOCK_OPERATIONS:
+            setattr(collection_class, name, self._counted(getattr(collection_class, name)))
+
+    def count(self, endpoint):
+        with self._lock:
+            return self.counts[endpoint]
+
+    def _counted(self, method):
+        from flask import has_request_context, request
+
+        def counted(*args, **kwargs):
+            if getattr(self._local, 'depth', 0) == 0:
+                endpoint = request.endpoint if has_request_context() else '<background>'
+                with self._lock:
+                    self.counts[endpoint] += 1
+            self._local.depth = getattr(self._local, 'depth', 0) + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.depth -= 1
+        return counted
+
+
+# Replaces the MongoDB client with mongomock's in-memory stand-in, for '--mongomock', and returns the counter of its operations.
+def use_mongomock():
+    try:
+        import mongomock
+        import mongomock.gridfs
+    except ImportError:
+        sys.exit("The --mongomock option requires the mongomock package (pip install mongomock).")
+    mongomock.gridfs.enable_gridfs_integration()
+    operations = OperationCounter()
+    operations.install(mongomock.collection.Collection)
+    import flask_pymongo
+    flask_pymongo.MongoClient = mongomock.MongoClient
+    return operations
+
+
+# Builds the application configured for the benchmark and creates its indexes. Returns it with the function counting the database
+# commands issued by an endpoint.
+def load_app(args):
+    operations = use_mongomock() if args.mongomock else None
+
+    from mapster_app import create_app, bootstrap
+    app = create_app(settings=benchmark_settings(args.mongo_uri, args.mongomock))
+    mongo = app.extensions['mapster_mongo']
+    if not args.mongomock and not args.force and 'bench' not in mongo.db.name:
+        sys.exit(f"Refusing to seed database '{mongo.db.name}': use a database whose name contains 'bench', or --force.")
+    bootstrap(app)
+    if operations is not None:
+        return app, operations.count
+    metrics = app.extensions['mapster_metrics']
+    return app, lambda endpoint: db_command_count(metrics, endpoint)
+
+
+# Returns the form fields of a new itinerary, as posted by the itinerary editor.
+def itinerary_form(rng, number):
+    south, west, north, east = AREA
+    form = {
+        'itinerary_name': f'benchmark itinerary {number}',
+        'itinerary_description': ' '.join(rng.choice(WORDS) for _ in range(12)),
+        'waypoint_count': '8'
+    }
+    for i in range(8):
+        form[f'waypoints[{i}][name]'] = f'Stop {i + 1}'
+        form[f'waypoints[{i}][latitude]'] = str(round(rng.uniform(south, north), 6))
+        form[f'waypoints[{i}][longitude]'] = str(round(rng.uniform(west, east), 6))
+    return form
+
+
+# Returns the benchmarked routes, by name (see ENDPOINTS), as functions sending one request with the test client.
+def build_scenarios(dataset, rng):
+    itinerary_ids = dataset['itinerary_ids']
+    new_itineraries = itertools.count()
+    return {
+        'index': lambda client: client.get('/'),
+        'search': lambda client: client.get('/search', query_string={'q': rng.choice(WORDS)[:rng.randint(3, 6)], 'filters': '{}'}),
+        'view_itinerary': lambda client: client.get(f'/view-itinerary/{rng.choice(itinerary_ids)}'),
+        'sync_itineraries': lambda client: client.get('/api/sync-itineraries'),
+        'toggle_like': lambda client: client.post(f'/api/toggle-like/{rng.choice(itinerary_ids)}'),
+        'save_itinerary': lambda client: client.post('/save-itinerary', data=itinerary_form(rng, next(new_itineraries)))
+    }
+
+
+# Returns the 'fraction' percentile of sorted values (nearest-rank method).
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def db_command_count(metrics, endpoint):
+    return sum(count for (command_endpoint, _), count in metrics.db_commands.items() if command_endpoint == endpoint)
+
+
+# Sends the warm-up and measured requests of one route and returns its statistics.
+def run_scenario(client, command_count, endpoint, send, requests, warmup):
+    for _ in range(warmup):
+        send(client)
+
+    commands_before = command_count(endpoint)
+    latencies, response_bytes, errors = [], 0, 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        response = send(client)
+        latencies.append(time.perf_counter() - request_started)
+        response_bytes += len(response.get_data())
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / requests * 1000, 3),
+        'throughput_rps': round(requests / elapsed, 1),
+        'db_commands_per_request': round((command_count(endpoint) - commands_before) / requests, 2),
+        'response_bytes': round(response_bytes / requests)
+    }
+
+
+def print_results(results):
+    print(f"{'route':<18}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'req/s':>10}{'db/req':>8}{'bytes':>10}{'errors':>8}")
+    for endpoint, stats in results.items():
+        print(f"{endpoint:<18}{stats['p50_ms']:>10}{stats['p90_ms']:>10}{stats['p99_ms']:>10}{stats['mean_ms']:>10}"
+              f"{stats['throughput_rps']:>10}{stats['db_commands_per_request']:>8}{stats['response_bytes']:>10}{stats['errors']:>8}")
+
+
+# Compares the results with a baseline and returns the descriptions of the regressions found.
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for endpoint, stats in results.items():
+        reference = baseline['routes'].get(endpoint)
+        if not reference:
+            continue
+        for key in ('p50_ms', 'p90_ms'):
+            if reference[key] and stats[key] > reference[key] * (1 + tolerance):
+                regressions.append(f"{endpoint} {key}: {stats[key]} ms (baseline {reference[key]} ms, +{(stats[key] / reference[key] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.images is None:
+        args.images = 0 if args.mongomock else 50
+    app, command_count = load_app(args)
+    mongo = app.extensions['mapster_mongo']
+
+    volumes = {key: getattr(args, key) for key in ('users', 'itineraries', 'waypoints', 'likes', 'images', 'requests', 'seed')}
+    print(f"Seeding {'mongomock' if args.mongomock else mongo.db.name}: {volumes}")
+    dataset = seed(
+        mongo,
+        app.extensions['mapster_images'],
+        users=args.users,
+        itineraries=args.itineraries,
+        waypoints=args.waypoints,
+        likes=args.likes,
+        images=args.images,
+        seed_value=args.seed
+    )
+
+    client = app.test_client()
+    client.post('/login', data={'username': dataset['usernames'][0], 'password': PASSWORD})
+
+    scenarios = build_scenarios(dataset, random.Random(args.seed))
+    selected = args.routes.split(',') if args.routes else list(scenarios)
+    results = {}
+    for endpoint in selected:
+        results[endpoint] = run_scenario(
+            client,
+            command_count,
+            ENDPOINTS[endpoint],
+            scenarios[endpoint],
+            args.requests,
+            args.warmup
+        )
+    app.extensions['mapster_views'].flush()
+    print_results(results)
+
+    report = {'backend': 'mongomock' if args.mongomock else 'mongodb', 'volumes': volumes, 'routes': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('backend') != report['backend'] or baseline.get('volumes') != volumes:
+        print("Note: the baseline was recorded with a different backend or data volumes; the comparison is indicative only.")
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regression beyond {args.tolerance:.0%} of the baseline.")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Generation of a reproducible benchmark dataset: users, itineraries with waypoints and map images, and likes.
+# The same seed always produces the same data, so that benchmark runs on different versions of the code are comparable.
+
+import random
+from datetime import datetime
+import bcrypt
+from bson import ObjectId
+from pymongo import UpdateOne
+from itinerary_model import new_itinerary
+
+
+# Password of every seeded user.
+PASSWORD = 'benchmark'
+
+# Words from which itinerary names and descriptions are drawn; search benchmarks query them too.
+WORDS = (
+    'rome', 'naples', 'florence', 'venice', 'milan', 'turin', 'bologna', 'genoa', 'palermo', 'bari',
+    'coast', 'mountain', 'lake', 'valley', 'castle', 'museum', 'market', 'harbour', 'vineyard', 'cathedral',
+    'walk', 'tour', 'ride', 'trip', 'weekend', 'sunset', 'morning', 'historic', 'scenic', 'hidden'
+)
+
+# Area in which waypoints are placed (roughly Italy), as (south, west, north, east).
+AREA = (37.0, 7.0, 46.5, 18.5)
+
+
+def _phrase(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+# Seeds the database with the given volumes and returns a summary of what was created: usernames, itinerary IDs and the
+# number of likes and images. Existing users, itineraries, likes and images are removed first.
+# Images are 'images' distinct blobs of random bytes shared among the itineraries, which exercises deduplication in the image store.
+def seed(mongo, image_store, users=20, itineraries=500, waypoints=8, likes=2000, images=100, image_size=20000, seed_value=42):
+    rng = random.Random(seed_value)
+    db = mongo.db
+    for collection in ('users', 'itineraries', 'likes', 'image_refs', 'images.files', 'images.chunks', 'counters', 'leaderboards', 'meta', 'migrations'):
+        db[collection].delete_many({})
+
+    # A low bcrypt cost keeps seeding fast; logins still verify the hash normally.
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=4))
+    usernames = [f'user{i}' for i in range(users)]
+    db.users.insert_many([{'username': username, 'name': username.title(), 'password': password_hash} for username in usernames])
+
+    image_data = [rng.randbytes(image_size) for _ in range(images)]
+    image_hashes = set()
+
+    documents = []
+    south, west, north, east = AREA
+    for i in range(itineraries):
+        latitude, longitude = rng.uniform(south, north), rng.uniform(west, east)
+        route = []
+        for j in range(waypoints):
+            latitude = min(max(latitude + rng.uniform(-0.05, 0.05), south), north)
+            longitude = min(max(longitude + rng.uniform(-0.05, 0.05), west), east)
+            route.append({'name': f'Stop {j + 1}', 'latitude': round(latitude, 6), 'longitude': round(longitude, 6)})
+
+        itinerary = new_itinerary(
+            rng.choice(usernames),
+            f'{_phrase(rng, 3)} {i}',
+            _phrase(rng, 12),
+            route,
+            sync_seq=i + 1,
+            timestamp=datetime(2024, rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+        )
+        # IDs are derived from the itinerary's position, so they are the same at every run.
+        itinerary['_id'] = ObjectId(f'{i + 1:024x}')
+        itinerary['num_views'] = rng.randint(0, 500)
+        if image_data:
+            # Storing an image already stored only adds a reference to it.
+            itinerary['image_hash'] = image_store.store_bytes(rng.choice(image_data), 'webp')
+            itinerary['image_format'] = 'webp'
+            image_hashes.add(itinerary['image_hash'])
+        documents.append(itinerary)
+    if documents:
+        db.itineraries.insert_many(documents)
+    db.counters.update_one({'_id': 'sync_seq'}, {'$set': {'value': itineraries}}, upsert=True)
+
+    like_pairs = set()
+    itinerary_ids = [document['_id'] for document in documents]
+    while itinerary_ids and len(like_pairs) < min(likes, users * itineraries):
+        like_pairs.add((rng.choice(usernames), rng.choice(itinerary_ids)))
+    if like_pairs:
+        db.likes.insert_many([{'user_id': user_id, 'itinerary_id': itinerary_id} for user_id, itinerary_id in like_pairs])
+        counts = {}
+        for _, itinerary_id in like_pairs:
+            counts[itinerary_id] = counts.get(itinerary_id, 0) + 1
+        db.itineraries.bulk_write([UpdateOne({'_id': itinerary_id}, {'$set': {'likes_count': count}}) for itinerary_id, count in counts.items()])
+
+    return {
+        'usernames': usernames,
+        'itinerary_ids': [str(itinerary_id) for itinerary_id in itinerary_ids],
+        'likes': len(like_pairs),
+        'images': len(image_hashes)
+    }
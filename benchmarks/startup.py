@@ -0,0 +1,75 @@
+# Startup benchmark, measuring how long a new process takes to become able to serve requests. Run it from the project's root directory:
+#
+#     python -m benchmarks.startup
+#
+# Every run starts a fresh Python process, which times the import of mapster_app.py (and of the modules it imports), the building
+# of the application by 'create_app()' and its first request (a liveness check, which does not touch the database, so no database
+# is needed). The median and maximum of each phase over '--runs' runs are reported.
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+PHASES = ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the startup time of the Mapster application.")
+    parser.add_argument('--runs', type=int, default=5, help="number of fresh processes to measure")
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# Measures the startup phases in the current process, which must not have imported the application yet, and returns them in milliseconds.
+def measure():
+    started = time.perf_counter()
+    from mapster_app import create_app
+    imported = time.perf_counter()
+
+    app = create_app(settings={'MONGO_URI': 'mongodb://localhost:27017/mapster_startup', 'SECRET_KEY': 'benchmark', 'MAINTENANCE_ENABLED': False})
+    created = time.perf_counter()
+
+    response = app.test_client().get('/healthz')
+    served = time.perf_counter()
+    if response.status_code != 200:
+        raise RuntimeError(f"The first request failed with status {response.status_code}")
+
+    return {
+        'import_ms': round((imported - started) * 1000, 1),
+        'create_app_ms': round((created - imported) * 1000, 1),
+        'first_request_ms': round((served - created) * 1000, 1),
+        'total_ms': round((served - started) * 1000, 1)
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(measure()))
+        return 0
+
+    runs = []
+    for _ in range(args.runs):
+        child = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child'], capture_output=True, text=True)
+        if child.returncode != 0:
+            sys.exit(f"Startup run failed:\n{child.stderr}")
+        runs.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    results = {phase: {'median_ms': round(statistics.median(run[phase] for run in runs), 1), 'max_ms': max(run[phase] for run in runs)} for phase in PHASES}
+    print(f"{'phase':<18}{'median ms':>12}{'max ms':>10}")
+    for phase, stats in results.items():
+        print(f"{phase[:-3]:<18}{stats['median_ms']:>12}{stats['max_ms']:>10}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'runs': args.runs, 'phases': results}, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,24 @@
+# Conversion of MongoDB documents to JSON-safe values, for templates that embed them with 'tojson'.
+# Produces the same values as 'json.loads(json_util.dumps(document))' (relaxed Extended JSON: '{'$oid': ...}' for ObjectIds,
+# '{'$date': ...}' for dates, and so on) in a single pass, without serializing the document to a string and parsing it back.
+
+import math
+from bson import json_util
+
+
+# Types returned as they are. Booleans are ints, and strings must be checked before the iterable types.
+_PLAIN_TYPES = (str, int, type(None))
+
+
+def to_json_safe(value):
+    if isinstance(value, _PLAIN_TYPES):
+        return value
+    if isinstance(value, float):
+        # Non-finite numbers have no JSON representation and are converted by 'json_util' (e.g. '{'$numberDouble': 'NaN'}').
+        return value if math.isfinite(value) else json_util.default(value)
+    if hasattr(value, 'items'):
+        return {key: to_json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_safe(item) for item in value]
+    # ObjectIds, dates and the other BSON types, as 'json_util.dumps()' converts them.
+    return json_util.default(value)
@@ -0,0 +1,105 @@
+# Small in-process caches shared by the routes.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+# Thread-safe cache bounded in size, evicting the least recently used entry when full, whose entries also expire 'ttl'
+# seconds after being stored. Hits and misses are counted for monitoring (see 'stats()').
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the cached value for 'key', or 'default' if it is missing or expired.
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    # Stores 'value' for 'key', evicting the least recently used entry if the cache is full.
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # Returns the cached value for 'key', calling 'loader()' and caching its result on a miss. None results are cached as well.
+    def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    # Removes 'key' from the cache, e.g. when the data it holds changes.
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # Removes every entry.
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Returns the usage counters of the cache.
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Coalesces concurrent calls for the same key: while 'function' runs for a key, other threads calling 'do()' with that key
+# wait for it and receive its result (or its exception) instead of running their own, so a burst of cache misses for the same
+# entry costs a single load.
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    # Returns the result of 'function()', or of the call already running for 'key'.
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,96 @@
+# This script defines maintenance commands for the Flask command line interface, run with 'flask --app mapster_app <command>'.
+# They bring documents created by earlier versions of the application up to date with the fields the routes rely on.
+
+import click
+from search import backfill_search_terms
+from feed import backfill_counters
+from trending import refresh_trending
+from likes import migrate_likes
+from image_store import migrate_embedded_images
+from thumbnails import generate_missing_variants
+from geo import backfill_geometry
+from route_metrics import backfill_route_fields
+from migrations import run_migrations, migration_status, MigrationLocked
+
+
+def init_app(app, mongo):
+    # Command computing the search terms of itineraries created before search indexing existed (see search.py).
+    @app.cli.command('backfill-search')
+    def backfill_search():
+        updated = backfill_search_terms(mongo)
+        click.echo(f"Search terms computed for {updated} itineraries.")
+
+    # Command setting the like and view counters of itineraries created before counters were maintained (see feed.py).
+    @app.cli.command('backfill-counters')
+    def backfill_counters_command():
+        updated = backfill_counters(mongo)
+        click.echo(f"Counters set for {updated} itineraries.")
+
+    # Command moving the likes stored as arrays on itineraries by earlier versions into the 'likes' collection (see likes.py).
+    @app.cli.command('migrate-likes')
+    def migrate_likes_command():
+        migrated = migrate_likes(mongo)
+        click.echo(f"Likes migrated for {migrated} itineraries.")
+
+    # Command recomputing the trending leaderboard immediately, instead of waiting for it to expire (see trending.py).
+    @app.cli.command('refresh-trending')
+    def refresh_trending_command():
+        items = refresh_trending(mongo, size=app.config.get('TRENDING_SIZE', 20))
+        click.echo(f"Trending leaderboard recomputed with {len(items)} itineraries.")
+
+    # Command moving the map images embedded in itineraries by earlier versions into the image store (see image_store.py).
+    @app.cli.command('migrate-images')
+    def migrate_images_command():
+        migrated = migrate_embedded_images(mongo, app.extensions['mapster_images'])
+        click.echo(f"Images migrated for {migrated} itineraries.")
+
+    # Command generating the reduced-size variants missing for itinerary images, e.g. those uploaded before variants existed (see thumbnails.py).
+    @app.cli.command('generate-thumbnails')
+    def generate_thumbnails_command():
+        processed = generate_missing_variants(mongo, app.extensions['mapster_thumbnails'])
+        click.echo(f"Variants checked for {processed} images.")
+
+    # Command converting the waypoint coordinates of itineraries created by earlier versions to numbers and computing their route geometry (see geo.py).
+    @app.cli.command('backfill-geometry')
+    def backfill_geometry_command():
+        updated = backfill_geometry(mongo)
+        click.echo(f"Route geometry computed for {updated} itineraries.")
+
+    # Command computing the route length, bounding box, centroid and simplified polyline of existing itineraries (see route_metrics.py).
+    @app.cli.command('backfill-routes')
+    def backfill_routes_command():
+        updated = backfill_route_fields(mongo, tolerance=app.config.get('ROUTE_SIMPLIFY_TOLERANCE', 10))
+        click.echo(f"Route metrics computed for {updated} itineraries.")
+
+    # Command running the maintenance tasks immediately, regardless of the background scheduler (see maintenance.py).
+    @app.cli.command('maintenance')
+    def maintenance_command():
+        results = app.extensions['mapster_maintenance'].run_once(force=True)
+        for name, result in results.items():
+            click.echo(f"{name}: {result}")
+
+    # Command running the pending data migrations in order, reporting their progress, or listing their state with '--status' (see migrations/).
+    # An interrupted run resumes where it stopped when the command is run again.
+    @app.cli.command('migrate')
+    @click.option('--status', is_flag=True, help="List the migrations and their state without running them.")
+    @click.option('--batch-size', default=500, show_default=True, help="Documents migrated per batch.")
+    def migrate_command(status, batch_size):
+        if status:
+            for migration, record in migration_status(mongo):
+                if record is None:
+                    state = "pending"
+                elif record.get('completed_at'):
+                    state = f"completed at {record['completed_at']:%Y-%m-%d %H:%M:%S} UTC ({record.get('processed', 0)} documents)"
+                else:
+                    state = f"interrupted after {record.get('processed', 0)} documents"
+                click.echo(f"{migration.ID}  {migration.DESCRIPTION}: {state}")
+            return
+
+        def report(migration, processed, total):
+            click.echo(f"{migration.ID}: {processed}/{total} documents")
+
+        try:
+            completed = run_migrations(mongo, app.logger, batch_size=batch_size, progress=report)
+        except MigrationLocked as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Migrations completed: {', '.join(completed)}" if completed else "No pending migrations.")
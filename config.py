@@ -8,5 +8,127 @@
 # GOOGLE_CONSUMER_KEY = 
 # GOOGLE_CONSUMER_SECRET = 
 
-# Caching Configuration:
-CACHE_ENABLED = True
\ No newline at end of file
+# Caching Configuration (also enables the server-side cache of home feed and search results, sized and expired as below):
+CACHE_ENABLED = True
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 60
+
+# Itinerary Cache Configuration (itineraries prepared for the itinerary page: maximum number cached and seconds after which one is reloaded):
+ITINERARY_CACHE_SIZE = 1024
+ITINERARY_CACHE_TTL = 60
+
+# Home Feed Configuration:
+FEED_PAGE_SIZE = 20
+
+# Synchronization Configuration (maximum number of changes and approximate size of a single sync response):
+SYNC_BATCH_SIZE = 100
+SYNC_BATCH_MAX_BYTES = 1048576
+
+# Change Notification Configuration (seconds between heartbeats and maximum lifetime of a change stream connection; change streams served
+# at once by each server process, each holding one of its SERVER_THREADS threads, and seconds after which a refused client tries again;
+# relay of change events between processes, and size in bytes of the capped collection through which they are relayed):
+CHANGE_STREAM_HEARTBEAT = 25
+CHANGE_STREAM_MAX_SECONDS = 120
+CHANGE_STREAM_MAX_CONNECTIONS = 4
+CHANGE_STREAM_RETRY_AFTER = 60
+CHANGE_RELAY_ENABLED = True
+CHANGE_EVENTS_SIZE = 1024 * 1024
+
+# Search Configuration (results per page and maximum number of matches ranked by relevance for a single query):
+SEARCH_PAGE_SIZE = 20
+SEARCH_CANDIDATE_LIMIT = 500
+
+# Trending Configuration (number of itineraries in the leaderboard and seconds after which it is recomputed):
+TRENDING_SIZE = 20
+TRENDING_REFRESH_SECONDS = 300
+
+# View Counter Configuration (seconds between writes of buffered itinerary views, and number of buffered views forcing an early write):
+VIEW_FLUSH_INTERVAL = 10
+VIEW_FLUSH_THRESHOLD = 500
+
+# User Cache Configuration (maximum number of cached users and seconds after which a cached user is reloaded):
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 300
+
+# Image Storage Configuration (size in bytes of the chunks in which map images are hashed, stored in GridFS and streamed):
+IMAGE_CHUNK_SIZE = 261120
+
+# Thumbnail Configuration (number of background threads generating reduced-size map image variants, and their compression quality):
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_QUALITY = 80
+
+# Spatial Query Configuration (maximum itineraries returned by the viewport and nearby APIs, and maximum nearby search radius in meters):
+GEO_RESULTS_LIMIT = 200
+GEO_NEARBY_MAX_DISTANCE = 50000
+
+# Route Metrics Configuration (tolerance in meters of the simplified route polyline used for previews):
+ROUTE_SIMPLIFY_TOLERANCE = 10
+
+# Bulk Write Configuration (maximum number of itineraries accepted by a single request to the bulk write API):
+BULK_MAX_ITINERARIES = 100
+
+# Maintenance Configuration (background maintenance tasks, their interval in seconds, and days after which tombstones of deleted itineraries are purged;
+# clients that have not synchronized within that period perform a full resynchronization; itineraries whose like counter is checked per run):
+MAINTENANCE_ENABLED = True
+MAINTENANCE_INTERVAL = 3600
+TOMBSTONE_RETENTION_DAYS = 30
+LIKES_RECONCILE_BATCH_SIZE = 5000
+
+# Metrics Configuration (request and database metrics on '/metrics', bearer token required to read them and the cache statistics on '/api/cache-stats' if set,
+# and duration in seconds above which requests are logged with their database commands; 0 disables the log):
+METRICS_ENABLED = True
+METRICS_TOKEN = ''
+SLOW_REQUEST_SECONDS = 1.0
+
+# MongoDB Client Configuration (connections per process, idle time in milliseconds after which they are closed, and timeouts in milliseconds
+# for connecting, selecting a server, waiting for a reply and waiting for a free connection when the pool is exhausted):
+MONGO_MAX_POOL_SIZE = 20
+MONGO_MIN_POOL_SIZE = 2
+MONGO_MAX_IDLE_TIME_MS = 300000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = 30000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+
+# Production Server Configuration (see gunicorn.conf.py: listening address, worker processes (0 = two per CPU core plus one), threads per worker,
+# seconds after which a stuck worker is restarted, seconds given to workers to finish their requests on shutdown, and keep-alive seconds),
+# and timeout in seconds of the database check of the readiness route ('/readyz'):
+SERVER_BIND = '0.0.0.0:8000'
+SERVER_WORKERS = 0
+SERVER_THREADS = 8
+SERVER_TIMEOUT = 60
+SERVER_GRACEFUL_TIMEOUT = 30
+SERVER_KEEPALIVE = 5
+HEALTH_CHECK_TIMEOUT = 2
+
+# Password Configuration (bcrypt work factor, applied to existing passwords when their users next log in; worker processes hashing passwords,
+# maximum password operations queued for them, and seconds a login or signup waits for a free slot before being refused as busy):
+BCRYPT_ROUNDS = 12
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_MAX_PENDING = 16
+PASSWORD_HASH_QUEUE_TIMEOUT = 5
+
+# Login Throttling Configuration (failed logins allowed per username from one client address and per client address within the window,
+# in seconds, after which they are forgotten):
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_MAX_ATTEMPTS_PER_ADDRESS = 20
+LOGIN_THROTTLE_WINDOW = 900
+
+# Reverse Proxy Configuration (number of trusted proxies in front of the server, whose X-Forwarded-For, -Proto and -Host headers give the
+# client's address, scheme and host; 0 when clients connect to the server directly, as the headers could then be forged):
+PROXY_FIX_HOPS = 0
+
+# Static Asset Configuration (fingerprinted static file URLs, cached by browsers without revalidation; precompression of static text files
+# with gzip, and Brotli if installed, at the given Brotli quality; and compression of dynamic responses of at least COMPRESS_MIN_SIZE bytes
+# at the given gzip level):
+STATIC_FINGERPRINT = True
+STATIC_PRECOMPRESS = True
+STATIC_BROTLI_QUALITY = 11
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+# Snapshot Configuration (itinerary snapshots loaded by offline clients on their first synchronization: number of cached snapshots,
+# seconds after which an unused one is dropped, and itineraries after which the compressed stream is flushed to the client):
+SNAPSHOT_CACHE_SIZE = 64
+SNAPSHOT_CACHE_TTL = 600
+SNAPSHOT_FLUSH_RECORDS = 100
\ No newline at end of file
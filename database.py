@@ -0,0 +1,54 @@
+# MongoDB client of the application, created on first use rather than when the application is created.
+# Creating the application therefore never touches the database, and a process forked after the client was created (such as
+# a worker of the production server, see gunicorn.conf.py) gets a client of its own, with its own connection pool, the first time
+# it uses it: a client must not be shared across a fork. Everything reads 'mongo.db' or 'mongo.cx' when it needs them.
+
+import os
+import threading
+from flask_pymongo import PyMongo
+
+
+class LazyMongo:
+    def __init__(self, app=None, **client_options):
+        self.app = None
+        self.client_options = client_options
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, **client_options)
+
+    # Records the application whose MONGO_URI setting the client connects to, and the options of the client (see 'MongoClient').
+    def init_app(self, app, **client_options):
+        self.app = app
+        self.client_options.update(client_options)
+
+    @property
+    def cx(self):
+        return self._connect().cx
+
+    @property
+    def db(self):
+        return self._connect().db
+
+    # Returns whether this process created its client already.
+    def connected(self):
+        return self._client is not None and self._pid == os.getpid()
+
+    # Closes the client of this process, if it has one; the next use creates a new one.
+    def close(self):
+        with self._lock:
+            if self.connected():
+                self._client.cx.close()
+            self._client = None
+            self._pid = None
+
+    def _connect(self):
+        if self._pid == os.getpid():
+            return self._client
+        with self._lock:
+            if self._pid != os.getpid():
+                client = PyMongo()
+                client.init_app(self.app, **self.client_options)
+                self._client, self._pid = client, os.getpid()
+        return self._client
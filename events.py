@@ -0,0 +1,179 @@
+# Publish/subscribe hub for itinerary change notifications.
+# Routes that modify itineraries publish a change event addressed to the itinerary's owner; the '/api/changes' stream
+# forwards these events to the owner's connected clients, so they synchronize only when something actually changed.
+# Each process has its own hub; a ChangeRelay forwards the events published in one process to the hubs of all the others
+# (e.g. the other workers of the production server), so that a client is notified whichever process serves its stream.
+
+import os
+import queue
+import threading
+import uuid
+from collections import defaultdict
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+
+class ChangeHub:
+    def __init__(self, max_queue_size=100):
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._listeners = []
+        self.relay = None
+
+    # Registers a new subscriber for the changes of 'user_id' and returns the queue on which its events are delivered.
+    def subscribe(self, user_id):
+        subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers[user_id].add(subscriber)
+        return subscriber
+
+    # Removes a subscriber registered with 'subscribe()'.
+    def unsubscribe(self, user_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    # Registers a function called with every published event, regardless of the user (e.g. to invalidate caches).
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    # Delivers 'event' to the subscribers of 'user_id' and the listeners of this process, and sends it to the other processes
+    # through the relay, if there is one.
+    def publish(self, user_id, event):
+        self.deliver(user_id, event)
+        if self.relay is not None:
+            self.relay.send(user_id, event)
+
+    # Delivers 'event' to every subscriber of 'user_id' and to every listener of this process. Delivering never blocks the calling route:
+    # if a subscriber is not consuming its queue, its oldest pending event is dropped to make room, since a single pending
+    # event is enough for the client to know that it has to synchronize.
+    def deliver(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        for listener in self._listeners:
+            listener(event)
+
+    # Returns the number of open subscriptions, for monitoring.
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+# Relays change events between the hubs of all application processes through the capped 'change_events' collection.
+# Events published in a process are inserted into the collection, tagged with the process that published them; a background
+# thread in every process follows the collection with a tailable cursor and delivers the events of other processes to its hub.
+# The collection is capped at 'collection_size' bytes, so old events are dropped as new ones arrive, and it is created with a
+# first event addressed to no one, as a tailable cursor on an empty collection ends immediately. A reconnecting cursor resumes
+# after the last event seen by its position in the collection; events dropped from the collection before a process reads them are
+# missed, but clients also synchronize whenever their stream reconnects.
+class ChangeRelay:
+    COLLECTION = 'change_events'
+
+    def __init__(self, mongo, hub, logger, collection_size=1024 * 1024, await_seconds=1, retry_interval=5):
+        self.mongo = mongo
+        self.hub = hub
+        self.logger = logger
+        self.collection_size = collection_size
+        self.await_seconds = await_seconds
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._origin = None
+
+    # Sends an event published in this process to the other processes. A failure is logged rather than raised, as the change
+    # itself has already been written: the clients of the other processes then only see it with their next synchronization.
+    def send(self, user_id, event):
+        self.ensure_started()
+        try:
+            self.mongo.db[self.COLLECTION].insert_one({'origin': self._origin, 'user_id': user_id, 'event': event})
+        except PyMongoError as e:
+            self.logger.error(f"Error relaying change event for user '{user_id}': {e}")
+
+    # Starts the thread following the collection, once per process. A forked worker process does not inherit the parent's thread,
+    # so a new one is started there, with an origin of its own.
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._origin = uuid.uuid4().hex
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='change-relay', daemon=True)
+            self._thread.start()
+
+    # Stops the thread of this process. It exits within 'await_seconds', once its cursor returns.
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout=self.await_seconds + 1)
+
+    # Creates the capped collection with its first event, unless it exists.
+    def _create_collection(self):
+        try:
+            collection = self.mongo.db.create_collection(self.COLLECTION, capped=True, size=self.collection_size)
+        except CollectionInvalid:
+            return
+        collection.insert_one({'origin': None, 'user_id': None, 'event': None})
+
+    def _run(self):
+        last_id = None
+        while not self._stop.is_set():
+            try:
+                self._create_collection()
+                collection = self.mongo.db[self.COLLECTION]
+                if last_id is None:
+                    latest = collection.find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+                    last_id = latest['_id']
+
+                # Event ids are generated by the publishing processes, so they do not follow the order of insertion: the cursor
+                # reads the collection in natural order instead and skips the events up to the last one seen. If that event has
+                # been dropped from the collection since, every remaining event is newer and none is skipped.
+                skipping = collection.find_one({'_id': last_id}, {'_id': 1}) is not None
+                cursor = collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                cursor.max_await_time_ms(self.await_seconds * 1000)
+                while cursor.alive and not self._stop.is_set():
+                    for document in cursor:
+                        if skipping:
+                            skipping = document['_id'] != last_id
+                            continue
+                        last_id = document['_id']
+                        if document['origin'] != self._origin and document['user_id'] is not None:
+                            self.hub.deliver(document['user_id'], document['event'])
+                        if self._stop.is_set():
+                            break
+                    # The end of the collection was reached without finding the last event seen: it was dropped meanwhile.
+                    skipping = False
+                cursor.close()
+            except PyMongoError as e:
+                self.logger.error(f"Error following change events: {e}")
+                self._stop.wait(self.retry_interval)
+
+
+# Publishes the change of an itinerary to its owner's clients. 'change' is one of 'created', 'updated', 'deleted' or 'liked'.
+def publish_itinerary_change(change_hub, owner_id, itinerary_id, change):
+    change_hub.publish(owner_id, {
+        'type': 'itinerary',
+        'change': change,
+        'itinerary_id': str(itinerary_id),
+        'user_id': owner_id
+    })
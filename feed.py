@@ -0,0 +1,131 @@
+# Helpers for the home feed: keyset (cursor-based) pagination over recent itineraries and preparation of itinerary cards.
+
+from flask import url_for
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from likes import liked_itinerary_ids
+from timestamps import to_datetime, before_position
+import pytz
+import humanize
+
+
+# Fields needed to render an itinerary card. Waypoints and images are never loaded for list pages.
+CARD_PROJECTION = {
+    'name': 1,
+    'description': 1,
+    'num_views': 1,
+    'likes_count': 1,
+    'upload_datetime': 1,
+    'image_hash': 1,
+    'image_format': 1,
+    'route_length': 1
+}
+
+# Sort order of the feed. '_id' breaks ties between itineraries uploaded in the same second, making the order total.
+FEED_SORT = [('upload_datetime', -1), ('_id', -1)]
+
+
+# Encodes the position of the last itinerary of a page into an opaque, URL-safe cursor. Upload dates stored as BSON dates are marked
+# with a 'date:' prefix, to tell them from the strings stored by earlier versions (see timestamps.py).
+def encode_cursor(itinerary):
+    upload_datetime = itinerary['upload_datetime']
+    if isinstance(upload_datetime, datetime):
+        upload_datetime = f"date:{upload_datetime.isoformat()}"
+    raw = f"{upload_datetime}|{itinerary['_id']}"
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+# Decodes a cursor produced by 'encode_cursor()'. Raises ValueError if the cursor is malformed.
+def decode_cursor(cursor):
+    try:
+        upload_datetime, itinerary_id = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        if upload_datetime.startswith('date:'):
+            upload_datetime = datetime.fromisoformat(upload_datetime[len('date:'):])
+        return upload_datetime, ObjectId(itinerary_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+# Returns one page of the feed and the cursor of the next page (None on the last page).
+# Instead of skipping over previous pages, the query resumes strictly after the cursor position on the
+# (upload_datetime, _id) key, so it is served by the 'feed_recent' index regardless of how deep the page is.
+def fetch_feed_page(mongo, cursor=None, page_size=20):
+    query = {'deleted': 0}
+    if cursor:
+        upload_datetime, itinerary_id = decode_cursor(cursor)
+        query['$or'] = before_position('upload_datetime', upload_datetime, itinerary_id)
+
+    # One extra document is requested to find out whether another page exists.
+    itineraries = list(mongo.db.itineraries.find(query, CARD_PROJECTION).sort(FEED_SORT).limit(page_size + 1))
+    next_cursor = None
+    if len(itineraries) > page_size:
+        itineraries = itineraries[:page_size]
+        next_cursor = encode_cursor(itineraries[-1])
+
+    return itineraries, next_cursor
+
+
+# Sets 'has_liked' on each itinerary of a list page, looking up the current user's likes for the whole page with one query.
+def mark_liked(mongo, itineraries, user_id):
+    liked = liked_itinerary_ids(mongo, user_id, [itinerary['_id'] for itinerary in itineraries])
+    for itinerary in itineraries:
+        itinerary['has_liked'] = itinerary['_id'] in liked
+
+
+# Converts a raw itinerary document into the fields displayed on its card.
+def prepare_card(itinerary, now=None):
+    now = now or datetime.utcnow().replace(tzinfo=pytz.utc)
+    itinerary['views'] = itinerary.pop('num_views', 0)
+    itinerary['likes'] = itinerary.pop('likes_count', 0)
+    itinerary.setdefault('has_liked', False)
+
+    upload_datetime = to_datetime(itinerary.get('upload_datetime'))
+    if upload_datetime is not None:
+        itinerary['upload_datetime'] = upload_datetime.replace(tzinfo=pytz.utc)
+        itinerary['time_since_upload'] = humanize.naturaltime(now - itinerary['upload_datetime'])
+    else:
+        itinerary['time_since_upload'] = ''
+    return itinerary
+
+
+# Serializes a prepared card for the feed API, with the same fields the 'index.html' template displays.
+def card_to_json(itinerary):
+    image_url = None
+    if itinerary.get('image_format'):
+        image_url = url_for('itineraries.itinerary_image', itinerary_id=str(itinerary['_id']), v=itinerary.get('image_hash'), size='small')
+
+    return {
+        '_id': str(itinerary['_id']),
+        'name': itinerary.get('name', ''),
+        'description': itinerary.get('description', ''),
+        'views': itinerary['views'],
+        'likes': itinerary['likes'],
+        'has_liked': itinerary['has_liked'],
+        'time_since_upload': itinerary['time_since_upload'],
+        'url': url_for('itineraries.view_itinerary', itinerary_id=str(itinerary['_id'])),
+        'image_url': image_url,
+        'route_length': itinerary.get('route_length')
+    }
+
+
+# Sets the 'likes_count' counter (and 'num_views', where missing) of itineraries created before counters were maintained.
+# Itineraries whose likes are still stored as an array get their counter from it; see also 'migrate_likes()' in likes.py.
+# Returns the number of updated itineraries.
+def backfill_counters(mongo, batch_size=500):
+    updated = 0
+    operations = []
+    for itinerary in mongo.db.itineraries.find({'likes_count': {'$exists': False}}, {'likes': 1, 'num_views': 1}):
+        likes = itinerary.get('likes')
+        counters = {
+            'likes_count': len(likes) if isinstance(likes, list) else 0,
+            'num_views': itinerary.get('num_views') or 0
+        }
+        operations.append(UpdateOne({'_id': itinerary['_id']}, {'$set': counters}))
+        if len(operations) >= batch_size:
+            updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+    return updated
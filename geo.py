@@ -0,0 +1,152 @@
+# Geospatial representation of itinerary waypoints and the spatial queries built on it.
+# Waypoints are stored with numeric coordinates, and each itinerary also carries a GeoJSON 'geometry' describing its route
+# (a LineString through its waypoints, or a Point for single-waypoint itineraries), indexed with a '2dsphere' index.
+# This lets the server return only the itineraries intersecting a map viewport or close to a point.
+
+from flask import url_for
+from pymongo import UpdateOne
+
+
+# Fields needed to draw an itinerary's markers on a map.
+MARKER_PROJECTION = {
+    'name': 1,
+    'waypoints': 1,
+    'route_polyline': 1
+}
+
+
+# Converts a latitude/longitude pair (numbers or numeric strings, as sent by forms) into floats.
+# Raises ValueError if either value is missing, not a number or out of range.
+def parse_coordinates(latitude, longitude):
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid coordinates: {latitude}, {longitude}")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError(f"Coordinates out of range: {latitude}, {longitude}")
+    return latitude, longitude
+
+
+# Reads the waypoints posted by the itinerary form ('waypoint_count' and 'waypoints[i][...]' fields), with numeric coordinates.
+def parse_waypoints(form):
+    waypoints = []
+    for i in range(int(form.get('waypoint_count', 0))):
+        latitude, longitude = parse_coordinates(form.get(f'waypoints[{i}][latitude]'), form.get(f'waypoints[{i}][longitude]'))
+        waypoints.append({
+            'name': form.get(f'waypoints[{i}][name]'),
+            'latitude': latitude,
+            'longitude': longitude
+        })
+    return waypoints
+
+
+# Returns the GeoJSON geometry of a route through the given waypoints, or None if there are no waypoints.
+# Consecutive repeated positions are dropped, as GeoJSON does not allow them in a LineString.
+def route_geometry(waypoints):
+    coordinates = []
+    for waypoint in waypoints or []:
+        position = [waypoint['longitude'], waypoint['latitude']]
+        if not coordinates or coordinates[-1] != position:
+            coordinates.append(position)
+
+    if not coordinates:
+        return None
+    if len(coordinates) == 1:
+        return {'type': 'Point', 'coordinates': coordinates[0]}
+    return {'type': 'LineString', 'coordinates': coordinates}
+
+
+# Builds the query matching non-deleted itineraries whose route intersects the rectangle between the given longitudes and latitudes.
+# A viewport crossing the antimeridian (west > east) is split into two rectangles, and wide rectangles are split further into strips
+# at most 90 degrees wide, since MongoDB interprets a polygon larger than a hemisphere as its complement.
+def viewport_query(west, south, east, north):
+    # Each corner is validated as a (latitude, longitude) pair.
+    south, west = parse_coordinates(south, west)
+    north, east = parse_coordinates(north, east)
+    if south >= north:
+        raise ValueError("The southern edge of the viewport must be below the northern edge.")
+
+    spans = [(west, east)] if west < east else [(west, 180.0), (-180.0, east)]
+    boxes = []
+    for span_west, span_east in spans:
+        while span_east - span_west > 90:
+            boxes.append((span_west, span_west + 90))
+            span_west += 90
+        boxes.append((span_west, span_east))
+    conditions = [
+        {'geometry': {'$geoIntersects': {'$geometry': {
+            'type': 'Polygon',
+            'coordinates': [[[w, south], [e, south], [e, north], [w, north], [w, south]]]
+        }}}}
+        for w, e in boxes
+    ]
+    query = conditions[0] if len(conditions) == 1 else {'$or': conditions}
+    query['deleted'] = 0
+    return query
+
+
+# Returns up to 'limit' non-deleted itineraries whose route intersects the given viewport, most recent first.
+def find_in_viewport(mongo, west, south, east, north, limit=200):
+    query = viewport_query(west, south, east, north)
+    return list(mongo.db.itineraries.find(query, MARKER_PROJECTION).sort('upload_datetime', -1).limit(limit))
+
+
+# Returns up to 'limit' non-deleted itineraries whose route passes within 'max_distance' meters of a point, closest first.
+# Raises ValueError if the coordinates are invalid or 'max_distance' is not a positive number.
+def find_nearby(mongo, latitude, longitude, max_distance=50000, limit=200):
+    latitude, longitude = parse_coordinates(latitude, longitude)
+    if not max_distance > 0:
+        raise ValueError(f"Invalid radius: {max_distance}")
+    query = {
+        'geometry': {'$near': {
+            '$geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            '$maxDistance': max_distance
+        }},
+        'deleted': 0
+    }
+    return list(mongo.db.itineraries.find(query, MARKER_PROJECTION).limit(limit))
+
+
+# Serializes an itinerary found by a spatial query with only what is needed to draw its markers, and its simplified route
+# as an encoded polyline (see route_metrics.py).
+def marker_to_json(itinerary):
+    return {
+        '_id': str(itinerary['_id']),
+        'name': itinerary.get('name', ''),
+        'waypoints': [
+            {'name': waypoint.get('name'), 'latitude': waypoint['latitude'], 'longitude': waypoint['longitude']}
+            for waypoint in itinerary.get('waypoints') or []
+        ],
+        'polyline': itinerary.get('route_polyline'),
+        'url': url_for('itineraries.view_itinerary', itinerary_id=str(itinerary['_id']))
+    }
+
+
+# Converts the waypoints of itineraries created by earlier versions (coordinates stored as strings) to numeric coordinates
+# and computes their route geometry. Itineraries with invalid coordinates are skipped. Returns the number of updated itineraries.
+def backfill_geometry(mongo, batch_size=500):
+    updated = 0
+    operations = []
+    query = {'deleted': 0, 'geometry': {'$exists': False}}
+    for itinerary in mongo.db.itineraries.find(query, {'waypoints': 1}):
+        try:
+            waypoints = []
+            for waypoint in itinerary.get('waypoints') or []:
+                latitude, longitude = parse_coordinates(waypoint.get('latitude'), waypoint.get('longitude'))
+                waypoints.append(dict(waypoint, latitude=latitude, longitude=longitude))
+        except ValueError:
+            continue
+
+        fields = {'waypoints': waypoints}
+        geometry = route_geometry(waypoints)
+        if geometry:
+            fields['geometry'] = geometry
+        operations.append(UpdateOne({'_id': itinerary['_id']}, {'$set': fields}))
+
+        if len(operations) >= batch_size:
+            updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    if operations:
+        updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+    return updated
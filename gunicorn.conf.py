@@ -0,0 +1,40 @@
+# Configuration of the Gunicorn production server, started by './run.sh production' or, from the project's root directory:
+#
+#     gunicorn -c gunicorn.conf.py 'mapster_app:create_app()'
+#
+# The application is built once by the master process, which also creates the indexes and compresses the static assets, and shared
+# by the forked worker processes, each serving requests with a pool of threads. Settings are read from config.py.
+# A change stream ('/api/changes') holds one of these threads while it is open: each worker serves at most CHANGE_STREAM_MAX_CONNECTIONS
+# of them at once, closes each after CHANGE_STREAM_MAX_SECONDS, and refuses the others, so that SERVER_THREADS minus that number of
+# threads always remain for the other requests. Raise SERVER_THREADS along with CHANGE_STREAM_MAX_CONNECTIONS to serve more streams.
+
+import multiprocessing
+import config as mapster_config  # Not named 'config', which Gunicorn would read as one of its settings.
+
+
+bind = getattr(mapster_config, 'SERVER_BIND', '0.0.0.0:8000')
+workers = getattr(mapster_config, 'SERVER_WORKERS', 0) or multiprocessing.cpu_count() * 2 + 1
+worker_class = 'gthread'
+threads = getattr(mapster_config, 'SERVER_THREADS', 8)
+timeout = getattr(mapster_config, 'SERVER_TIMEOUT', 60)
+graceful_timeout = getattr(mapster_config, 'SERVER_GRACEFUL_TIMEOUT', 30)
+keepalive = getattr(mapster_config, 'SERVER_KEEPALIVE', 5)
+preload_app = True
+accesslog = '-'
+
+
+# Prepares the application once, before the workers are forked (see 'bootstrap()' in mapster_app.py), so that they inherit the result,
+# then closes the master's MongoDB client: its connections and monitoring threads would not be usable in the workers anyway.
+# Each worker creates its own client, with its own connection pool, when it first uses it (see database.py).
+def when_ready(server):
+    import mapster_app
+    app = server.app.wsgi()
+    mapster_app.bootstrap(app)
+    app.extensions['mapster_assets'].compress_all()
+    app.extensions['mapster_mongo'].close()
+
+
+# Writes the data buffered by the worker (itinerary views) and stops its background threads before it exits.
+def worker_exit(server, worker):
+    import mapster_app
+    mapster_app.shutdown(worker.wsgi)
@@ -0,0 +1,124 @@
+# Content-addressed storage of itinerary map images in GridFS.
+# Images are identified by the SHA-256 hash of their content and stored once, however many itineraries (or successive
+# versions of the same itinerary) use them. The 'image_refs' collection maps each hash to its GridFS file and counts the
+# itineraries referencing it; the file is deleted when the last reference is released.
+
+import hashlib
+from io import BytesIO
+from gridfs import GridFSBucket
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class ImageStore:
+    def __init__(self, mongo, chunk_size=255 * 1024):
+        self.mongo = mongo
+        self.chunk_size = chunk_size
+        self._bucket = None
+        self._bucket_db = None
+
+    # The bucket is created again if the MongoDB client has been replaced (e.g. in a forked server worker, see database.py).
+    @property
+    def bucket(self):
+        if self._bucket is None or self._bucket_db is not self.mongo.db:
+            self._bucket_db = self.mongo.db
+            self._bucket = GridFSBucket(self._bucket_db, bucket_name='images', chunk_size_bytes=self.chunk_size)
+        return self._bucket
+
+    # Stores the image read from 'stream' (a seekable file object, such as an uploaded file) and returns its hash,
+    # adding one reference to it. The stream is read in chunks: a first pass computes the hash, and only if no image with
+    # that hash is stored yet is the stream read again and written to GridFS, in chunks as well.
+    def store(self, stream, image_format):
+        hasher = hashlib.sha256()
+        size = 0
+        for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+            hasher.update(chunk)
+            size += len(chunk)
+        image_hash = hasher.hexdigest()
+
+        if self._add_reference(image_hash):
+            return image_hash
+
+        stream.seek(0)
+        file_id = self.bucket.upload_from_stream(image_hash, stream, metadata={'format': image_format})
+        try:
+            self.mongo.db.image_refs.insert_one({
+                '_id': image_hash,
+                'file_id': file_id,
+                'format': image_format,
+                'size': size,
+                'refcount': 1
+            })
+        except DuplicateKeyError:
+            # The same image was stored concurrently: keep that copy and reference it instead.
+            self.bucket.delete(file_id)
+            self._add_reference(image_hash)
+        return image_hash
+
+    # Stores an image held in memory (e.g. one embedded in a document by earlier versions). See 'store()'.
+    def store_bytes(self, data, image_format):
+        return self.store(BytesIO(data), image_format)
+
+    # Removes one reference to an image, deleting it once no itinerary references it anymore.
+    def release(self, image_hash):
+        if not image_hash:
+            return
+        ref = self.mongo.db.image_refs.find_one_and_update(
+            {'_id': image_hash},
+            {'$inc': {'refcount': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        # The conditional delete ensures that an image referenced again in the meantime is kept.
+        if ref and ref['refcount'] <= 0:
+            if self.mongo.db.image_refs.delete_one({'_id': image_hash, 'refcount': {'$lte': 0}}).deleted_count:
+                self.bucket.delete(ref['file_id'])
+                # Reduced-size variants (see thumbnails.py) are deleted along with their original.
+                for variant_hash in ref.get('variants', {}).values():
+                    if variant_hash != image_hash:
+                        self.release(variant_hash)
+
+    # Returns the hash of the given variant of an image, or None if it has not been generated (yet).
+    def variant(self, image_hash, name):
+        ref = self.mongo.db.image_refs.find_one({'_id': image_hash}, {'variants': 1})
+        return ref.get('variants', {}).get(name) if ref else None
+
+    # Records 'variant_hash' (an image stored with 'store()', whose reference passes to the original) as the given variant of an image.
+    # An image can be its own variant, when it is already small enough. If the variant is already recorded, or the original no longer
+    # exists, the reference to 'variant_hash' is released.
+    def add_variant(self, image_hash, name, variant_hash):
+        result = self.mongo.db.image_refs.update_one(
+            {'_id': image_hash, f'variants.{name}': {'$exists': False}},
+            {'$set': {f'variants.{name}': variant_hash}}
+        )
+        if not result.modified_count and variant_hash != image_hash:
+            self.release(variant_hash)
+
+    # Returns a file object from which the image can be read in chunks, or None if no image with that hash is stored.
+    # The object exposes the image size as 'length'.
+    def open(self, image_hash):
+        ref = self.mongo.db.image_refs.find_one({'_id': image_hash}, {'file_id': 1})
+        if not ref:
+            return None
+        return self.bucket.open_download_stream(ref['file_id'])
+
+    def _add_reference(self, image_hash):
+        result = self.mongo.db.image_refs.update_one({'_id': image_hash}, {'$inc': {'refcount': 1}})
+        return result.matched_count == 1
+
+
+# Moves the images embedded in itinerary documents by earlier versions into the image store, replacing them with a reference.
+# Returns the number of migrated itineraries.
+def migrate_embedded_images(mongo, image_store):
+    migrated = 0
+    for itinerary in mongo.db.itineraries.find({'image': {'$exists': True}}, {'image': 1, 'image_format': 1}):
+        update = {'$unset': {'image': ''}}
+        if itinerary['image']:
+            image_hash = image_store.store_bytes(bytes(itinerary['image']), itinerary.get('image_format') or 'jpg')
+            update['$set'] = {'image_hash': image_hash}
+        result = mongo.db.itineraries.update_one({'_id': itinerary['_id'], 'image': {'$exists': True}}, update)
+        if not result.modified_count and itinerary['image']:
+            # The itinerary changed meanwhile; drop the reference taken above.
+            image_store.release(image_hash)
+        else:
+            migrated += 1
+    return migrated
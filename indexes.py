@@ -0,0 +1,75 @@
+# Definitions of the MongoDB indexes required by the application's queries, created at application startup.
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE
+from pymongo.errors import PyMongoError
+
+
+# Indexes grouped by collection. Each entry is a (keys, options) pair passed to 'create_index()'.
+INDEXES = {
+    'itineraries': [
+        # Home feed: keyset pagination over non-deleted itineraries, newest first (see feed.py).
+        ([('deleted', ASCENDING), ('upload_datetime', DESCENDING), ('_id', DESCENDING)], {'name': 'feed_recent'}),
+        # Search filters: most viewed and most liked itineraries.
+        ([('deleted', ASCENDING), ('num_views', DESCENDING), ('_id', DESCENDING)], {'name': 'most_viewed'}),
+        ([('deleted', ASCENDING), ('likes_count', DESCENDING), ('_id', DESCENDING)], {'name': 'most_liked'}),
+        # Search: itineraries containing given words or word prefixes, most recent first (see search.py).
+        ([('search_terms', ASCENDING), ('deleted', ASCENDING), ('upload_datetime', DESCENDING)], {'name': 'search_terms'}),
+        # Synchronization: a user's changes in sync sequence order (see sync.py).
+        ([('user_id', ASCENDING), ('sync_seq', ASCENDING), ('_id', ASCENDING)], {'name': 'sync_changes'}),
+        # One name per user among non-deleted itineraries; duplicate names are rejected by the database (see itinerary_model.py).
+        ([('user_id', ASCENDING), ('name', ASCENDING)], {'name': 'user_name', 'unique': True, 'partialFilterExpression': {'deleted': 0}}),
+        # Maintenance: tombstones of deleted itineraries, by deletion date (see maintenance.py).
+        ([('deleted_at', ASCENDING)], {'name': 'tombstones', 'partialFilterExpression': {'deleted': 1}}),
+        # Spatial queries: itineraries whose route intersects a map viewport or passes near a point (see geo.py).
+        ([('geometry', GEOSPHERE), ('deleted', ASCENDING)], {'name': 'geometry'}),
+    ],
+    'likes': [
+        # One like per user and itinerary; also serves the lookup of the current user's likes on a list page (see likes.py).
+        ([('user_id', ASCENDING), ('itinerary_id', ASCENDING)], {'name': 'user_itinerary', 'unique': True}),
+        # Removal of an itinerary's likes when it is deleted.
+        ([('itinerary_id', ASCENDING)], {'name': 'itinerary'}),
+    ],
+    'sync_writes': [
+        # Lowest sync sequence value of the writes in flight, and removal of those that never completed (see sync.py).
+        ([('floor', ASCENDING)], {'name': 'floor'}),
+        ([('expires_at', ASCENDING)], {'name': 'expiry', 'expireAfterSeconds': 0}),
+    ],
+    'login_attempts': [
+        # Removal of expired failed login counters (see login_throttle.py).
+        ([('expires_at', ASCENDING)], {'name': 'expiry', 'expireAfterSeconds': 0}),
+    ],
+}
+
+
+# Creates every index listed in INDEXES. Creation is idempotent, so this is safe to run on every startup;
+# failures are logged rather than raised so that an unreachable database does not prevent the app from starting.
+def ensure_indexes(mongo, logger):
+    for collection_name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                mongo.db[collection_name].create_index(keys, **options)
+            except PyMongoError as e:
+                logger.warning(f"Could not create index '{options.get('name')}' on '{collection_name}': {e}")
+
+
+# Checks that every index listed in INDEXES exists with the expected keys. Missing indexes are created, and indexes whose keys
+# differ from their definition are rebuilt. Returns the names of the indexes that are still missing or wrong.
+def verify_indexes(mongo, logger):
+    problems = []
+    for collection_name, indexes in INDEXES.items():
+        collection = mongo.db[collection_name]
+        existing = collection.index_information()
+        for keys, options in indexes:
+            name = options['name']
+            try:
+                if name in existing and list(existing[name]['key']) != keys:
+                    logger.warning(f"Rebuilding index '{name}' on '{collection_name}': its keys differ from its definition")
+                    collection.drop_index(name)
+                    collection.create_index(keys, **options)
+                elif name not in existing:
+                    logger.warning(f"Creating missing index '{name}' on '{collection_name}'")
+                    collection.create_index(keys, **options)
+            except PyMongoError as e:
+                logger.error(f"Could not create index '{name}' on '{collection_name}': {e}")
+                problems.append(f"{collection_name}.{name}")
+    return problems
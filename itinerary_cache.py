@@ -0,0 +1,99 @@
+# Cache of the prepared itineraries displayed by the itinerary page ('/view-itinerary/<itinerary_id>').
+# The page needs the itinerary document converted for the template, its author's name and formatted dates: this work is
+# the same for every viewer, so it is done once per itinerary and cached until the itinerary changes. Concurrent requests
+# missing the cache for the same itinerary (e.g. when a shared link goes viral) are coalesced into a single database read.
+# Entries are removed when a change of their itinerary is published on the change hub (see events.py) and otherwise expire
+# after a TTL, which bounds their staleness in other server processes. Views written by the view counter are added to the
+# cached counts (see 'add_views()'), so the displayed count keeps including them.
+# Only the parts of the page that depend on the viewer (whether they are the author, whether they liked the itinerary) are
+# computed on every request.
+
+import threading
+from bson import ObjectId
+from bson_json import to_json_safe
+from cache import TTLCache, SingleFlight
+from user_model import get_user_data
+from timestamps import to_datetime
+
+
+_MISSING = object()
+
+
+class PreparedItinerary:
+    def __init__(self, itinerary, author, creation_date):
+        self.id = itinerary['_id']
+        self.owner_id = itinerary.get('user_id')
+        self.name = itinerary.get('name')
+        self.description = itinerary.get('description', '')
+        self.num_likes = itinerary.get('likes_count', 0)
+        self.num_views = itinerary.get('num_views', 0)
+        self.author = author
+        self.creation_date = creation_date
+        # Template-ready copy of the document, shared by the requests: 'template_data()' returns a copy with the current view count.
+        self.document = to_json_safe(itinerary)
+
+    def template_data(self, num_views):
+        document = dict(self.document)
+        document['num_views'] = num_views
+        return document
+
+
+# Reads an itinerary and prepares it for display. Returns None if it does not exist.
+def prepare_itinerary(mongo, user_cache, itinerary_id):
+    itinerary = mongo.db.itineraries.find_one({'_id': itinerary_id}, {'image': 0, 'likes': 0})
+    if not itinerary:
+        return None
+
+    author_data = get_user_data(mongo, user_cache, itinerary.get('user_id'))
+    author = author_data.get('name') if author_data else "Anonymous"
+    # Dates are stored as BSON dates, or as strings by earlier versions (see timestamps.py).
+    upload_datetime = to_datetime(itinerary.get('upload_datetime'))
+    creation_date = upload_datetime.strftime('%m/%d/%Y') if upload_datetime else "Unknown"
+    return PreparedItinerary(itinerary, author, creation_date)
+
+
+class ItineraryCache:
+    def __init__(self, mongo, user_cache, maxsize=1024, ttl=60, enabled=True):
+        self.mongo = mongo
+        self.user_cache = user_cache
+        self.enabled = enabled
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    # Returns the prepared itinerary with ID 'itinerary_id' (an ObjectId), or None if it does not exist.
+    def get(self, itinerary_id):
+        prepared = self.entries.get(itinerary_id, _MISSING) if self.enabled else _MISSING
+        if prepared is _MISSING:
+            prepared = self._flight.do(itinerary_id, lambda: self._load(itinerary_id))
+        return prepared
+
+    # Loads an itinerary and caches it, unless an invalidation or a write of views happened during the read (the result could be
+    # older than the change, or miss views that 'add_views()' could not add to it as it was not cached yet).
+    def _load(self, itinerary_id):
+        generation = self._generation
+        prepared = prepare_itinerary(self.mongo, self.user_cache, itinerary_id)
+        if self.enabled:
+            with self._lock:
+                if generation == self._generation:
+                    self.entries.set(itinerary_id, prepared)
+        return prepared
+
+    # Removes the itinerary of a change event from the cache. Registered as a listener of the change hub.
+    def invalidate(self, event):
+        with self._lock:
+            self._generation += 1
+            self.entries.invalidate(ObjectId(event['itinerary_id']))
+
+    # Adds views written to the database to the counts of the cached itineraries. Registered as a listener of the view counter.
+    def add_views(self, views):
+        with self._lock:
+            self._generation += 1
+            for itinerary_id, count in views.items():
+                prepared = self.entries.get(itinerary_id)
+                if prepared is not None:
+                    prepared.num_views += count
+
+    def stats(self):
+        return self.entries.stats()
@@ -0,0 +1,73 @@
+# Construction of itinerary documents, shared by the form routes (see routes/itinerary_routes.py) and the bulk write API
+# (see routes/api_routes.py). Besides the fields entered by the user, every write stores the fields derived from them:
+# search terms (see search.py), route geometry (see geo.py) and route metrics (see route_metrics.py).
+
+from search import build_search_terms
+from geo import parse_coordinates, route_geometry
+from route_metrics import route_fields, ROUTE_FIELDS
+from timestamps import utc_now
+
+
+# Error returned when a user already has an itinerary with the same name, detected through the unique 'user_name' index (see indexes.py).
+DUPLICATE_NAME_ERROR = "An itinerary named '{}' already exists in your profile."
+
+
+# Validates an itinerary received as JSON (or BSON) by the API and returns its name, description and waypoints,
+# with coordinates converted to numbers. Raises ValueError describing the first invalid field.
+def parse_itinerary(data):
+    if not isinstance(data, dict):
+        raise ValueError("Each itinerary must be an object.")
+
+    name = data.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("The itinerary name is required.")
+    description = data.get('description') or ''
+    if not isinstance(description, str):
+        raise ValueError("The itinerary description must be a string.")
+
+    raw_waypoints = data.get('waypoints') or []
+    if not isinstance(raw_waypoints, list):
+        raise ValueError("The itinerary waypoints must be a list.")
+    waypoints = []
+    for waypoint in raw_waypoints:
+        if not isinstance(waypoint, dict):
+            raise ValueError("Each waypoint must be an object.")
+        latitude, longitude = parse_coordinates(waypoint.get('latitude'), waypoint.get('longitude'))
+        waypoints.append({'name': waypoint.get('name'), 'latitude': latitude, 'longitude': longitude})
+    return name, description, waypoints
+
+
+# Builds the update setting an itinerary's content. Returns the fields to set and the fields to unset: itineraries without
+# waypoints have no route geometry nor metrics.
+def itinerary_update(name, description, waypoints, sync_seq, timestamp=None, tolerance=10):
+    fields = {
+        'name': name,
+        'description': description,
+        'waypoints': waypoints,
+        'last_modified': timestamp or utc_now(),
+        'search_terms': build_search_terms(name, description),
+        'sync_seq': sync_seq
+    }
+    unset_fields = {}
+
+    geometry = route_geometry(waypoints)
+    if geometry:
+        fields['geometry'] = geometry
+        fields.update(route_fields(waypoints, tolerance))
+    else:
+        unset_fields = {field: '' for field in ('geometry',) + ROUTE_FIELDS}
+    return fields, unset_fields
+
+
+# Builds the document of a new itinerary.
+def new_itinerary(user_id, name, description, waypoints, sync_seq, timestamp=None, tolerance=10):
+    timestamp = timestamp or utc_now()
+    itinerary, _ = itinerary_update(name, description, waypoints, sync_seq, timestamp, tolerance)
+    itinerary.update({
+        'user_id': user_id,
+        'upload_datetime': timestamp,
+        'num_views': 0,
+        'likes_count': 0,
+        'deleted': 0
+    })
+    return itinerary
@@ -0,0 +1,126 @@
+# Storage of itinerary likes. Each like is a small document of the 'likes' collection identified by the unique
+# (user_id, itinerary_id) pair, while the itinerary only keeps the denormalized 'likes_count' counter. Itinerary documents
+# therefore stay the same size however popular they become, and list pages never load the users who liked an itinerary.
+
+import time
+from pymongo import ReturnDocument, InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from sync import sync_write
+
+
+RECONCILE_CHECKPOINT_ID = 'likes_reconcile'
+
+
+# Toggles the like of 'user_id' on an itinerary and returns the state after the toggle as a (liked, owner_id, likes_count) tuple,
+# or None if the itinerary does not exist or was deleted. The like document is removed if present, otherwise created; the unique
+# index makes each of these operations atomic, so concurrent toggles cannot double-count. The counter is then adjusted with an
+# atomic '$inc' that returns the updated value, instead of reading the itinerary beforehand, and the itinerary is stamped with a new
+# sync sequence value, so that its owner's clients receive the new count (see sync.py).
+# The like and the counter are two separate writes, not a transaction (which would require a replica set): if the process stops
+# between them, the counter is wrong until 'reconcile_like_counts()' repairs it.
+def toggle_like(mongo, itinerary_id, user_id):
+    like = {'user_id': user_id, 'itinerary_id': itinerary_id}
+    if mongo.db.likes.delete_one(like).deleted_count:
+        liked, delta = False, -1
+    else:
+        try:
+            mongo.db.likes.insert_one(dict(like))
+            liked, delta = True, 1
+        except DuplicateKeyError:
+            # The same user liked the itinerary concurrently; the like already exists and is already counted.
+            liked, delta = True, 0
+
+    with sync_write(mongo) as sync_seq:
+        itinerary = mongo.db.itineraries.find_one_and_update(
+            {'_id': itinerary_id, 'deleted': 0},
+            {'$inc': {'likes_count': delta}, '$set': {'sync_seq': sync_seq}},
+            projection={'likes_count': 1, 'user_id': 1},
+            return_document=ReturnDocument.AFTER
+        )
+    if itinerary is None:
+        if delta == 1:
+            mongo.db.likes.delete_one(like)
+        return None
+
+    return liked, itinerary['user_id'], itinerary['likes_count']
+
+
+# Returns the set of IDs, among 'itinerary_ids', of the itineraries liked by 'user_id', using a single indexed query.
+def liked_itinerary_ids(mongo, user_id, itinerary_ids):
+    if not user_id or not itinerary_ids:
+        return set()
+    likes = mongo.db.likes.find(
+        {'user_id': user_id, 'itinerary_id': {'$in': list(itinerary_ids)}},
+        {'itinerary_id': 1, '_id': 0}
+    )
+    return {like['itinerary_id'] for like in likes}
+
+
+# Returns the 'likes_count' counter of each of the given itineraries and the number of their documents in the 'likes' collection,
+# as a dictionary from itinerary ID to a (counter, likes) pair.
+def _like_counts(mongo, itinerary_ids):
+    likes = mongo.db.likes.aggregate([
+        {'$match': {'itinerary_id': {'$in': itinerary_ids}}},
+        {'$group': {'_id': '$itinerary_id', 'count': {'$sum': 1}}}
+    ])
+    counts = {group['_id']: group['count'] for group in likes}
+    itineraries = mongo.db.itineraries.find({'_id': {'$in': itinerary_ids}, 'deleted': 0}, {'likes_count': 1})
+    return {itinerary['_id']: (itinerary.get('likes_count', 0), counts.get(itinerary['_id'], 0)) for itinerary in itineraries}
+
+
+# Repairs the 'likes_count' counters that disagree with the 'likes' collection, as left by a process that stopped between the two
+# writes of 'toggle_like()'. Each run checks the next 'batch_size' itineraries in '_id' order, resuming after the last one checked
+# by the previous run (recorded in the 'meta' collection) and starting over after the last itinerary, so that every counter is
+# checked within a bounded number of maintenance runs. A toggle in progress also shows a mismatch for a moment, so a counter is
+# only repaired if its mismatch is unchanged after 'settle_seconds', and only if it still holds the value that was checked.
+# Repaired itineraries are stamped with new sync sequence values, so that clients receive the repaired counts. Returns their number.
+def reconcile_like_counts(mongo, batch_size=5000, settle_seconds=1):
+    checkpoint = mongo.db.meta.find_one({'_id': RECONCILE_CHECKPOINT_ID})
+    query = {'deleted': 0}
+    if checkpoint and checkpoint.get('last_id') is not None:
+        query['_id'] = {'$gt': checkpoint['last_id']}
+    itinerary_ids = [itinerary['_id'] for itinerary in mongo.db.itineraries.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+    last_id = itinerary_ids[-1] if len(itinerary_ids) == batch_size else None
+    mongo.db.meta.update_one({'_id': RECONCILE_CHECKPOINT_ID}, {'$set': {'last_id': last_id}}, upsert=True)
+
+    mismatches = {itinerary_id: counts for itinerary_id, counts in _like_counts(mongo, itinerary_ids).items() if counts[0] != counts[1]}
+    if not mismatches:
+        return 0
+    time.sleep(settle_seconds)
+    rechecked = _like_counts(mongo, list(mismatches))
+    repairs = [(itinerary_id, counts) for itinerary_id, counts in mismatches.items() if rechecked.get(itinerary_id) == counts]
+    if not repairs:
+        return 0
+
+    with sync_write(mongo, len(repairs)) as sync_seq:
+        result = mongo.db.itineraries.bulk_write([
+            UpdateOne({'_id': itinerary_id, 'likes_count': counter}, {'$set': {'likes_count': likes, 'sync_seq': sync_seq + index}})
+            for index, (itinerary_id, (counter, likes)) in enumerate(repairs)
+        ], ordered=False)
+    return result.modified_count
+
+
+# Removes every like of an itinerary, used when the itinerary is deleted.
+def delete_itinerary_likes(mongo, itinerary_id):
+    mongo.db.likes.delete_many({'itinerary_id': itinerary_id})
+
+
+# Moves the 'likes' arrays stored on itineraries by earlier versions into the 'likes' collection, setting 'likes_count' from them.
+# Likes already moved are skipped, so the migration can be safely re-run. Returns the number of migrated itineraries.
+def migrate_likes(mongo):
+    migrated = 0
+    for itinerary in mongo.db.itineraries.find({'likes': {'$exists': True}}, {'likes': 1, 'deleted': 1}):
+        likes = itinerary['likes'] if isinstance(itinerary['likes'], list) and not itinerary.get('deleted') else []
+        if likes:
+            try:
+                mongo.db.likes.bulk_write(
+                    [InsertOne({'user_id': user_id, 'itinerary_id': itinerary['_id']}) for user_id in set(likes)],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+        likes_count = mongo.db.likes.count_documents({'itinerary_id': itinerary['_id']})
+        mongo.db.itineraries.update_one({'_id': itinerary['_id']}, {'$set': {'likes_count': likes_count}, '$unset': {'likes': ''}})
+        migrated += 1
+    return migrated
@@ -0,0 +1,62 @@
+# Throttling of failed login attempts, limiting password guessing and the CPU it costs in password hashing.
+# Failures are counted per username and client address pair and per client address in the 'login_attempts' collection, so that
+# the limits hold across all server processes. A counter starts with the first failure and expires 'window' seconds later; while
+# a pair or an address is over its limit, logins are refused before any password is checked. Usernames are only limited together
+# with the address trying them, so that failures from other clients can never lock a user out of their account.
+# Behind a reverse proxy, client addresses are only known if PROXY_FIX_HOPS is set (see mapster_app.py).
+
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+
+class LoginThrottle:
+    def __init__(self, mongo, logger, max_attempts=5, max_attempts_per_address=20, window=900):
+        self.mongo = mongo
+        self.logger = logger
+        self.max_attempts = max_attempts
+        self.max_attempts_per_address = max_attempts_per_address
+        self.window = window
+
+    def _limits(self, username, address):
+        return {f'user:{username}@{address}': self.max_attempts, f'address:{address}': self.max_attempts_per_address}
+
+    # Returns the number of seconds before a login for 'username' from 'address' is allowed again, or 0 if it is allowed now.
+    # If the counters cannot be read, logins are allowed.
+    def retry_after(self, username, address):
+        limits = self._limits(username, address)
+        now = datetime.utcnow()
+        try:
+            counters = list(self.mongo.db.login_attempts.find({'_id': {'$in': list(limits)}, 'expires_at': {'$gt': now}}))
+        except PyMongoError as e:
+            self.logger.warning(f"Could not read login attempt counters: {e}")
+            return 0
+        waits = [(counter['expires_at'] - now).total_seconds() for counter in counters if counter['count'] >= limits[counter['_id']]]
+        return max(1, int(max(waits))) if waits else 0
+
+    # Counts a failed login for 'username' from 'address'. An expired counter still waiting for removal is restarted.
+    def record_failure(self, username, address):
+        now = datetime.utcnow()
+        for key in self._limits(username, address):
+            try:
+                counter = self.mongo.db.login_attempts.find_one_and_update(
+                    {'_id': key, 'expires_at': {'$gt': now}},
+                    {'$inc': {'count': 1}},
+                    return_document=ReturnDocument.AFTER
+                )
+                if counter is None:
+                    self.mongo.db.login_attempts.replace_one(
+                        {'_id': key},
+                        {'count': 1, 'expires_at': now + timedelta(seconds=self.window)},
+                        upsert=True
+                    )
+            except PyMongoError as e:
+                self.logger.warning(f"Could not count failed login for '{key}': {e}")
+
+    # Resets the failure counter of a username from 'address' after a successful login. The address keeps its counter, so that
+    # an attacker cannot reset it by logging into an account of their own.
+    def clear(self, username, address):
+        try:
+            self.mongo.db.login_attempts.delete_one({'_id': f'user:{username}@{address}'})
+        except PyMongoError as e:
+            self.logger.warning(f"Could not reset failed logins for '{username}': {e}")
@@ -0,0 +1,114 @@
+# Periodic maintenance of the database: purging old tombstones of deleted itineraries, verifying the indexes the routes
+# rely on, refreshing the trending leaderboard and repairing like counters.
+# Each application process runs a scheduler thread, but a lease stored in the 'meta' collection ensures that only one
+# process runs the tasks in each interval. The tasks can also be run on demand with 'flask maintenance'.
+
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from indexes import verify_indexes
+from likes import reconcile_like_counts
+from sync import advance_sync_horizons
+from trending import refresh_trending
+
+
+LEASE_ID = 'maintenance_lease'
+
+
+# Deletes the tombstones of itineraries deleted more than 'retention_days' days ago. Before each batch is deleted, the sync
+# horizon of each of their users is moved past them, so that the user's clients that might not have received those deletions
+# are told to resync (see sync.py).
+# Tombstones created before deletion dates were recorded are dated now. Returns the number of deleted tombstones.
+def purge_tombstones(mongo, retention_days=30, batch_size=1000):
+    now = datetime.utcnow()
+    mongo.db.itineraries.update_many({'deleted': 1, 'deleted_at': {'$exists': False}}, {'$set': {'deleted_at': now}})
+
+    cutoff = now - timedelta(days=retention_days)
+    purged = 0
+    while True:
+        tombstones = list(mongo.db.itineraries.find({'deleted': 1, 'deleted_at': {'$lt': cutoff}}, {'user_id': 1, 'sync_seq': 1}).limit(batch_size))
+        if not tombstones:
+            return purged
+        horizons = {}
+        for tombstone in tombstones:
+            horizons[tombstone['user_id']] = max(horizons.get(tombstone['user_id'], 0), tombstone.get('sync_seq', 0))
+        advance_sync_horizons(mongo, horizons)
+        result = mongo.db.itineraries.delete_many({'_id': {'$in': [tombstone['_id'] for tombstone in tombstones]}, 'deleted': 1})
+        purged += result.deleted_count
+
+
+# Returns the maintenance tasks, as (name, function) pairs, configured from the application's settings.
+def default_tasks(mongo, logger, config):
+    return [
+        ('purge-tombstones', lambda: purge_tombstones(mongo, retention_days=config.get('TOMBSTONE_RETENTION_DAYS', 30))),
+        ('verify-indexes', lambda: verify_indexes(mongo, logger)),
+        ('refresh-trending', lambda: len(refresh_trending(mongo, size=config.get('TRENDING_SIZE', 20)))),
+        ('reconcile-likes', lambda: reconcile_like_counts(mongo, batch_size=config.get('LIKES_RECONCILE_BATCH_SIZE', 5000)))
+    ]
+
+
+class MaintenanceScheduler:
+    def __init__(self, mongo, logger, tasks, interval=3600):
+        self.mongo = mongo
+        self.logger = logger
+        self.tasks = tasks
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+
+    # Runs every task once and returns their results by name; a failing task is logged and does not prevent the others from running.
+    # Unless 'force' is set, nothing is run if another process holds the lease for the current interval.
+    def run_once(self, force=False):
+        if not force and not self._acquire_lease():
+            return None
+
+        results = {}
+        for name, task in self.tasks:
+            try:
+                results[name] = task()
+                self.logger.info(f"Maintenance task '{name}' completed: {results[name]}")
+            except Exception as e:
+                self.logger.error(f"Maintenance task '{name}' failed: {e}")
+        return results
+
+    # Starts the scheduler thread on first use. A forked worker process does not inherit the parent's thread, so a new one is started there.
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            self.run_once()
+            self._wakeup.wait(self.interval)
+
+    # Takes the lease for the current interval if it is free or expired. The lease expires slightly before the interval ends,
+    # so that the process holding it can take it again at its next run.
+    def _acquire_lease(self):
+        now = datetime.utcnow()
+        try:
+            self.mongo.db.meta.find_one_and_update(
+                {'_id': LEASE_ID, 'expires_at': {'$lt': now}},
+                {'$set': {'owner': f"{socket.gethostname()}:{os.getpid()}", 'expires_at': now + timedelta(seconds=self.interval * 0.9)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+        except PyMongoError as e:
+            self.logger.warning(f"Could not acquire the maintenance lease: {e}")
+            return False
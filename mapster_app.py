@@ -1,55 +1,244 @@
 # Main script for the Flask web application.
+# The application is built by 'create_app()', which the production server (see gunicorn.conf.py), 'flask --app mapster_app'
+# and the benchmarks call. Building it does not touch the database: the MongoDB client is created on first use (see database.py),
+# the Google OAuth client on the first Google login (see auth_routes.py), and the indexes are created once by 'bootstrap()'.
 
-from flask import Flask
-from flask_pymongo import PyMongo
+import threading
+from flask import Flask, request
 from flask_login import LoginManager
-from user_model import User
-from flask import send_from_directory
+from werkzeug.middleware.proxy_fix import ProxyFix
+from database import LazyMongo
+from user_model import User, get_user_data
+from indexes import ensure_indexes
+from events import ChangeHub, ChangeRelay
+from view_counter import ViewCounter
+from cache import TTLCache
+from page_cache import PageCache
+from itinerary_cache import ItineraryCache
+from image_store import ImageStore
+from thumbnails import ThumbnailGenerator
+from maintenance import MaintenanceScheduler, default_tasks
+from metrics import Metrics
+from passwords import PasswordHasher
+from login_throttle import LoginThrottle
+from static_assets import StaticAssets
+from routes import auth_routes, itinerary_routes, api_routes, main_routes, health_routes
+import commands
 import os
 import config # config.py
 
-app = Flask(__name__)
-app.config.from_object(config) # config.py
-
-mongo = PyMongo(app)
-
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# Route for loading user data from the database using Flask-Login; returns a User object if found.
-@login_manager.user_loader
-def load_user(username):
-    user_data = mongo.db.users.find_one({'username': username})
-    if user_data:
-        return User(username=username, name=user_data.get('name'))
-    return None
-
-# Modifies response headers to prevent caching if CACHE_ENABLED is not set in app configuration (see config.py).
-@app.after_request
-def after_request(response):
-    if not app.config['CACHE_ENABLED']:
-        response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-    return response
-
-# Route for Service Worker (sw.js) placed at root to ensure maximum scope across the entire site.
-@app.route('/sw.js')
-def sw():
-    return send_from_directory(os.path.join(app.root_path), 'sw.js')
-
-# Importing and initializing route modules containing routes for the web application.
-from routes import auth_routes
-from routes import itinerary_routes
-from routes import api_routes
-from routes import main_routes
-
-auth_routes.init_app(app, mongo)
-itinerary_routes.init_app(app, mongo)
-api_routes.init_app(app, mongo)
-main_routes.init_app(app, mongo)
+_bootstrap_lock = threading.Lock()
+
+
+# Returns the options of the MongoDB client: connection pool size and timeouts (see config.py) and the metrics command listener.
+def mongo_client_options(app):
+    options = {
+        'maxPoolSize': app.config.get('MONGO_MAX_POOL_SIZE', 100),
+        'minPoolSize': app.config.get('MONGO_MIN_POOL_SIZE', 0),
+        'maxIdleTimeMS': app.config.get('MONGO_MAX_IDLE_TIME_MS'),
+        'connectTimeoutMS': app.config.get('MONGO_CONNECT_TIMEOUT_MS', 20000),
+        'serverSelectionTimeoutMS': app.config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+        'socketTimeoutMS': app.config.get('MONGO_SOCKET_TIMEOUT_MS'),
+        'waitQueueTimeoutMS': app.config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS')
+    }
+    if app.config.get('METRICS_ENABLED', True):
+        options['event_listeners'] = [app.extensions['mapster_metrics']]
+    return options
+
+
+# Creates the indexes the routes' queries rely on (see indexes.py), once per application. The production server runs it in its
+# master process before forking the workers, which inherit the result (see gunicorn.conf.py); otherwise it runs before the first request
+# (other than a health check, which must not depend on the database).
+def bootstrap(app):
+    with _bootstrap_lock:
+        if app.extensions.get('mapster_bootstrapped'):
+            return
+        ensure_indexes(app.extensions['mapster_mongo'], app.logger)
+        app.extensions['mapster_bootstrapped'] = True
+
+
+# Stops the background workers of this process, writing the views still buffered in memory, then closes the MongoDB client.
+# Called by the production server when a worker exits (see gunicorn.conf.py).
+def shutdown(app):
+    app.extensions['mapster_maintenance'].stop()
+    app.extensions['mapster_thumbnails'].stop()
+    app.extensions['mapster_passwords'].stop()
+    app.extensions['mapster_views'].stop()
+    app.extensions['mapster_relay'].stop()
+    app.extensions['mapster_mongo'].close()
+
+
+# Builds the application configured from 'config_object' (config.py by default), with 'settings' overriding individual settings.
+# Several applications can be built in the same process, e.g. against different databases.
+def create_app(config_object=config, settings=None):
+    app = Flask(__name__)
+    app.config.from_object(config_object) # config.py
+    app.config.update(settings or {})
+
+    # Behind PROXY_FIX_HOPS trusted reverse proxies, the client's address (used by login throttling), scheme and host are read from
+    # the headers they add (see config.py).
+    proxy_hops = app.config.get('PROXY_FIX_HOPS', 0)
+    if proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops, x_host=proxy_hops)
+
+    # Request timing and MongoDB command monitoring, exposed on '/metrics' (see metrics.py). The command listener has to be
+    # registered when the MongoDB client is created.
+    metrics = Metrics()
+    app.extensions['mapster_metrics'] = metrics
+    if app.config.get('METRICS_ENABLED', True):
+        metrics.init_app(app)
+
+    mongo = LazyMongo(app, **mongo_client_options(app))
+    app.extensions['mapster_mongo'] = mongo
+
+    # Hub through which routes notify connected clients of itinerary changes, and relay of its events to the other processes,
+    # started by the first request each process serves (see events.py).
+    app.extensions['mapster_changes'] = ChangeHub()
+    app.extensions['mapster_relay'] = ChangeRelay(
+        mongo,
+        app.extensions['mapster_changes'],
+        app.logger,
+        collection_size=app.config.get('CHANGE_EVENTS_SIZE', 1024 * 1024)
+    )
+    if app.config.get('CHANGE_RELAY_ENABLED', True):
+        app.extensions['mapster_changes'].relay = app.extensions['mapster_relay']
+
+    # Cache of home feed and search results, emptied on every itinerary change published on the hub (see page_cache.py).
+    # Server-side caching follows the CACHE_ENABLED setting, like the caching headers below.
+    app.extensions['mapster_pages'] = PageCache(
+        maxsize=app.config.get('PAGE_CACHE_SIZE', 256),
+        ttl=app.config.get('PAGE_CACHE_TTL', 60),
+        enabled=app.config['CACHE_ENABLED']
+    )
+    app.extensions['mapster_changes'].add_listener(app.extensions['mapster_pages'].invalidate)
+
+    # Cache of users' public data, shared by the user loader and the author lookups of the routes.
+    app.extensions['mapster_users'] = TTLCache(
+        maxsize=app.config.get('USER_CACHE_SIZE', 1024),
+        ttl=app.config.get('USER_CACHE_TTL', 300)
+    )
+
+    # Cache of the itineraries prepared for the itinerary page, emptied of an itinerary when its change is published on the hub (see itinerary_cache.py).
+    app.extensions['mapster_itineraries'] = ItineraryCache(
+        mongo,
+        app.extensions['mapster_users'],
+        maxsize=app.config.get('ITINERARY_CACHE_SIZE', 1024),
+        ttl=app.config.get('ITINERARY_CACHE_TTL', 60),
+        enabled=app.config['CACHE_ENABLED']
+    )
+    app.extensions['mapster_changes'].add_listener(app.extensions['mapster_itineraries'].invalidate)
+
+    # Cache of the itinerary snapshots loaded by offline clients on their first synchronization, one per user (see snapshot.py).
+    app.extensions['mapster_snapshots'] = TTLCache(
+        maxsize=app.config.get('SNAPSHOT_CACHE_SIZE', 64),
+        ttl=app.config.get('SNAPSHOT_CACHE_TTL', 600)
+    )
+
+    # Buffers itinerary views and writes them to the database in periodic batches (see view_counter.py).
+    app.extensions['mapster_views'] = ViewCounter(
+        mongo,
+        app.logger,
+        flush_interval=app.config.get('VIEW_FLUSH_INTERVAL', 10),
+        flush_threshold=app.config.get('VIEW_FLUSH_THRESHOLD', 500)
+    )
+    app.extensions['mapster_views'].add_listener(app.extensions['mapster_itineraries'].add_views)
+
+    # Content-addressed storage of itinerary map images in GridFS, shared by itineraries with identical images (see image_store.py).
+    app.extensions['mapster_images'] = ImageStore(mongo, chunk_size=app.config.get('IMAGE_CHUNK_SIZE', 255 * 1024))
+
+    # Generates reduced-size variants of uploaded map images in background threads (see thumbnails.py).
+    app.extensions['mapster_thumbnails'] = ThumbnailGenerator(
+        app.extensions['mapster_images'],
+        app.logger,
+        max_workers=app.config.get('THUMBNAIL_WORKERS', 2),
+        quality=app.config.get('THUMBNAIL_QUALITY', 80)
+    )
+
+    # Runs the periodic maintenance tasks in a background thread, started by the first request each process serves (see maintenance.py).
+    app.extensions['mapster_maintenance'] = MaintenanceScheduler(
+        mongo,
+        app.logger,
+        default_tasks(mongo, app.logger, app.config),
+        interval=app.config.get('MAINTENANCE_INTERVAL', 3600)
+    )
+
+    # Hashes and verifies passwords in a bounded pool of worker processes, off the request threads (see passwords.py).
+    app.extensions['mapster_passwords'] = PasswordHasher(
+        rounds=app.config.get('BCRYPT_ROUNDS', 12),
+        max_workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+        max_pending=app.config.get('PASSWORD_HASH_MAX_PENDING', 16),
+        queue_timeout=app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 5)
+    )
+
+    # Limits failed login attempts per username and per client address (see login_throttle.py).
+    app.extensions['mapster_login_throttle'] = LoginThrottle(
+        mongo,
+        app.logger,
+        max_attempts=app.config.get('LOGIN_MAX_ATTEMPTS', 5),
+        max_attempts_per_address=app.config.get('LOGIN_MAX_ATTEMPTS_PER_ADDRESS', 20),
+        window=app.config.get('LOGIN_THROTTLE_WINDOW', 900)
+    )
+
+    @app.before_request
+    def bootstrap_app():
+        if request.blueprint != 'health':
+            bootstrap(app)
+
+    @app.before_request
+    def start_maintenance():
+        if app.config.get('MAINTENANCE_ENABLED', True):
+            app.extensions['mapster_maintenance'].ensure_started()
+
+    @app.before_request
+    def start_change_relay():
+        if app.extensions['mapster_changes'].relay is not None and request.blueprint != 'health':
+            app.extensions['mapster_relay'].ensure_started()
+
+    login_manager = LoginManager()
+    login_manager.init_app(app)
+    login_manager.login_view = 'auth.login'
+
+    # Route for loading user data from the database using Flask-Login; returns a User object if found.
+    # User data is cached (see user_model.py), so authenticated requests do not query the users collection every time.
+    @login_manager.user_loader
+    def load_user(username):
+        user_data = get_user_data(mongo, app.extensions['mapster_users'], username)
+        if user_data:
+            return User(username=username, name=user_data.get('name'))
+        return None
+
+    # Fingerprinted, precompressed static files with immutable caching, and compression of dynamic responses (see static_assets.py).
+    app.extensions['mapster_assets'] = StaticAssets()
+    app.extensions['mapster_assets'].init_app(app)
+
+    # Modifies response headers to prevent caching if CACHE_ENABLED is not set in app configuration (see config.py).
+    # Fingerprinted static files keep their immutable caching, as their content cannot change without their URL changing.
+    @app.after_request
+    def after_request(response):
+        if not app.config['CACHE_ENABLED'] and 'immutable' not in response.headers.get('Cache-Control', ''):
+            response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+            response.headers["Pragma"] = "no-cache"
+            response.headers["Expires"] = "0"
+        return response
+
+    # Route for Service Worker (sw.js) placed at root to ensure maximum scope across the entire site.
+    # The script is served with its precache manifest prepended (see static_assets.py).
+    @app.route('/sw.js')
+    def sw():
+        return app.extensions['mapster_assets'].service_worker(os.path.join(app.root_path, 'sw.js'))
+
+    # Initializing the route modules containing the routes of the web application (each registering its blueprint), and the command line commands (see commands.py).
+    auth_routes.init_app(app, mongo)
+    itinerary_routes.init_app(app, mongo)
+    api_routes.init_app(app, mongo)
+    main_routes.init_app(app, mongo)
+    health_routes.init_app(app, mongo)
+    commands.init_app(app, mongo)
+
+    return app
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app = create_app()
+    bootstrap(app)
+    app.run(host='0.0.0.0', port=5000, debug=True)
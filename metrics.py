@@ -0,0 +1,191 @@
+# Request and database instrumentation, exposed in the Prometheus text format on '/metrics'.
+# Every request is timed by 'before_request'/'teardown_request' hooks, and a pymongo command listener attributes the duration,
+# count and number of returned documents of each MongoDB command to the route that issued it (or to '<background>' for commands issued by
+# background threads, such as the view counter or maintenance). Reply sizes are not measured in bytes: pymongo only passes listeners
+# the decoded reply, and encoding it again to measure it would cost as much as decoding it. Requests slower than SLOW_REQUEST_SECONDS
+# are logged with the commands they ran. Metrics are kept per process: with several worker processes, each exposes its own.
+
+import threading
+import time
+from flask import g, request
+from pymongo import monitoring
+
+
+# Upper bounds, in seconds, of the histogram buckets.
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Maximum length of the command filters reported in the slow-request log.
+MAX_LOGGED_FILTER_LENGTH = 200
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.sum += value
+
+    # Returns the cumulative count of each bucket, as Prometheus expects them.
+    def cumulative_counts(self):
+        cumulative, running = [], 0
+        for count in self.counts:
+            running += count
+            cumulative.append(running)
+        return cumulative
+
+
+# Escapes a label value for the Prometheus text format.
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+
+# Collects the commands run while handling one request, for the slow-request log.
+class RequestTrace:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.commands = []
+
+
+class Metrics(monitoring.CommandListener):
+    def __init__(self, slow_request_seconds=None, logger=None):
+        self.slow_request_seconds = slow_request_seconds
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pending_commands = {}
+        self.requests = {}
+        self.request_durations = {}
+        self.db_durations = {}
+        self.db_commands = {}
+        self.db_failures = {}
+        self.db_reply_documents = {}
+
+    # Registers the request timing hooks, reading SLOW_REQUEST_SECONDS from the app's configuration unless given to the constructor
+    # (0 disables the slow-request log). The listener itself must be passed to the MongoDB client ('event_listeners').
+    def init_app(self, app):
+        self.logger = self.logger or app.logger
+        if self.slow_request_seconds is None:
+            self.slow_request_seconds = app.config.get('SLOW_REQUEST_SECONDS', 1.0)
+
+        @app.before_request
+        def start_request_timer():
+            g.metrics_trace = self._local.trace = RequestTrace(request.endpoint or '<unmatched>')
+
+        @app.after_request
+        def record_status(response):
+            g.metrics_status = response.status_code
+            return response
+
+        # Requests are recorded on teardown, which also runs when a request failed with an unhandled exception (recorded as a 500).
+        @app.teardown_request
+        def record_request(exception):
+            trace = g.pop('metrics_trace', None)
+            self._local.trace = None
+            if trace is not None:
+                self.record_request(trace, request.method, g.pop('metrics_status', 500))
+
+    def record_request(self, trace, method, status_code):
+        duration = time.perf_counter() - trace.start
+        with self._lock:
+            key = (trace.endpoint, method, str(status_code))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_durations.setdefault((trace.endpoint, method), Histogram()).observe(duration)
+
+        if self.slow_request_seconds and duration >= self.slow_request_seconds:
+            commands = '; '.join(
+                f"{name} {collection} {filter_summary} ({command_duration * 1000:.1f} ms)"
+                for name, collection, filter_summary, command_duration in trace.commands
+            )
+            self.logger.warning(
+                f"Slow request: {method} {trace.endpoint} took {duration * 1000:.1f} ms with "
+                f"{len(trace.commands)} database commands: {commands or 'none'}"
+            )
+
+    # Command listener callbacks. They run in the thread that issued the command, so the current request's trace is found in thread-local storage.
+
+    def started(self, event):
+        trace = getattr(self._local, 'trace', None)
+        collection = event.command.get(event.command_name)
+        filter_summary = ''
+        if trace is not None and self.slow_request_seconds:
+            filter_summary = repr(event.command.get('filter', event.command.get('query', '')))[:MAX_LOGGED_FILTER_LENGTH]
+        with self._lock:
+            self._pending_commands[event.request_id] = (trace, collection if isinstance(collection, str) else '', filter_summary)
+
+    # The size of a reply is counted in documents of its cursor batch (see the module comment).
+    def succeeded(self, event):
+        cursor = event.reply.get('cursor')
+        documents = len(cursor.get('firstBatch', cursor.get('nextBatch', ()))) if isinstance(cursor, dict) else 0
+        self._record_command(event, documents, failed=False)
+
+    def failed(self, event):
+        self._record_command(event, 0, failed=True)
+
+    def _record_command(self, event, reply_documents, failed):
+        duration = event.duration_micros / 1e6
+        with self._lock:
+            trace, collection, filter_summary = self._pending_commands.pop(event.request_id, (None, '', ''))
+            endpoint = trace.endpoint if trace is not None else '<background>'
+            key = (endpoint, event.command_name)
+            self.db_durations.setdefault(key, Histogram()).observe(duration)
+            self.db_commands[key] = self.db_commands.get(key, 0) + 1
+            self.db_reply_documents[key] = self.db_reply_documents.get(key, 0) + reply_documents
+            if failed:
+                self.db_failures[key] = self.db_failures.get(key, 0) + 1
+        if trace is not None:
+            trace.commands.append((event.command_name, collection, filter_summary, duration))
+
+    # Renders all metrics in the Prometheus text exposition format.
+    def render(self):
+        lines = []
+        with self._lock:
+            self._render_counter(lines, 'mapster_requests_total', "Requests handled, by route, method and status.",
+                                 ('endpoint', 'method', 'status'), self.requests)
+            self._render_histogram(lines, 'mapster_request_duration_seconds', "Request handling time, by route and method.",
+                                   ('endpoint', 'method'), self.request_durations)
+            self._render_counter(lines, 'mapster_db_commands_total', "MongoDB commands, by issuing route and command.",
+                                 ('endpoint', 'command'), self.db_commands)
+            self._render_counter(lines, 'mapster_db_command_failures_total', "Failed MongoDB commands, by issuing route and command.",
+                                 ('endpoint', 'command'), self.db_failures)
+            self._render_counter(lines, 'mapster_db_reply_documents_total', "Documents returned by MongoDB commands, by issuing route and command "
+                                 "(not bytes: pymongo only exposes decoded replies, which would have to be encoded again to be measured).",
+                                 ('endpoint', 'command'), self.db_reply_documents)
+            self._render_histogram(lines, 'mapster_db_command_duration_seconds', "MongoDB command time, by issuing route and command.",
+                                   ('endpoint', 'command'), self.db_durations)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_counter(lines, name, description, label_names, values):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{name}{_labels(label_names, label_values)} {value}")
+
+    @staticmethod
+    def _render_histogram(lines, name, description, label_names, histograms):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for label_values, histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                bucket_labels = _labels(label_names, label_values, 'le="%s"' % bound)
+                lines.append(f"{name}_bucket{bucket_labels} {count}")
+            bucket_labels = _labels(label_names, label_values, 'le="+Inf"')
+            lines.append(f"{name}_bucket{bucket_labels} {histogram.total}")
+            lines.append(f"{name}_sum{_labels(label_names, label_values)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(label_names, label_values)} {histogram.total}")
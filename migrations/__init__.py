@@ -0,0 +1,99 @@
+# Versioned data migrations, run with 'flask --app mapster_app migrate' (see commands.py).
+# Each migration is a module listed in MIGRATIONS, in the order in which they must run, defining:
+#   ID           unique, ordered identifier (e.g. '0001_dates_to_bson'), under which its state is recorded;
+#   DESCRIPTION  one-line summary;
+#   count(mongo) number of documents still to migrate, for progress reporting;
+#   run(mongo, checkpoint, batch_size)
+#                generator migrating documents in batches, resuming after 'checkpoint' (None on the first run), and yielding
+#                the checkpoint and number of documents processed after each batch.
+# The state of every migration is recorded in the 'migrations' collection: its checkpoint is saved after each batch, so an
+# interrupted run resumes where it stopped, and completed migrations are skipped. Migrations must be idempotent, as a batch
+# interrupted before its checkpoint was saved is processed again. A lease in the 'meta' collection prevents concurrent runs.
+
+import os
+import socket
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from migrations import m0001_dates_to_bson, m0002_sync_seq
+
+
+MIGRATIONS = [
+    m0001_dates_to_bson,
+    m0002_sync_seq,
+]
+
+LOCK_ID = 'migration_lock'
+
+# Seconds after which the lease of a runner that stopped renewing it (e.g. because it was killed) expires.
+LOCK_TIMEOUT = 600
+
+
+class MigrationLocked(Exception):
+    pass
+
+
+# Returns the state of every migration, in order, as (migration, record) pairs; 'record' is None for migrations never started.
+def migration_status(mongo):
+    records = {record['_id']: record for record in mongo.db.migrations.find({'_id': {'$in': [migration.ID for migration in MIGRATIONS]}})}
+    return [(migration, records.get(migration.ID)) for migration in MIGRATIONS]
+
+
+# Runs the migrations not completed yet, in order, and returns the IDs of those completed by this run.
+# 'progress' is called after each batch with the migration, the number of documents it processed so far and its estimated total.
+# Raises MigrationLocked if another runner holds the lease.
+def run_migrations(mongo, logger, batch_size=500, progress=None):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    _acquire_lock(mongo, owner)
+    completed = []
+    try:
+        for migration, record in migration_status(mongo):
+            if record and record.get('completed_at'):
+                continue
+
+            if record is None:
+                mongo.db.migrations.insert_one({
+                    '_id': migration.ID,
+                    'description': migration.DESCRIPTION,
+                    'started_at': datetime.utcnow(),
+                    'checkpoint': None,
+                    'processed': 0
+                })
+                record = {'checkpoint': None, 'processed': 0}
+            else:
+                logger.info(f"Resuming migration {migration.ID} after {record.get('processed', 0)} documents")
+
+            processed = record.get('processed', 0)
+            total = processed + migration.count(mongo)
+            for checkpoint, count in migration.run(mongo, record.get('checkpoint'), batch_size):
+                processed += count
+                mongo.db.migrations.update_one(
+                    {'_id': migration.ID},
+                    {'$set': {'checkpoint': checkpoint, 'processed': processed, 'updated_at': datetime.utcnow()}}
+                )
+                _renew_lock(mongo, owner)
+                if progress:
+                    progress(migration, processed, total)
+
+            mongo.db.migrations.update_one({'_id': migration.ID}, {'$set': {'completed_at': datetime.utcnow()}})
+            logger.info(f"Migration {migration.ID} completed: {processed} documents processed")
+            completed.append(migration.ID)
+    finally:
+        mongo.db.meta.delete_one({'_id': LOCK_ID, 'owner': owner})
+    return completed
+
+
+def _acquire_lock(mongo, owner):
+    now = datetime.utcnow()
+    try:
+        mongo.db.meta.find_one_and_update(
+            {'_id': LOCK_ID, 'expires_at': {'$lt': now}},
+            {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=LOCK_TIMEOUT)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        lock = mongo.db.meta.find_one({'_id': LOCK_ID}) or {}
+        raise MigrationLocked(f"Migrations are already running ({lock.get('owner')}, lease expiring at {lock.get('expires_at')} UTC).")
+
+
+def _renew_lock(mongo, owner):
+    mongo.db.meta.update_one({'_id': LOCK_ID, 'owner': owner}, {'$set': {'expires_at': datetime.utcnow() + timedelta(seconds=LOCK_TIMEOUT)}})
@@ -0,0 +1,53 @@
+# Converts the itinerary dates ('upload_datetime', 'last_modified') stored as "%Y-%m-%d %H:%M:%S" strings by earlier versions
+# into BSON dates, so that they are compared and sorted as dates by the database and no longer parsed on every read (see timestamps.py).
+# Empty strings (left on deleted itineraries) become null. Each field is only replaced if it still holds the string that was read,
+# so dates written meanwhile by the application are never overwritten; strings that cannot be parsed are left as they are.
+
+from pymongo import UpdateOne
+from timestamps import to_datetime
+
+
+ID = '0001_dates_to_bson'
+DESCRIPTION = "Store itinerary dates as BSON dates instead of strings"
+
+FIELDS = ('upload_datetime', 'last_modified')
+
+QUERY = {'$or': [{field: {'$type': 'string'}} for field in FIELDS]}
+
+
+def count(mongo):
+    return mongo.db.itineraries.count_documents(QUERY)
+
+
+# Migrates itineraries in '_id' order, after 'checkpoint' (an itinerary ID), yielding the last ID and size of each batch.
+def run(mongo, checkpoint=None, batch_size=500):
+    query = dict(QUERY)
+    if checkpoint is not None:
+        query['_id'] = {'$gt': checkpoint}
+    projection = {field: 1 for field in FIELDS}
+
+    batch = []
+    for itinerary in mongo.db.itineraries.find(query, projection).sort('_id', 1):
+        batch.append(itinerary)
+        if len(batch) >= batch_size:
+            _convert(mongo, batch)
+            yield batch[-1]['_id'], len(batch)
+            batch = []
+    if batch:
+        _convert(mongo, batch)
+        yield batch[-1]['_id'], len(batch)
+
+
+def _convert(mongo, itineraries):
+    operations = []
+    for itinerary in itineraries:
+        for field in FIELDS:
+            value = itinerary.get(field)
+            if not isinstance(value, str):
+                continue
+            converted = to_datetime(value)
+            if converted is None and value:
+                continue
+            operations.append(UpdateOne({'_id': itinerary['_id'], field: value}, {'$set': {field: converted}}))
+    if operations:
+        mongo.db.itineraries.bulk_write(operations, ordered=False)
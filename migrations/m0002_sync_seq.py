@@ -0,0 +1,26 @@
+# Stamps the itineraries written before sync sequences existed with sync sequence value 0, placing them at the start of the
+# sequence: synchronization only returns itineraries with a sync sequence value (see 'fetch_changes()' in sync.py).
+
+ID = '0002_sync_seq'
+DESCRIPTION = "Stamp itineraries written before sync sequences existed"
+
+QUERY = {'sync_seq': {'$exists': False}}
+
+
+def count(mongo):
+    return mongo.db.itineraries.count_documents(QUERY)
+
+
+# Stamps itineraries in '_id' order, after 'checkpoint' (an itinerary ID), yielding the last ID and size of each batch.
+def run(mongo, checkpoint=None, batch_size=500):
+    query = dict(QUERY)
+    if checkpoint is not None:
+        query['_id'] = {'$gt': checkpoint}
+
+    while True:
+        ids = [itinerary['_id'] for itinerary in mongo.db.itineraries.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+        if not ids:
+            return
+        mongo.db.itineraries.update_many({'_id': {'$in': ids}, 'sync_seq': {'$exists': False}}, {'$set': {'sync_seq': 0}})
+        yield ids[-1], len(ids)
+        query['_id'] = {'$gt': ids[-1]}
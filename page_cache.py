@@ -0,0 +1,51 @@
+# Server-side cache for the home feed and search result pages.
+# Query results are cached for every user, keyed by the query, filters and page, while fully rendered pages are cached
+# only for anonymous visitors, whose pages do not depend on the session. Every itinerary change published on the change
+# hub (see events.py) empties the cache, so cached pages are never older than the last save, update, delete or like;
+# entries also expire after a TTL, which bounds the staleness of counters not published on the hub, such as views.
+
+from datetime import datetime
+from flask import make_response, request
+from cache import TTLCache
+
+
+class PageCache:
+    def __init__(self, maxsize=256, ttl=60, enabled=True):
+        self.enabled = enabled
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.pages = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.last_modified = datetime.utcnow().replace(microsecond=0)
+
+    # Returns the result of 'loader()' for 'key', from the cache when possible. The result must be a tuple whose first
+    # element is a list of itinerary documents; the documents are copied on every call, so that callers can prepare them
+    # for display without altering the cached copies.
+    def get_results(self, key, loader):
+        if not self.enabled:
+            return loader()
+        itineraries, *rest = self.results.get_or_load(key, loader)
+        return ([dict(itinerary) for itinerary in itineraries], *rest)
+
+    # Returns the rendered page for 'key', from the cache when possible.
+    def get_page(self, key, render):
+        if not self.enabled:
+            return render()
+        return self.pages.get_or_load(key, render)
+
+    # Empties the cache. Registered as a listener of the change hub.
+    def invalidate(self, event=None):
+        self.results.clear()
+        self.pages.clear()
+        self.last_modified = datetime.utcnow().replace(microsecond=0)
+
+    def stats(self):
+        return {'results': self.results.stats(), 'pages': self.pages.stats()}
+
+
+# Builds a response for a rendered page with an ETag computed from its content (and optionally a Last-Modified date),
+# answering with 304 Not Modified when the client's copy is still current.
+def conditional_response(html, last_modified=None):
+    response = make_response(html)
+    response.add_etag()
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
@@ -0,0 +1,107 @@
+# Password hashing and verification with bcrypt, run in a pool of worker processes.
+# bcrypt is deliberately slow: running it on request threads would keep a server worker busy on CPU for every signup and login,
+# and a burst of logins would stall every other request. The pool bounds the CPU spent on hashing to its number of processes,
+# and at most 'max_pending' operations may be queued: beyond that, callers wait up to 'queue_timeout' seconds for a free slot,
+# then get a HasherBusy error, so that an overloaded server refuses logins quickly instead of piling them up.
+# The worker processes are started from a fork server (or spawned, where fork servers are not available) rather than forked from
+# the server worker: a fork would copy its threads' locks, and the MongoDB client, in whatever state they were at that moment.
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+
+
+class HasherBusy(Exception):
+    pass
+
+
+# Functions run in the worker processes; they must be module-level so that they can be sent to them.
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds))
+
+
+def _check_password(password, password_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash)
+
+
+# Returns the work factor (cost) of a bcrypt hash, or None if it is not a valid bcrypt hash.
+def hash_rounds(password_hash):
+    try:
+        return int(password_hash.split(b'$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, rounds=12, max_workers=2, max_pending=16, queue_timeout=5):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    # Returns the bcrypt hash of a password, computed with the configured work factor.
+    def hash(self, password):
+        return self._run(_hash_password, password, self.rounds)
+
+    # Returns whether a password matches a bcrypt hash. Hashes that are missing or invalid (e.g. accounts created with
+    # Google OAuth, which have no password) never match, without using the pool.
+    def verify(self, password, password_hash):
+        if not isinstance(password_hash, bytes) or hash_rounds(password_hash) is None:
+            return False
+        return self._run(_check_password, password, password_hash)
+
+    # Returns whether a hash was computed with a different work factor than the configured one, and should be replaced
+    # by a new hash of the password the next time the user logs in.
+    def needs_rehash(self, password_hash):
+        return hash_rounds(password_hash) != self.rounds
+
+    # Stops the worker processes of this process's pool.
+    def stop(self):
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+            self._pid = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    # Runs a function in the pool, waiting for a free slot first. With 'max_workers' set to 0, it runs in the calling thread.
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusy("Too many password operations in progress.")
+        try:
+            if not self.max_workers:
+                return function(*args)
+            executor = self._get_executor()
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            # A worker process died (e.g. killed by the system): the pool is shut down and replaced at the next call.
+            self._discard_executor(executor)
+            raise HasherBusy("The password hashing pool was interrupted.")
+        finally:
+            self._slots.release()
+
+    # Creates the pool on first use. A forked server worker does not inherit its parent's pool, so a new one is created there.
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(start_method))
+                    self._pid = os.getpid()
+        return self._executor
+
+    # Shuts down a broken pool, unless another thread already replaced it, so that the next call creates a new one.
+    def _discard_executor(self, executor):
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._pid = None
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,130 @@
+# Route metrics computed once when an itinerary is saved and stored on its document, so that clients and list pages do not
+# have to recompute them from the raw waypoints: route length, bounding box, centroid and a simplified polyline for previews.
+# Computations are vectorized over all waypoints with NumPy.
+
+import numpy as np
+from pymongo import UpdateOne
+
+
+EARTH_RADIUS = 6371008.8  # Mean Earth radius in meters.
+
+# Document fields written by 'route_fields()'.
+ROUTE_FIELDS = ('route_length', 'route_bbox', 'route_centroid', 'route_polyline')
+
+
+# Converts waypoints into an array of [longitude, latitude] positions in degrees (GeoJSON order).
+def _positions(waypoints):
+    return np.array([[float(waypoint['longitude']), float(waypoint['latitude'])] for waypoint in waypoints], dtype=float)
+
+
+# Returns the length in meters of the path through the given positions, summing the haversine distances between consecutive ones.
+def route_length(positions):
+    if len(positions) < 2:
+        return 0.0
+    lon, lat = np.radians(positions[:, 0]), np.radians(positions[:, 1])
+    dlon, dlat = np.diff(lon), np.diff(lat)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+    return float(np.sum(2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))))
+
+
+# Returns the bounding box of the given positions as [west, south, east, north].
+def bounding_box(positions):
+    west, south = positions.min(axis=0)
+    east, north = positions.max(axis=0)
+    return [float(west), float(south), float(east), float(north)]
+
+
+# Returns the centroid of the given positions as [longitude, latitude]. Positions are averaged as 3D unit vectors,
+# so that routes crossing the antimeridian get a sensible centroid.
+def centroid(positions):
+    lon, lat = np.radians(positions[:, 0]), np.radians(positions[:, 1])
+    x, y, z = (np.mean(np.cos(lat) * np.cos(lon)), np.mean(np.cos(lat) * np.sin(lon)), np.mean(np.sin(lat)))
+    if np.hypot(np.hypot(x, y), z) < 1e-9:
+        return [round(float(np.mean(positions[:, 0])), 6), round(float(np.mean(positions[:, 1])), 6)]
+    return [round(float(np.degrees(np.arctan2(y, x))), 6), round(float(np.degrees(np.arctan2(z, np.hypot(x, y)))), 6)]
+
+
+# Returns the distances in meters of points from the segment between 'start' and 'end' (all in projected coordinates).
+def _segment_distances(points, start, end):
+    segment = end - start
+    length_squared = float(segment @ segment)
+    if length_squared == 0:
+        return np.linalg.norm(points - start, axis=1)
+    t = np.clip(((points - start) @ segment) / length_squared, 0, 1)
+    return np.linalg.norm(points - (start + t[:, None] * segment), axis=1)
+
+
+# Simplifies a path with the Douglas-Peucker algorithm, keeping only the positions that deviate from the simplified path by
+# more than 'tolerance' meters. Positions are projected onto a local equirectangular plane, which is accurate at route scale.
+def simplify(positions, tolerance=10):
+    if len(positions) < 3:
+        return positions
+
+    lat0 = np.radians(np.mean(positions[:, 1]))
+    projected = np.radians(positions) * EARTH_RADIUS * np.array([np.cos(lat0), 1.0])
+
+    keep = np.zeros(len(positions), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(positions) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(projected[first + 1:last], projected[first], projected[last])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            farthest += first + 1
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return positions[keep]
+
+
+# Encodes positions in the encoded polyline format (as used by Google Maps and supported by most mapping libraries),
+# a compact string of latitude/longitude deltas rounded to 'precision' decimal digits.
+def encode_polyline(positions, precision=5):
+    rounded = np.round(positions[:, ::-1] * 10 ** precision).astype(np.int64)
+    deltas = np.diff(rounded, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+    chars = []
+    for value in deltas.ravel().tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+# Computes the route fields stored on an itinerary document from its waypoints, or returns None if it has no waypoints.
+def route_fields(waypoints, tolerance=10):
+    if not waypoints:
+        return None
+    positions = _positions(waypoints)
+    return {
+        'route_length': round(route_length(positions), 1),
+        'route_bbox': bounding_box(positions),
+        'route_centroid': centroid(positions),
+        'route_polyline': encode_polyline(simplify(positions, tolerance))
+    }
+
+
+# Computes the route fields of itineraries saved before they existed. Returns the number of updated itineraries.
+def backfill_route_fields(mongo, tolerance=10, batch_size=500):
+    updated = 0
+    operations = []
+    query = {'deleted': 0, 'route_length': {'$exists': False}, 'waypoints.0': {'$exists': True}}
+    for itinerary in mongo.db.itineraries.find(query, {'waypoints': 1}):
+        try:
+            fields = route_fields(itinerary['waypoints'], tolerance)
+        except (KeyError, TypeError, ValueError):
+            continue
+        operations.append(UpdateOne({'_id': itinerary['_id']}, {'$set': fields}))
+
+        if len(operations) >= batch_size:
+            updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    if operations:
+        updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+    return updated
@@ -1,67 +1,343 @@
 # Script for API route handling in Flask application.
 
-from flask import request, jsonify
+from flask import Blueprint, request, jsonify, Response
 from flask_login import login_required, current_user
-from datetime import datetime
-from bson import ObjectId
-from base64 import b64encode
-import pytz
+from bson import ObjectId, decode as bson_decode
+from bson.errors import InvalidId, InvalidBSON
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import json
+import queue
+import threading
+import time
+from feed import fetch_feed_page, prepare_card, card_to_json, mark_liked
+from sync import fetch_changes, sync_write
+from snapshot import get_snapshot, stream_snapshot
+from events import publish_itinerary_change
+from trending import get_trending
+from likes import toggle_like as toggle_itinerary_like
+from thumbnails import VARIANTS as THUMBNAIL_VARIANTS
+from geo import find_in_viewport, find_nearby, marker_to_json
+from itinerary_model import parse_itinerary, new_itinerary, itinerary_update, DUPLICATE_NAME_ERROR
+from timestamps import utc_now
 
 def init_app(app, mongo):
-    # API route for synchronizing itineraries. This route is used by the client, specifically the service worker, to synchronize personal itineraries stored locally. 
-    # It retrieves and sends back itineraries that have been updated since the last sync time provided by the client, ensuring the local data is up-to-date.
-    @app.route('/api/sync-itineraries', methods=['GET'])
+    blueprint = Blueprint('api', __name__)
+    change_hub = app.extensions['mapster_changes']
+    # Change streams hold a worker thread for as long as they are open, so only CHANGE_STREAM_MAX_CONNECTIONS of them are served at once
+    # by each process, leaving the other threads to the other requests (see config.py).
+    change_stream_slots = threading.BoundedSemaphore(app.config.get('CHANGE_STREAM_MAX_CONNECTIONS', 4))
+
+    # API route for synchronizing itineraries. This route is used by the client, specifically the service worker, to synchronize personal itineraries stored locally.
+    # It returns the changes made since the position described by the 'since' sync token (everything when omitted), in batches bounded by
+    # SYNC_BATCH_SIZE and SYNC_BATCH_MAX_BYTES (see config.py). The client stores the returned 'sync_token' and repeats the call while 'has_more' is true.
+    # The optional 'image_size' parameter makes image URLs point to a reduced-size variant of the images (see thumbnails.py).
+    @blueprint.route('/api/sync-itineraries', methods=['GET'])
     @login_required
     def sync_itineraries():
         try:
-            last_sync_time_str = request.args.get('lastSyncTime')
-            if last_sync_time_str:
-                last_sync_time = datetime.fromisoformat(last_sync_time_str)
-                if last_sync_time.tzinfo is None:
-                    last_sync_time = last_sync_time.replace(tzinfo=pytz.utc)
-                last_sync_time = last_sync_time.astimezone(pytz.utc)
+            token = request.args.get('since') or None
+            image_size = request.args.get('image_size') or None
+            if image_size is not None and image_size not in THUMBNAIL_VARIANTS:
+                raise ValueError(f"Invalid image size: {image_size}")
+            app.logger.info(f"Client '{current_user.id}' requesting itinerary sync since token: {token}")
+
+            changes = fetch_changes(
+                mongo,
+                current_user.id,
+                token,
+                batch_size=app.config.get('SYNC_BATCH_SIZE', 100),
+                max_bytes=app.config.get('SYNC_BATCH_MAX_BYTES', 1024 * 1024),
+                image_size=image_size
+            )
+
+            app.logger.info(f"Number of itineraries to sync for client '{current_user.id}': {len(changes['items'])} updated, {len(changes['deleted'])} deleted")
+            return jsonify(changes)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            app.logger.error(f"Error during itinerary synchronization for client '{current_user.id}': {e}")
+            return jsonify({"error": str(e)}), 500
+        
+    # API route streaming a snapshot of all the current user's itineraries as NDJSON (see snapshot.py), gzip-compressed if the client accepts it.
+    # Used by the service worker instead of '/api/sync-itineraries' when it has no sync token. An interrupted download is resumed by passing
+    # the 'snapshot' ID from the first line and the number of itineraries already received as 'offset'; if the user's itineraries changed
+    # since, the snapshot no longer exists and 410 is returned, with the ID of the current one.
+    @blueprint.route('/api/sync-snapshot', methods=['GET'])
+    @login_required
+    def sync_snapshot():
+        try:
+            image_size = request.args.get('image_size') or None
+            if image_size is not None and image_size not in THUMBNAIL_VARIANTS:
+                raise ValueError(f"Invalid image size: {image_size}")
+            offset = request.args.get('offset', 0, type=int)
+            snapshot = get_snapshot(mongo, app.extensions['mapster_snapshots'], current_user.id, image_size)
+            if offset < 0 or offset > len(snapshot.lines):
+                raise ValueError(f"Invalid offset: {offset}")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            app.logger.error(f"Error building the itinerary snapshot for client '{current_user.id}': {e}")
+            return jsonify({"error": str(e)}), 500
+
+        requested = request.args.get('snapshot')
+        if requested and requested != snapshot.snapshot_id:
+            return jsonify({"error": "The snapshot changed, download it again.", "snapshot_id": snapshot.snapshot_id}), 410
+
+        app.logger.info(f"Streaming snapshot {snapshot.snapshot_id} of {len(snapshot.lines)} itineraries to client '{current_user.id}' from offset {offset}")
+        compress = request.accept_encodings['gzip'] > 0
+        response = Response(
+            stream_snapshot(
+                snapshot,
+                offset,
+                compress=compress,
+                flush_records=app.config.get('SNAPSHOT_FLUSH_RECORDS', 100),
+                compress_level=app.config.get('COMPRESS_LEVEL', 6)
+            ),
+            mimetype='application/x-ndjson'
+        )
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    # API route streaming change notifications to the current user's clients as Server-Sent Events. Each 'change' event tells the client
+    # that one of its itineraries changed and that it should synchronize; comment lines are sent as heartbeats to keep the connection open.
+    # The stream is closed after CHANGE_STREAM_MAX_SECONDS (see config.py) and the client reconnects, so worker threads are released periodically.
+    # When the process already serves CHANGE_STREAM_MAX_CONNECTIONS streams, the request is refused with a 503 status and a Retry-After
+    # header: the client keeps synchronizing periodically until a later attempt connects.
+    @blueprint.route('/api/changes', methods=['GET'])
+    @login_required
+    def change_stream():
+        if not change_stream_slots.acquire(blocking=False):
+            response = jsonify({"error": "Too many change streams, try again later."})
+            response.headers['Retry-After'] = str(app.config.get('CHANGE_STREAM_RETRY_AFTER', 60))
+            return response, 503
+
+        user_id = current_user.id
+        heartbeat = app.config.get('CHANGE_STREAM_HEARTBEAT', 25)
+        max_seconds = app.config.get('CHANGE_STREAM_MAX_SECONDS', 120)
+        subscriber = change_hub.subscribe(user_id)
+
+        def generate():
+            yield "retry: 5000\n\n"
+            deadline = time.monotonic() + max_seconds
+            while time.monotonic() < deadline:
+                try:
+                    event = subscriber.get(timeout=heartbeat)
+                    yield f"event: change\ndata: {json.dumps(event)}\n\n"
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+
+        # The subscription and the slot are released when the server closes the response, which it does even if the stream was never read.
+        def close_stream():
+            change_hub.unsubscribe(user_id, subscriber)
+            change_stream_slots.release()
+
+        response = Response(generate(), mimetype='text/event-stream')
+        response.call_on_close(close_stream)
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # API route for the paginated home feed. Returns the page of recent itineraries following 'cursor' and the cursor of the next page,
+    # which is null once the end of the feed is reached. Used by the home page to load further itineraries as the user scrolls.
+    @blueprint.route('/api/itineraries', methods=['GET'])
+    @login_required
+    def feed_page():
+        try:
+            cursor = request.args.get('cursor')
+            itineraries, next_cursor = app.extensions['mapster_pages'].get_results(
+                ('feed', cursor),
+                lambda: fetch_feed_page(mongo, cursor, app.config.get('FEED_PAGE_SIZE', 20))
+            )
+            mark_liked(mongo, itineraries, current_user.id)
+            return jsonify({
+                'itineraries': [card_to_json(prepare_card(itinerary)) for itinerary in itineraries],
+                'next_cursor': next_cursor
+            })
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    # API route returning the itineraries whose route intersects a map viewport, given as 'bbox=west,south,east,north' in degrees.
+    # Only the fields needed to draw markers are returned, and at most GEO_RESULTS_LIMIT itineraries (see config.py).
+    @blueprint.route('/api/itineraries/viewport', methods=['GET'])
+    @login_required
+    def viewport_itineraries():
+        try:
+            bbox = request.args.get('bbox', '').split(',')
+            if len(bbox) != 4:
+                raise ValueError("The 'bbox' parameter must be 'west,south,east,north'.")
+            itineraries = find_in_viewport(mongo, *bbox, limit=app.config.get('GEO_RESULTS_LIMIT', 200))
+            return jsonify({'itineraries': [marker_to_json(itinerary) for itinerary in itineraries]})
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    # API route returning the itineraries whose route passes within 'radius' meters (at most GEO_NEARBY_MAX_DISTANCE) of the point
+    # given by 'lat' and 'lng', closest first, with the same fields as the viewport route.
+    @blueprint.route('/api/itineraries/nearby', methods=['GET'])
+    @login_required
+    def nearby_itineraries():
+        try:
+            max_distance = app.config.get('GEO_NEARBY_MAX_DISTANCE', 50000)
+            radius = min(float(request.args.get('radius', max_distance)), max_distance)
+            itineraries = find_nearby(
+                mongo,
+                request.args.get('lat'),
+                request.args.get('lng'),
+                max_distance=radius,
+                limit=app.config.get('GEO_RESULTS_LIMIT', 200)
+            )
+            return jsonify({'itineraries': [marker_to_json(itinerary) for itinerary in itineraries]})
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    # API route returning the trending leaderboard, served from its precomputed document (see trending.py).
+    @blueprint.route('/api/trending', methods=['GET'])
+    @login_required
+    def trending_itineraries():
+        try:
+            leaderboard = get_trending(mongo, max_age_seconds=app.config.get('TRENDING_REFRESH_SECONDS', 300), size=app.config.get('TRENDING_SIZE', 20))
+            mark_liked(mongo, leaderboard, current_user.id)
+            return jsonify({'itineraries': [card_to_json(prepare_card(itinerary)) for itinerary in leaderboard]})
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    # Returns whether the request may read the monitoring routes: if METRICS_TOKEN is set, it must be sent as a bearer token.
+    def monitoring_authorized():
+        token = app.config.get('METRICS_TOKEN')
+        return not token or request.headers.get('Authorization') == f"Bearer {token}"
+
+    # API route exposing the hit and miss counters of the in-process caches, for monitoring. Protected like '/metrics'.
+    @blueprint.route('/api/cache-stats', methods=['GET'])
+    def cache_stats():
+        if not monitoring_authorized():
+            return Response("Unauthorized\n", status=401, mimetype='text/plain')
+        return jsonify({'users': app.extensions['mapster_users'].stats(), 'pages': app.extensions['mapster_pages'].stats()})
+
+    # Route exposing the request and database metrics in the Prometheus text format, for scraping (see metrics.py).
+    # If METRICS_TOKEN is set, the scraper must send it as a bearer token.
+    @blueprint.route('/metrics', methods=['GET'])
+    def metrics():
+        if not monitoring_authorized():
+            return Response("Unauthorized\n", status=401, mimetype='text/plain')
+        return Response(app.extensions['mapster_metrics'].render(), mimetype='text/plain; version=0.0.4')
+
+    # API route creating and updating several of the current user's itineraries in a single request, e.g. edits queued by an offline client.
+    # The body is a JSON object (or, with the 'application/bson' content type, its more compact BSON encoding) whose 'itineraries' list
+    # holds objects with 'name', 'description' and 'waypoints' fields, plus '_id' for itineraries to update. All writes are sent to the
+    # database in one unordered 'bulk_write', so an invalid or rejected itinerary does not prevent the others from being written.
+    # Returns one result per itinerary, in request order, with its status ('created', 'updated' or 'error') and ID or error message.
+    # Images are not accepted here; they are uploaded through the form routes.
+    @blueprint.route('/api/itineraries/bulk', methods=['POST'])
+    @login_required
+    def bulk_write_itineraries():
+        try:
+            if request.mimetype == 'application/bson':
+                data = bson_decode(request.get_data())
             else:
-                last_sync_time = datetime.min.replace(tzinfo=pytz.utc)
+                data = request.get_json(silent=True)
+            items = data.get('itineraries') if isinstance(data, dict) else None
+            if not isinstance(items, list):
+                raise ValueError("The request body must contain an 'itineraries' list.")
+            max_items = app.config.get('BULK_MAX_ITINERARIES', 100)
+            if len(items) > max_items:
+                raise ValueError(f"At most {max_items} itineraries can be written per request.")
+        except (ValueError, InvalidBSON) as e:
+            return jsonify({"error": str(e)}), 400
+
+        try:
+            user_id = current_user.id
+            results = [None] * len(items)
+
+            # Itineraries are validated first, so that only valid ones take a sync sequence value and a database operation.
+            parsed = []
+            for index, item in enumerate(items):
+                try:
+                    itinerary_oid = ObjectId(item['_id']) if isinstance(item, dict) and item.get('_id') else None
+                    parsed.append((index, itinerary_oid, parse_itinerary(item)))
+                except (ValueError, InvalidId, TypeError) as e:
+                    results[index] = {'status': 'error', 'error': str(e)}
 
-            app.logger.info(f"Client '{current_user.id}' requesting itinerary sync since: {last_sync_time_str}")
+            # Updates are restricted to the user's own non-deleted itineraries, found with a single query.
+            update_ids = [itinerary_oid for _, itinerary_oid, _ in parsed if itinerary_oid]
+            owned_ids = set()
+            if update_ids:
+                owned_ids = {itinerary['_id'] for itinerary in mongo.db.itineraries.find({'_id': {'$in': update_ids}, 'user_id': user_id, 'deleted': 0}, {'_id': 1})}
 
-            all_itineraries = mongo.db.itineraries.find({'user_id': current_user.id})
+            # Each itinerary is built with its sync sequence value once the values are reserved, right before the bulk write.
+            to_write = []
+            timestamp = utc_now()
+            tolerance = app.config.get('ROUTE_SIMPLIFY_TOLERANCE', 10)
+            for index, itinerary_oid, (name, description, waypoints) in parsed:
+                if itinerary_oid and itinerary_oid not in owned_ids:
+                    results[index] = {'status': 'error', 'error': "Itinerary not found or permission denied."}
+                    continue
+                to_write.append((index, itinerary_oid, name, description, waypoints))
 
-            itineraries_list = []
-            for itinerary in all_itineraries:
-                itinerary_last_modified_str = itinerary['last_modified']
-                itinerary_last_modified = datetime.fromisoformat(itinerary_last_modified_str).replace(tzinfo=pytz.utc)
+            # Duplicate names are rejected by the unique 'user_name' index and reported as write errors, by operation index.
+            operations, written = [], []
+            write_errors = {}
+            if to_write:
+                with sync_write(mongo, len(to_write)) as sync_seq:
+                    for index, itinerary_oid, name, description, waypoints in to_write:
+                        if itinerary_oid:
+                            fields, unset_fields = itinerary_update(name, description, waypoints, sync_seq, timestamp, tolerance)
+                            update = {'$set': fields}
+                            if unset_fields:
+                                update['$unset'] = unset_fields
+                            operations.append(UpdateOne({'_id': itinerary_oid, 'user_id': user_id, 'deleted': 0}, update))
+                            written.append((index, itinerary_oid, name, 'updated'))
+                        else:
+                            itinerary = new_itinerary(user_id, name, description, waypoints, sync_seq, timestamp, tolerance)
+                            itinerary['_id'] = ObjectId()
+                            operations.append(InsertOne(itinerary))
+                            written.append((index, itinerary['_id'], name, 'created'))
+                        sync_seq += 1
+                    try:
+                        mongo.db.itineraries.bulk_write(operations, ordered=False)
+                    except BulkWriteError as e:
+                        write_errors = {error['index']: error for error in e.details.get('writeErrors', [])}
 
-                if itinerary_last_modified > last_sync_time:
-                    itinerary['_id'] = str(itinerary['_id'])
-                    if itinerary.get('image'):
-                        itinerary['image'] = b64encode(itinerary['image']).decode('utf-8')
-                    itineraries_list.append(itinerary)
+            for operation_index, (index, itinerary_oid, name, status) in enumerate(written):
+                error = write_errors.get(operation_index)
+                if error is None:
+                    results[index] = {'status': status, '_id': str(itinerary_oid)}
+                    publish_itinerary_change(change_hub, user_id, itinerary_oid, status)
+                elif error.get('code') == 11000:
+                    results[index] = {'status': 'error', 'error': DUPLICATE_NAME_ERROR.format(name)}
+                else:
+                    results[index] = {'status': 'error', 'error': error.get('errmsg', 'Write error.')}
 
-            app.logger.info(f"Number of itineraries to sync for client '{current_user.id}': {len(itineraries_list)}")
-            return jsonify(itineraries_list)
+            return jsonify({'results': results})
         except Exception as e:
-            app.logger.error(f"Error during itinerary synchronization for client '{current_user.id}': {e}")
+            app.logger.error(f"Error in bulk itinerary write for client '{current_user.id}': {e}")
             return jsonify({"error": str(e)}), 500
-        
+
     # API route for toggling likes on itineraries. This route is used by the client to like or unlike a specific itinerary.
-    @app.route('/api/toggle-like/<string:itinerary_id>', methods=['POST'])
+    # Returns the new like state and the updated number of likes (see likes.py).
+    @blueprint.route('/api/toggle-like/<string:itinerary_id>', methods=['POST'])
     @login_required
     def toggle_like(itinerary_id):
         user_id = current_user.id
 
         try:
-            itinerary = mongo.db.itineraries.find_one({'_id': ObjectId(itinerary_id)})
+            result = toggle_itinerary_like(mongo, ObjectId(itinerary_id), user_id)
+            if result is None:
+                return jsonify({'success': False, 'error': "Itinerary not found."}), 404
 
-            if user_id in itinerary.get('likes', []):
-                mongo.db.itineraries.update_one({'_id': ObjectId(itinerary_id)}, {'$pull': {'likes': user_id}})
-                liked = False
-            else:
-                mongo.db.itineraries.update_one({'_id': ObjectId(itinerary_id)}, {'$addToSet': {'likes': user_id}})
-                liked = True
-
-            likes_count = len(itinerary.get('likes', []))
+            liked, owner_id, likes_count = result
+            publish_itinerary_change(change_hub, owner_id, itinerary_id, 'liked')
             return jsonify({'success': True, 'liked': liked, 'likesCount': likes_count})
         
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)})
+
+    app.register_blueprint(blueprint)
@@ -1,34 +1,69 @@
 # This script defines routes for user authentication including signup, login, logout, and Google OAuth in the Flask web application.
 # It handles user registration, authentication, session management, and integrates with Google for OAuth logins.
 
-from flask import request, redirect, url_for, flash, render_template, jsonify, session
+from flask import Blueprint, request, redirect, url_for, flash, render_template, jsonify, session
 from flask_login import login_user, logout_user, login_required, current_user
-from flask_oauthlib.client import OAuth
+import threading
 from user_model import User
-import bcrypt
+from passwords import HasherBusy
 
 
 def init_app(app, mongo):
-    # Initializes OAuth for the app with Google as the remote service. Configures OAuth parameters including the consumer key and secret,
-    # request token parameters, and various URLs required for the OAuth flow with Google.
-    oauth = OAuth(app)
-    google = oauth.remote_app(
-        'google',
-        consumer_key=app.config['GOOGLE_CONSUMER_KEY'], # see config.py
-        consumer_secret=app.config['GOOGLE_CONSUMER_SECRET'], # see config.py
-        request_token_params={'scope': 'email profile', 'prompt': 'consent'}, 
-        base_url='https://www.googleapis.com/oauth2/v1/',
-        request_token_url=None,
-        access_token_method='POST',
-        access_token_url='https://accounts.google.com/o/oauth2/token',
-        authorize_url='https://accounts.google.com/o/oauth2/auth',
-    )
+    blueprint = Blueprint('auth', __name__)
+    user_cache = app.extensions['mapster_users']
+    password_hasher = app.extensions['mapster_passwords']
+    login_throttle = app.extensions['mapster_login_throttle']
+
+    google_lock = threading.Lock()
+
+    # Returns the OAuth client for Google, initializing OAuth for the app on first use (Google logins are rare, so processes that never
+    # see one do not pay for it). Configures OAuth parameters including the consumer key and secret, request token parameters,
+    # and various URLs required for the OAuth flow with Google.
+    def google_client():
+        with google_lock:
+            google = app.extensions.get('mapster_google')
+            if google is None:
+                from flask_oauthlib.client import OAuth
+
+                oauth = OAuth(app)
+                google = oauth.remote_app(
+                    'google',
+                    consumer_key=app.config['GOOGLE_CONSUMER_KEY'], # see config.py
+                    consumer_secret=app.config['GOOGLE_CONSUMER_SECRET'], # see config.py
+                    request_token_params={'scope': 'email profile', 'prompt': 'consent'},
+                    base_url='https://www.googleapis.com/oauth2/v1/',
+                    request_token_url=None,
+                    access_token_method='POST',
+                    access_token_url='https://accounts.google.com/o/oauth2/token',
+                    authorize_url='https://accounts.google.com/o/oauth2/auth',
+                )
+                google.tokengetter(get_google_oauth_token)
+                app.extensions['mapster_google'] = google
+            return google
+
+    # Function to retrieve the Google OAuth token from the session.
+    def get_google_oauth_token():
+        return session.get('google_token')
     
+    # Renders a form page with an error telling the user that the server is too busy hashing passwords, and a 503 status.
+    def busy_response(template):
+        flash('The server is busy, please try again in a moment.', 'warning')
+        return render_template(template), 503, {'Retry-After': '5'}
+
+    # Replaces a password hash computed with an outdated work factor (see BCRYPT_ROUNDS in config.py) with a new one.
+    # The hash is only replaced if it has not changed meanwhile; if the server is busy, it is replaced at a later login.
+    def rehash_password(username, password, password_hash):
+        try:
+            new_hash = password_hasher.hash(password)
+        except HasherBusy:
+            return
+        mongo.db.users.update_one({'username': username, 'password': password_hash}, {'$set': {'password': new_hash}})
+
     # Route for user registration. Handles new user sign up process and stores user data in the database.
-    @app.route('/signup', methods=['GET', 'POST'])
+    @blueprint.route('/signup', methods=['GET', 'POST'])
     def signup():
         if current_user.is_authenticated:
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         if request.method == 'POST':
             username = request.form['username']
@@ -37,46 +72,68 @@ def init_app(app, mongo):
 
             existing_user = mongo.db.users.find_one({'username': username})
             if existing_user is None:
-                hashed_pass = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+                try:
+                    hashed_pass = password_hasher.hash(password)
+                except HasherBusy:
+                    return busy_response('signup.html')
                 mongo.db.users.insert_one({'username': username, 'name': name, 'password': hashed_pass})
+                user_cache.invalidate(username)
                 flash('Registration successful! You can now log in with your new account.', 'success')
-                return redirect(url_for('login'))
+                return redirect(url_for('auth.login'))
             else:
                 flash('Username already exists.', 'info')
         return render_template('signup.html')
 
     # Route for user login. Authenticates users and manages user sessions.
-    @app.route('/login', methods=['GET', 'POST'])
+    # Usernames tried from the same client address, and client addresses, with too many recent failed attempts are refused before
+    # their password is checked (see login_throttle.py), and passwords hashed with an outdated work factor are rehashed on successful login.
+    @blueprint.route('/login', methods=['GET', 'POST'])
     def login():
         if current_user.is_authenticated:
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         if request.method == 'POST':
             username = request.form['username']
             password = request.form['password']
-            user = mongo.db.users.find_one({'username': username})
-            if user and bcrypt.checkpw(password.encode('utf-8'), user['password']):
+            address = request.remote_addr
+            retry_after = login_throttle.retry_after(username, address)
+            if retry_after:
+                flash(f'Too many failed login attempts. Please try again in {(retry_after + 59) // 60} minute(s).', 'danger')
+                return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
+
+            user = mongo.db.users.find_one({'username': username}, {'password': 1})
+            try:
+                password_ok = user is not None and password_hasher.verify(password, user.get('password'))
+            except HasherBusy:
+                return busy_response('login.html')
+            if password_ok:
+                login_throttle.clear(username, address)
+                if password_hasher.needs_rehash(user['password']):
+                    rehash_password(username, password, user['password'])
                 login_user(User(username))
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
             else:
+                login_throttle.record_failure(username, address)
                 flash('Incorrect username or password.', 'danger')
         return render_template('login.html')
 
     # Route for logging out. Ends the user's session and redirects to the main page.
-    @app.route('/logout')
+    @blueprint.route('/logout')
     @login_required
     def logout():
         logout_user()
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     # Route to initiate Google OAuth login process.
-    @app.route('/login/google')
+    @blueprint.route('/login/google')
     def google_login():
-        return google.authorize(callback=url_for('authorized', _external=True))
+        return google_client().authorize(callback=url_for('auth.authorized', _external=True))
 
     # Callback route for Google OAuth. Handles the response from Google and manages user authentication.
-    @app.route('/login/google/authorized')
+    # Users created here have no password: they can only log in with Google.
+    @blueprint.route('/login/google/authorized')
     def authorized():
+        google = google_client()
         resp = google.authorized_response()
         if resp is None or resp.get('access_token') is None:
             return 'Access denied: reason={0} error={1}'.format(
@@ -89,20 +146,15 @@ def init_app(app, mongo):
         user_name = me.data.get('name', '')
         existing_user = mongo.db.users.find_one({'username': user_id})
         if not existing_user:
-            random_password = bcrypt.gensalt().decode('utf-8')
-            hashed_pass = bcrypt.hashpw(random_password.encode('utf-8'), bcrypt.gensalt())
-            mongo.db.users.insert_one({'username': user_id, 'name': user_name, 'password': hashed_pass})
+            mongo.db.users.insert_one({'username': user_id, 'name': user_name})
+            user_cache.invalidate(user_id)
         login_user(User(user_id))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     # Route to check the user's login status. Returns JSON response indicating if the user is authenticated.
-    @app.route('/check-login-status')
+    @blueprint.route('/check-login-status')
     def check_login_status():
         is_logged_in = current_user.is_authenticated
         return jsonify({"isLoggedIn": is_logged_in})
 
-    # Function to retrieve the Google OAuth token from the session.
-    @google.tokengetter
-    def get_google_oauth_token():
-        return session.get('google_token')
-
+    app.register_blueprint(blueprint)
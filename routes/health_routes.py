@@ -0,0 +1,33 @@
+# Script for the health check routes polled by load balancers and process supervisors.
+
+from flask import Blueprint, jsonify
+import pymongo
+from pymongo.errors import PyMongoError
+
+def init_app(app, mongo):
+    blueprint = Blueprint('health', __name__)
+
+    # Liveness route: answers as long as the worker process can serve requests, without touching the database,
+    # so that a database outage does not get healthy workers restarted.
+    @blueprint.route('/healthz', methods=['GET'])
+    def healthz():
+        response = jsonify({'status': 'ok'})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    # Readiness route: answers 200 only if MongoDB can be reached, so that the load balancer stops sending traffic to a worker
+    # that could not serve it. The ping, including the selection of a server, waits at most HEALTH_CHECK_TIMEOUT seconds (see config.py).
+    @blueprint.route('/readyz', methods=['GET'])
+    def readyz():
+        try:
+            with pymongo.timeout(app.config.get('HEALTH_CHECK_TIMEOUT', 2)):
+                mongo.cx.admin.command('ping')
+            response = jsonify({'status': 'ready'})
+        except PyMongoError as e:
+            app.logger.warning(f"Readiness check failed: {e}")
+            response = jsonify({'status': 'unavailable'})
+            response.status_code = 503
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    app.register_blueprint(blueprint)
@@ -1,23 +1,49 @@
 # This script defines routes for managing itineraries in the Flask web application, including viewing, creating, editing, and deleting itineraries.
 # It includes user-specific logic, data handling, and rendering of corresponding templates.
 
-from flask import request, render_template, redirect, url_for, flash, jsonify
+from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify, abort, make_response, Response
 from flask_login import login_required, current_user
-from bson import ObjectId, json_util
-import json
-from base64 import b64encode
+from werkzeug.wsgi import wrap_file
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+import hashlib
 import time
-from datetime import datetime
-from bson.binary import Binary
 import traceback
+from sync import sync_write
+from events import publish_itinerary_change
+from likes import liked_itinerary_ids, delete_itinerary_likes
+from thumbnails import VARIANTS as THUMBNAIL_VARIANTS
+from geo import parse_waypoints
+from route_metrics import ROUTE_FIELDS
+from itinerary_model import new_itinerary, itinerary_update, DUPLICATE_NAME_ERROR
+from timestamps import utc_now, to_datetime
+from bson_json import to_json_safe
 
 
 request_block = {}
 request_results = {}
 
 def init_app(app, mongo):
+    blueprint = Blueprint('itineraries', __name__)
+    change_hub = app.extensions['mapster_changes']
+    view_counter = app.extensions['mapster_views']
+    itinerary_cache = app.extensions['mapster_itineraries']
+    image_store = app.extensions['mapster_images']
+    thumbnail_generator = app.extensions['mapster_thumbnails']
+
+    # Releases the reference taken to a newly stored image when the write of the itinerary that was to use it failed, unless the
+    # itinerary references it anyway (a failure such as a network error may be reported after the write was applied). If this cannot
+    # be checked, the reference is kept: an unreleased image only wastes storage, while a wrongly released one would be deleted in use.
+    def release_unused_image(itinerary_oid, image_hash):
+        try:
+            if not mongo.db.itineraries.find_one({'_id': itinerary_oid, 'image_hash': image_hash}, {'_id': 1}):
+                image_store.release(image_hash)
+        except Exception as e:
+            app.logger.error(f"Could not release image {image_hash} after a failed write of itinerary {itinerary_oid}: {e}")
+
     # Route for displaying itineraries created by the current logged-in user. Retrieves user-specific itineraries from the database.
-    @app.route('/myitineraries')
+    @blueprint.route('/myitineraries')
     @login_required
     def myitineraries():
         user_id = current_user.id
@@ -27,25 +53,24 @@ def init_app(app, mongo):
                 'description': 1, 
                 'detailed_description': 1,
                 'num_views': 1, 
-                'likes': 1,
+                'likes_count': 1,
                 'upload_datetime': 1,
-                'image': 1,
+                'image_hash': 1,
                 'image_format': 1
             }))
             for itinerary in itineraries:
                 itinerary['views'] = itinerary.pop('num_views')
-                itinerary['likes'] = len(itinerary.get('likes', []))
-                itinerary['date_created'] = itinerary['upload_datetime'].split(" ")[0]
-                if 'image' in itinerary and itinerary['image']:
-                    itinerary['image_b64'] = b64encode(itinerary['image']).decode('utf-8')
+                itinerary['likes'] = itinerary.pop('likes_count', 0)
+                upload_datetime = to_datetime(itinerary.get('upload_datetime'))
+                itinerary['date_created'] = upload_datetime.strftime('%Y-%m-%d') if upload_datetime else ''
         except Exception as e:
             flash(f"Errore di connessione al database: {e}", "danger")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         return render_template('myitineraries.html', itineraries=itineraries)
     
     # Route to display the form for creating a new itinerary. Provides an empty template for itinerary creation.
-    @app.route('/create-itinerary')
+    @blueprint.route('/create-itinerary')
     @login_required
     def create_itinerary():
         empty_itinerary = {
@@ -57,40 +82,30 @@ def init_app(app, mongo):
 
         return render_template('create_itinerary.html', edit_mode=False, itinerary=empty_itinerary)
 
-    @app.route('/save-itinerary', methods=['POST'])
+    @blueprint.route('/save-itinerary', methods=['POST'])
     @login_required
     def save_itinerary():
         itinerary_name = request.form.get('itinerary_name')
         itinerary_description = request.form.get('itinerary_description')  
         user_id = current_user.id
 
-        waypoints = []
-        waypoint_count = int(request.form.get('waypoint_count', 0))
-
-        for i in range(waypoint_count):
-            waypoint = {
-                'name': request.form.get(f'waypoints[{i}][name]'),
-                'latitude': request.form.get(f'waypoints[{i}][latitude]'),
-                'longitude': request.form.get(f'waypoints[{i}][longitude]')
-            }
-            waypoints.append(waypoint)
-
-        utc_datetime = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-
-        itinerary = {
-            'user_id': user_id,
-            'name': itinerary_name,
-            'description': itinerary_description,
-            'waypoints': waypoints,
-            'upload_datetime': utc_datetime,  
-            'last_modified': utc_datetime,    
-            'num_views': 0,
-            'likes': [],
-            'deleted' : 0
-        }
+        try:
+            waypoints = parse_waypoints(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        itinerary = new_itinerary(
+            user_id,
+            itinerary_name,
+            itinerary_description,
+            waypoints,
+            None,
+            tolerance=app.config.get('ROUTE_SIMPLIFY_TOLERANCE', 10)
+        )
 
         """ Handles processing and storage of the itinerary's map image, supporting both JPG and the more efficient WEBP format to minimize storage impact. 
-            The image is heavily compressed client-side before being sent via POST. """
+            The image is heavily compressed client-side before being sent via POST. It is streamed into the content-addressed image store
+            (see image_store.py), and the itinerary only keeps its hash and format. """
 
         map_image = request.files.get('map_image')
         if map_image:
@@ -99,47 +114,46 @@ def init_app(app, mongo):
             if map_image.content_type == 'image/webp':
                 image_format = 'webp'
 
-        
-            image_binary = Binary(map_image.read())
-
-        
-            itinerary['image'] = image_binary
+            itinerary['image_hash'] = image_store.store(map_image.stream, image_format)
             itinerary['image_format'] = image_format
+            thumbnail_generator.schedule(itinerary['image_hash'], image_format)
 
-    
-        existing_itinerary = mongo.db.itineraries.find_one({
-            'user_id': user_id,
-            'name': itinerary_name
-        })
-
-        if existing_itinerary:
-            error_message = f"An itinerary named '{itinerary_name}' already exists in your profile."
-            return jsonify({"error": error_message}), 400
-
-    
-        mongo.db.itineraries.insert_one(itinerary)
+        # A duplicate name is rejected by the unique 'user_name' index, so no query is needed to check for it beforehand.
+        try:
+            with sync_write(mongo) as sync_seq:
+                itinerary['sync_seq'] = sync_seq
+                result = mongo.db.itineraries.insert_one(itinerary)
+        except DuplicateKeyError:
+            image_store.release(itinerary.get('image_hash'))
+            return jsonify({"error": DUPLICATE_NAME_ERROR.format(itinerary_name)}), 400
+        except Exception:
+            if itinerary.get('image_hash'):
+                release_unused_image(itinerary.get('_id'), itinerary['image_hash'])
+            raise
+
+        publish_itinerary_change(change_hub, user_id, result.inserted_id, 'created')
         return jsonify({"message": "Itinerary saved successfully!"})
 
 
     # Route for editing an existing itinerary. Retrieves the itinerary data for the given ID and displays it for editing.
-    @app.route('/edit-itinerary/<itinerary_id>')
+    @blueprint.route('/edit-itinerary/<itinerary_id>')
     @login_required
     def edit_itinerary(itinerary_id):
         try:
-            itinerary = mongo.db.itineraries.find_one({'_id': ObjectId(itinerary_id), 'user_id': current_user.id})
+            itinerary = mongo.db.itineraries.find_one({'_id': ObjectId(itinerary_id), 'user_id': current_user.id}, {'image': 0, 'likes': 0})
             if not itinerary:
                 flash("Itinerary not found or you do not have permission to edit this itinerary.", "danger")
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
 
-            itinerary_json = json.loads(json_util.dumps(itinerary))
+            itinerary_json = to_json_safe(itinerary)
         except Exception as e:
             flash(f"Error retrieving itinerary for editing: {e}", "danger")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         return render_template('create_itinerary.html', edit_mode=True, itinerary=itinerary_json)
     
     # Route for updating an existing itinerary. Processes the POST request and updates the itinerary data in the database.
-    @app.route('/update-itinerary/<itinerary_id>', methods=['POST'])
+    @blueprint.route('/update-itinerary/<itinerary_id>', methods=['POST'])
     @login_required
     def update_itinerary(itinerary_id):
         try:
@@ -147,54 +161,69 @@ def init_app(app, mongo):
             itinerary_description = request.form.get('itinerary_description')
             user_id = current_user.id
 
-            
-            existing_itinerary = mongo.db.itineraries.find_one({
-                '_id': {'$ne': ObjectId(itinerary_id)},
-                'user_id': user_id,
-                'name': itinerary_name
-            })
-
-            if existing_itinerary:
-                error_message = f"An itinerary named '{itinerary_name}' already exists in your profile."
-                return jsonify({"error": error_message}), 400
-
-            waypoints = []
-            waypoint_count = int(request.form.get('waypoint_count', 0))
-            for i in range(waypoint_count):
-                waypoint = {
-                    'name': request.form.get(f'waypoints[{i}][name]'),
-                    'latitude': request.form.get(f'waypoints[{i}][latitude]'),
-                    'longitude': request.form.get(f'waypoints[{i}][longitude]')
-                }
-                waypoints.append(waypoint)
-
-            update_fields = {
-                'name': itinerary_name,
-                'description': itinerary_description,
-                'waypoints': waypoints,
-                'last_modified': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            }
+            try:
+                waypoints = parse_waypoints(request.form)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+            update_fields, unset_fields = itinerary_update(
+                itinerary_name,
+                itinerary_description,
+                waypoints,
+                None,
+                tolerance=app.config.get('ROUTE_SIMPLIFY_TOLERANCE', 10)
+            )
 
-            
             map_image = request.files.get('map_image')
             if map_image:
                 image_format = 'jpg' if map_image.content_type != 'image/webp' else 'webp'
-                image_binary = Binary(map_image.read())
-                update_fields['image'] = image_binary
                 update_fields['image_format'] = image_format
+                update_fields['image_hash'] = image_store.store(map_image.stream, image_format)
+                thumbnail_generator.schedule(update_fields['image_hash'], image_format)
+                # Drops the image embedded by earlier versions, if the itinerary still has one.
+                unset_fields['image'] = ''
 
-            
-            mongo.db.itineraries.update_one(
-                {'_id': ObjectId(itinerary_id), 'user_id': user_id},
-                {'$set': update_fields}
-            )
+            update = {'$set': update_fields}
+            if unset_fields:
+                update['$unset'] = unset_fields
 
+            """ The previous version of the document is returned so that the reference to the replaced image can be released.
+                If no itinerary was updated, the reference just taken to the new image is released instead.
+                A name already used by another of the user's itineraries is rejected by the unique 'user_name' index. """
+
+            try:
+                with sync_write(mongo) as sync_seq:
+                    update_fields['sync_seq'] = sync_seq
+                    previous = mongo.db.itineraries.find_one_and_update(
+                        {'_id': ObjectId(itinerary_id), 'user_id': user_id},
+                        update,
+                        projection={'image_hash': 1}
+                    )
+            except DuplicateKeyError:
+                previous = None
+                error_message = DUPLICATE_NAME_ERROR.format(itinerary_name)
+            except Exception:
+                if map_image:
+                    release_unused_image(ObjectId(itinerary_id), update_fields['image_hash'])
+                raise
+            else:
+                error_message = None
+
+            if previous:
+                if map_image:
+                    image_store.release(previous.get('image_hash'))
+                publish_itinerary_change(change_hub, user_id, itinerary_id, 'updated')
+            elif map_image:
+                image_store.release(update_fields['image_hash'])
+
+            if error_message:
+                return jsonify({"error": error_message}), 400
             return jsonify({"message": "Itinerary updated successfully!"}), 200
         except Exception as e:
             return jsonify({"error": f"Error updating itinerary: {e}"}), 500
 
     # Route for deleting an itinerary. Marks the itinerary as deleted in the database based on the provided ID.
-    @app.route('/delete-itinerary', methods=['POST'])
+    @blueprint.route('/delete-itinerary', methods=['POST'])
     @login_required
     def delete_itinerary():
         try:
@@ -206,30 +235,43 @@ def init_app(app, mongo):
                 app.logger.info(f"Attempting to mark itinerary with ID: {itinerary_id} as deleted")
 
                 user_id = current_user.id
-                existing_itinerary = mongo.db.itineraries.find_one({'_id': ObjectId(itinerary_id), 'user_id': user_id})
+                existing_itinerary = mongo.db.itineraries.find_one({'_id': ObjectId(itinerary_id), 'user_id': user_id}, {'image_hash': 1})
 
                 if existing_itinerary:
                     """ The itinerary document is not deleted but instead updated with blank fields using 'update_one()' to maintain a record of its deletion. 
-                        This approach updates the 'last_modified' timestamp, allowing the service worker to detect the deletion and synchronize local data accordingly. 
-                        While minimal data is retained, most fields, including the 'image' field which is data-heavy, are cleared to minimize storage impact. """
-
-                    mongo.db.itineraries.update_one(
-                        {'_id': ObjectId(itinerary_id), 'user_id': user_id},
-                        {
-                            '$set': {
-                                'name': '',
-                                'description': '',
-                                'waypoints': '',
-                                'upload_datetime': '',  
-                                'last_modified': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                                'num_views': 0,
-                                'likes': [],
-                                'deleted': 1,
-                                'image': '',
-                                'image_format': ''
+                        This approach advances the 'sync_seq' stamp, allowing the service worker to detect the deletion and synchronize local data accordingly.
+                        The record (tombstone) is purged by the maintenance tasks after TOMBSTONE_RETENTION_DAYS (see maintenance.py). 
+                        While minimal data is retained, most fields are cleared to minimize storage impact, and the itinerary's reference to its image
+                        is released, so that the image is deleted from the image store once no other itinerary uses it. """
+
+                    # The filter on 'deleted' makes a repeated deletion a no-op, so the image reference is only released once.
+                    now = utc_now()
+                    with sync_write(mongo) as sync_seq:
+                        result = mongo.db.itineraries.update_one(
+                            {'_id': ObjectId(itinerary_id), 'user_id': user_id, 'deleted': 0},
+                            {
+                                '$set': {
+                                    'name': '',
+                                    'description': '',
+                                    'waypoints': '',
+                                    'upload_datetime': None,
+                                    'last_modified': now,
+                                    'deleted_at': now,
+                                    'num_views': 0,
+                                    'likes_count': 0,
+                                    'deleted': 1,
+                                    'image_format': '',
+                                    'image_hash': '',
+                                    'search_terms': [],
+                                    'sync_seq': sync_seq
+                                },
+                                '$unset': {field: '' for field in ('image', 'geometry') + ROUTE_FIELDS}
                             }
-                        }
-                    )
+                        )
+                    if result.modified_count:
+                        image_store.release(existing_itinerary.get('image_hash'))
+                    delete_itinerary_likes(mongo, ObjectId(itinerary_id))
+                    publish_itinerary_change(change_hub, user_id, itinerary_id, 'deleted')
                     app.logger.info(f"Successfully marked itinerary with ID: {itinerary_id} as deleted")
                     return jsonify(success=True)
                 else:
@@ -243,62 +285,99 @@ def init_app(app, mongo):
             traceback.print_exc()
             return jsonify(success=False, error=str(e))
     
+    # Route for serving the map image of an itinerary. Streams the image from the image store with a content-hash ETag, so list pages can
+    # reference the image by URL instead of inlining it as base64, and browsers and the service worker can cache it.
+    # The optional 'size' parameter ('small' or 'medium', see thumbnails.py) requests a reduced-size variant of the image.
+    @blueprint.route('/itinerary/<itinerary_id>/image')
+    @login_required
+    def itinerary_image(itinerary_id):
+        try:
+            itinerary_oid = ObjectId(itinerary_id)
+        except InvalidId:
+            abort(404)
+
+        size = request.args.get('size')
+        if size is not None and size not in THUMBNAIL_VARIANTS:
+            abort(404)
+
+        """ The hash is read first so that a revalidation from a client that already holds the current image is answered with a 304
+            without reading the image itself. Itineraries whose image is still embedded in the document (saved by earlier versions and
+            not yet migrated with 'flask migrate-images') are served from the document, falling back to hashing the stored bytes.
+            A variant that has not been generated yet is replaced by the original image, served without long-term caching so that
+            the client asks again later. """
+
+        itinerary = mongo.db.itineraries.find_one({'_id': itinerary_oid}, {'image_hash': 1, 'image_format': 1})
+        if not itinerary or not itinerary.get('image_format'):
+            abort(404)
+
+        image_hash = itinerary.get('image_hash')
+        served_hash = image_hash
+        variant_ready = True
+        if size and image_hash:
+            variant_hash = image_store.variant(image_hash, size)
+            variant_ready = variant_hash is not None
+            served_hash = variant_hash or image_hash
+
+        if served_hash and served_hash in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            mimetype = 'image/webp' if itinerary['image_format'] == 'webp' else 'image/jpeg'
+            image_file = image_store.open(served_hash) if served_hash else None
+            if image_file:
+                # The GridFS file is read in blocks of IMAGE_CHUNK_SIZE bytes (iterating it would split it at newline bytes),
+                # through the server's file wrapper if it has one, and closed by the response once sent.
+                response = Response(wrap_file(request.environ, image_file, app.config.get('IMAGE_CHUNK_SIZE', 255 * 1024)), mimetype=mimetype, direct_passthrough=True)
+                response.content_length = image_file.length
+            else:
+                image_doc = mongo.db.itineraries.find_one({'_id': itinerary_oid}, {'image': 1})
+                image_data = bytes(image_doc.get('image') or b'') if image_doc else b''
+                if not image_data:
+                    abort(404)
+                image_hash = served_hash = image_hash or hashlib.sha256(image_data).hexdigest()
+                response = make_response(image_data)
+                response.mimetype = mimetype
+
+        response.set_etag(served_hash)
+
+        # URLs carrying the current hash ('v' parameter) never change content, so they can be cached indefinitely.
+        if request.args.get('v') == image_hash and variant_ready:
+            response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+
     # Route for viewing a specific itinerary. Retrieves and displays detailed information of the itinerary based on the given ID.
-    @app.route('/view-itinerary/<itinerary_id>')
+    # The itinerary is prepared for display once and shared by all viewers until it changes (see itinerary_cache.py).
+    @blueprint.route('/view-itinerary/<itinerary_id>')
     @login_required
     def view_itinerary(itinerary_id):
         try:
-            itinerary = mongo.db.itineraries.find_one({'_id': ObjectId(itinerary_id)})
+            itinerary = itinerary_cache.get(ObjectId(itinerary_id))
             if not itinerary:
                 flash("Itinerary not found.", "danger")
-                return redirect(url_for('index'))
-        
-            
-            itinerary_name = itinerary.get('name')
-            
-            author_username = itinerary.get('user_id')
-            author_data = mongo.db.users.find_one({'username': author_username})
-            author = author_data.get('name') if author_data else "Anonymous"
-    
-            try:
-                if isinstance(itinerary.get('upload_datetime'), datetime):
-                    creation_date = itinerary['upload_datetime'].strftime('%m/%d/%Y')
-                elif isinstance(itinerary.get('upload_datetime'), str):
-                    
-                    creation_date = datetime.strptime(itinerary['upload_datetime'], '%Y-%m-%d %H:%M:%S').strftime('%m/%d/%Y')
-                else:
-                    creation_date = "Unknown"  
-            except Exception as e:
-                flash(f"Error formatting the creation date: {e}", "warning")
-                creation_date = "Unknown"  
-            likes = itinerary.get('likes', [])
-            num_likes = len(likes)
-            description = itinerary.get('description', '')
+                return redirect(url_for('main.index'))
 
-            
             is_author = False
             has_liked = False
 
             
             user_id = str(current_user.id) if current_user.is_authenticated else None
 
-            if user_id and 'user_id' in itinerary:
-                is_author = user_id == str(itinerary['user_id'])
-                has_liked = user_id in likes
+            if user_id and itinerary.owner_id is not None:
+                is_author = user_id == str(itinerary.owner_id)
+                has_liked = itinerary.id in liked_itinerary_ids(mongo, current_user.id, [itinerary.id])
 
             
+            # The view is buffered and written later in a batch (see view_counter.py); the displayed count includes buffered views.
             if not is_author:
-                new_views = itinerary.get('num_views', 0) + 1
-                mongo.db.itineraries.update_one(
-                    {'_id': ObjectId(itinerary_id)}, 
-                    {'$set': {'num_views': new_views}}
-                )
-                itinerary['num_views'] = new_views  
+                view_counter.increment(itinerary.id)
+            num_views = itinerary.num_views + view_counter.pending(itinerary.id)
 
-            
-            itinerary_json = json.loads(json_util.dumps(itinerary))
+            itinerary_json = itinerary.template_data(num_views)
         except Exception as e:
             flash(f"Error retrieving itinerary: {e}", "danger")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
+
+        return render_template('view_itinerary.html', itinerary=itinerary_json, itinerary_name=itinerary.name, author=itinerary.author, creation_date=itinerary.creation_date, num_likes=itinerary.num_likes, description=itinerary.description, user_id=user_id, is_author=is_author, has_liked=has_liked, num_views=num_views)
 
-        return render_template('view_itinerary.html', itinerary=itinerary_json, itinerary_name=itinerary_name, author=author, creation_date=creation_date, num_likes=num_likes, description=description, user_id=user_id, is_author=is_author, has_liked=has_liked, num_views=itinerary.get('num_views', 0))
+    app.register_blueprint(blueprint)
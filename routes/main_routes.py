@@ -1,83 +1,109 @@
 # This script defines routes for the main page, search functionality, and search results in the Flask web application.
 # It handles the retrieval and processing of itinerary data from the MongoDB database and renders the corresponding templates.
 
-from flask import render_template, request, jsonify
+from flask import Blueprint, render_template, request, jsonify
+from flask_login import current_user
 import json
-from base64 import b64encode
-from datetime import datetime
-import pytz
-import humanize
+from feed import fetch_feed_page, prepare_card, mark_liked, CARD_PROJECTION
+from search import build_search_query, rank, matches
+from trending import get_trending
+from page_cache import conditional_response
 
 
 def init_app(app, mongo):
-    # Route for the main page. Retrieves itineraries from the database and processes them for display.
-    @app.route('/')
+    blueprint = Blueprint('main', __name__)
+    page_cache = app.extensions['mapster_pages']
+
+    # Route for the main page. Retrieves the first page of recent itineraries (or the page after 'cursor') and processes them for display.
+    # Query results are cached for all users and the rendered page for anonymous visitors (see page_cache.py). The page only lists
+    # itineraries to logged-in users, so none are read for anonymous visitors, who all get the same page whatever the cursor.
+    @blueprint.route('/')
     def index():
         is_search = False
         search_query = ''
+        cursor = request.args.get('cursor')
 
-        try:
-            
-            itineraries = list(mongo.db.itineraries.find({'deleted': 0}).sort('upload_datetime', -1))
+        def render():
+            if not current_user.is_authenticated:
+                return render_template('index.html', itineraries=[], is_search=is_search, search_query=search_query, next_cursor=None)
+            itineraries, next_cursor = page_cache.get_results(
+                ('feed', cursor),
+                lambda: fetch_feed_page(mongo, cursor, app.config.get('FEED_PAGE_SIZE', 20))
+            )
+            mark_liked(mongo, itineraries, current_user.id)
             for itinerary in itineraries:
-                itinerary['views'] = itinerary.pop('num_views')
-                itinerary['likes'] = len(itinerary.get('likes', []))
-                if 'image' in itinerary and itinerary['image']:
-                    itinerary['image_b64'] = b64encode(itinerary['image']).decode('utf-8')
-            
-                
-                if isinstance(itinerary['upload_datetime'], str):
-                    itinerary['upload_datetime'] = datetime.strptime(itinerary['upload_datetime'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=pytz.utc)
-            
-                
-                itinerary['time_since_upload'] = humanize.naturaltime(datetime.utcnow().replace(tzinfo=pytz.utc) - itinerary['upload_datetime'])
+                prepare_card(itinerary)
+            return render_template('index.html', itineraries=itineraries, is_search=is_search, search_query=search_query, next_cursor=next_cursor)
+
+        try:
+            if current_user.is_authenticated:
+                return conditional_response(render())
+            return conditional_response(page_cache.get_page(('index',), render), page_cache.last_modified)
+        except ValueError:
+            return "Invalid page cursor.", 400
         except Exception as e:
             return f"Database connection error: {e}", 500
 
-        return render_template('index.html', itineraries=itineraries, is_search=is_search, search_query=search_query)
-    
+    # Retrieves one page of search results and whether another page exists.
+    # Text queries are matched through the 'search_terms' index and ranked by relevance (see search.py).
+    def find_search_results(search_query, filters, page):
+        page_size = app.config.get('SEARCH_PAGE_SIZE', 20)
+        skip = (page - 1) * page_size
+
+        text_query = build_search_query(search_query)
+        itineraries_query = text_query or {'deleted': 0}
+
+        # One extra itinerary is requested to find out whether another page exists.
+        if filters.get('trending'):
+            # Trending itineraries come from the precomputed leaderboard, narrowed down to the ones matching the query words.
+            leaderboard = get_trending(mongo, max_age_seconds=app.config.get('TRENDING_REFRESH_SECONDS', 300), size=app.config.get('TRENDING_SIZE', 20))
+            itineraries = [itinerary for itinerary in leaderboard if matches(itinerary, search_query)][skip:skip + page_size + 1]
+        elif filters.get('mostViewed'):
+            itineraries = list(mongo.db.itineraries.find(itineraries_query, CARD_PROJECTION).sort([('num_views', -1), ('_id', -1)]).skip(skip).limit(page_size + 1))
+        elif filters.get('mostLiked'):
+            itineraries = list(mongo.db.itineraries.find(itineraries_query, CARD_PROJECTION).sort([('likes_count', -1), ('_id', -1)]).skip(skip).limit(page_size + 1))
+        elif text_query:
+            candidates = mongo.db.itineraries.find(itineraries_query, CARD_PROJECTION).sort('upload_datetime', -1).limit(app.config.get('SEARCH_CANDIDATE_LIMIT', 500))
+            itineraries = rank(candidates, search_query)[skip:skip + page_size + 1]
+        else:
+            itineraries = list(mongo.db.itineraries.find(itineraries_query, CARD_PROJECTION).sort('upload_datetime', -1).skip(skip).limit(page_size + 1))
+
+        return itineraries[:page_size], len(itineraries) > page_size
+
     # Route for handling search queries. Processes user input, filters, and retrieves matching itineraries from the database.
-    @app.route('/search', methods=['GET'])
+    # Results are paginated with 'page' and cached like the main page's. As on the main page, itineraries are only listed to logged-in
+    # users, so no search is run for anonymous visitors, whose page is rendered without results (and not cached, as it depends on the query).
+    @blueprint.route('/search', methods=['GET'])
     def search():
         is_search = True
         search_query = request.args.get('q', '')
-        filters = request.args.get('filters', '')
+        filters = request.args.get('filters', '') or '{}'
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+        except ValueError:
+            page = 1
 
         try:
             filters = json.loads(filters)
+            cache_key = ('search', search_query, json.dumps(filters, sort_keys=True), page)
 
-            itineraries_query = {
-                '$and': [
-                    {'$or': [
-                        {'name': {'$regex': search_query, '$options': 'i'}},
-                        {'description': {'$regex': search_query, '$options': 'i'}}
-                    ]},
-                    {'deleted': 0}  
-                ]
-            }
-
-            if filters.get('mostViewed'):
-                itineraries = list(mongo.db.itineraries.find(itineraries_query).sort('views', -1))
-            elif filters.get('mostLiked'):
-                itineraries = list(mongo.db.itineraries.find(itineraries_query).sort('likes', -1))
-            else:
-                itineraries = list(mongo.db.itineraries.find(itineraries_query).sort('upload_datetime', -1))
+            def render():
+                if not current_user.is_authenticated:
+                    return render_template('index.html', itineraries=[], search_query=search_query, is_search=is_search, filters=filters, next_page=None)
+                itineraries, has_more = page_cache.get_results(cache_key, lambda: find_search_results(search_query, filters, page))
+                mark_liked(mongo, itineraries, current_user.id)
+                for itinerary in itineraries:
+                    prepare_card(itinerary)
+                next_page = page + 1 if has_more else None
+                return render_template('index.html', itineraries=itineraries, search_query=search_query, is_search=is_search, filters=filters, next_page=next_page)
 
-            for itinerary in itineraries:
-                itinerary['views'] = itinerary.pop('num_views')
-                itinerary['likes'] = len(itinerary.get('likes', []))
-                if 'image' in itinerary and itinerary['image']:
-                    itinerary['image_b64'] = b64encode(itinerary['image']).decode('utf-8')
-            
-                
-                if isinstance(itinerary['upload_datetime'], str):
-                    itinerary['upload_datetime'] = datetime.strptime(itinerary['upload_datetime'], '%Y-%m-%d %H:%M:%S')
+            return conditional_response(render())
         except Exception as e:
             return jsonify({"error": f"Database connection error: {e}"}), 500
-
-        return render_template('index.html', itineraries=itineraries, search_query=search_query, is_search=is_search, filters=filters)
     
     # Route for displaying search results. Renders the search results page template.
-    @app.route('/search_results')
+    @blueprint.route('/search_results')
     def search_results():
-        return render_template('search_results.html')
\ No newline at end of file
+        return render_template('search_results.html')
+
+    app.register_blueprint(blueprint)
@@ -3,6 +3,11 @@
 # Activate the Mapster virtual environment
 source mapster_env/bin/activate
 
+# Start the production server (Gunicorn, configured in gunicorn.conf.py) when run as './run.sh production'
+if [ "$1" = "production" ]; then
+    exec gunicorn -c gunicorn.conf.py 'mapster_app:create_app()'
+fi
+
 # Set the Flask application to run
 export FLASK_APP=mapster_app.py
 
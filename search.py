@@ -0,0 +1,93 @@
+# Full-text search over itinerary names and descriptions.
+# Each itinerary stores in 'search_terms' the accent-folded, lower-case tokens of its name and description together with
+# their prefixes, kept up to date on every save, update and delete. The field has a multikey index, so a query is answered
+# by an index lookup of its tokens instead of a regular expression scan, and partially typed words match as prefixes.
+# Candidates are then ranked by relevance, favouring matches in the name and whole-word matches.
+
+import re
+import unicodedata
+from datetime import datetime
+from pymongo import UpdateOne
+from timestamps import to_datetime
+
+
+MIN_PREFIX_LENGTH = 1
+MAX_TOKEN_LENGTH = 32
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+# Lower-cases the text and removes diacritics, so that e.g. 'Città' and 'citta' are treated as the same word.
+def fold(text):
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+# Splits the text into folded tokens, truncating tokens longer than MAX_TOKEN_LENGTH.
+def tokenize(text):
+    return [token[:MAX_TOKEN_LENGTH] for token in TOKEN_PATTERN.findall(fold(text))]
+
+
+# Returns the value of the 'search_terms' field for an itinerary: every token of the name and description and all their prefixes.
+def build_search_terms(name, description):
+    terms = set()
+    for token in tokenize(name) + tokenize(description):
+        terms.add(token)
+        for length in range(MIN_PREFIX_LENGTH, len(token)):
+            terms.add(token[:length])
+    return sorted(terms)
+
+
+# Returns the MongoDB filter matching itineraries that contain every token of the query (as a word or a word prefix),
+# or None if the query contains no words.
+def build_search_query(search_query):
+    tokens = list(dict.fromkeys(tokenize(search_query)))
+    if not tokens:
+        return None
+    return {'search_terms': {'$all': tokens}, 'deleted': 0}
+
+
+# Scores how well an itinerary matches the query tokens: whole words weigh more than prefixes, and the name more than the description.
+def relevance(itinerary, tokens):
+    name_tokens = tokenize(itinerary.get('name'))
+    description_tokens = tokenize(itinerary.get('description'))
+    score = 0.0
+    for token in tokens:
+        if token in name_tokens:
+            score += 4
+        elif any(word.startswith(token) for word in name_tokens):
+            score += 2
+        if token in description_tokens:
+            score += 1
+        elif any(word.startswith(token) for word in description_tokens):
+            score += 0.5
+    return score
+
+
+# Tells whether every word of the query appears, as a word or a word prefix, in the itinerary's name or description.
+# Used to filter small in-memory lists (e.g. the trending leaderboard) without querying the database.
+def matches(itinerary, search_query):
+    words = tokenize(itinerary.get('name')) + tokenize(itinerary.get('description'))
+    return all(any(word.startswith(token) for word in words) for token in tokenize(search_query))
+
+
+# Orders candidate itineraries by decreasing relevance; among equally relevant ones, the most recent come first.
+def rank(itineraries, search_query):
+    tokens = list(dict.fromkeys(tokenize(search_query)))
+    itineraries = sorted(itineraries, key=lambda itinerary: to_datetime(itinerary.get('upload_datetime')) or datetime.min, reverse=True)
+    return sorted(itineraries, key=lambda itinerary: relevance(itinerary, tokens), reverse=True)
+
+
+# Computes 'search_terms' for itineraries that do not have it yet (created before search indexing existed).
+# Returns the number of updated itineraries.
+def backfill_search_terms(mongo, batch_size=500):
+    updated = 0
+    operations = []
+    for itinerary in mongo.db.itineraries.find({'search_terms': {'$exists': False}}, {'name': 1, 'description': 1, 'deleted': 1}):
+        terms = [] if itinerary.get('deleted') else build_search_terms(itinerary.get('name'), itinerary.get('description'))
+        operations.append(UpdateOne({'_id': itinerary['_id']}, {'$set': {'search_terms': terms}}))
+        if len(operations) >= batch_size:
+            updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += mongo.db.itineraries.bulk_write(operations, ordered=False).modified_count
+    return updated
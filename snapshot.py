@@ -0,0 +1,88 @@
+# Snapshot of a user's itineraries, loaded by offline clients on their first synchronization (or when they must start over)
+# instead of paging through the whole change history (see '/api/sync-snapshot').
+# The snapshot is streamed as NDJSON, one JSON object per line: a header describing it, one line per itinerary (in the format of the
+# synchronization API, see sync.py) and a final line with the sync token from which the client continues with incremental synchronization,
+# and the IDs of all the itineraries of the snapshot (so that the client can remove local itineraries that no longer exist).
+# Snapshots are built once and cached per user: a cached snapshot is used as long as the user's latest change is the one it was built at
+# (and the user's sync horizon has not moved past its sync token).
+# Its ID is derived from that position, so a client whose download was interrupted can resume it, from any server process, by asking
+# for the same snapshot from the number of itineraries it already received; if the user's data changed meanwhile, it must start over.
+
+import hashlib
+import json
+import zlib
+from bson import ObjectId
+from sync import serialize_sync_item, encode_sync_token, get_sync_horizon, committed_sync_seq
+
+
+class Snapshot:
+    def __init__(self, snapshot_id, position, horizon, sync_token, lines, ids):
+        self.snapshot_id = snapshot_id
+        self.position = position
+        self.horizon = horizon
+        self.sync_token = sync_token
+        self.lines = lines
+        self.ids = ids
+
+
+def _json_line(value):
+    return (json.dumps(value, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+# Returns the (sync_seq, _id) position of the user's latest change, or None if the user never had an itinerary. Served by the 'sync_changes' index.
+def latest_position(mongo, user_id):
+    latest = mongo.db.itineraries.find_one({'user_id': user_id}, {'sync_seq': 1}, sort=[('sync_seq', -1), ('_id', -1)])
+    return (latest.get('sync_seq', 0), latest['_id']) if latest else None
+
+
+# Reads the user's itineraries and builds their snapshot at 'position', given the user's current sync 'horizon'.
+# Must run in a request context, as image URLs are built with 'url_for()'. The sync token is the position read before the itineraries: changes made while they are read come after it, so the client receives them
+# again with its next incremental synchronization. A token below the user's sync horizon is moved up to it (see 'fetch_changes()' in sync.py),
+# and a token past writes still in flight is moved down to the last value before them (see 'committed_sync_seq()' in sync.py).
+def build_snapshot(mongo, user_id, position, horizon, image_size=None):
+    committed = committed_sync_seq(mongo)
+    sync_seq, itinerary_id = position or (0, ObjectId('0' * 24))
+    if sync_seq > committed:
+        sync_seq, itinerary_id = committed, ObjectId('f' * 24)
+    if sync_seq < horizon:
+        sync_seq, itinerary_id = horizon, ObjectId('0' * 24)
+
+    lines, ids = [], []
+    itineraries = mongo.db.itineraries.find({'user_id': user_id, 'deleted': 0}, {'image': 0, 'likes': 0}).sort([('sync_seq', 1), ('_id', 1)])
+    for itinerary in itineraries:
+        lines.append(_json_line(serialize_sync_item(itinerary, image_size)))
+        ids.append(str(itinerary['_id']))
+
+    snapshot_id = hashlib.sha256(f"{user_id}|{position}|{horizon}|{image_size}".encode('utf-8')).hexdigest()[:16]
+    return Snapshot(snapshot_id, position, horizon, encode_sync_token(sync_seq, itinerary_id), lines, ids)
+
+
+# Returns the user's current snapshot, from 'cache' (a TTLCache, see cache.py) if the user has not changed anything since it was built.
+def get_snapshot(mongo, cache, user_id, image_size=None):
+    position, horizon = latest_position(mongo, user_id), get_sync_horizon(mongo, user_id)
+    key = (user_id, image_size)
+    snapshot = cache.get(key)
+    if snapshot is None or snapshot.position != position or snapshot.horizon != horizon:
+        snapshot = build_snapshot(mongo, user_id, position, horizon, image_size)
+        cache.set(key, snapshot)
+    return snapshot
+
+
+# Yields the NDJSON lines of a snapshot from the itinerary at 'offset', gzip-compressed if 'compress' is set. The compressed stream is
+# flushed every 'flush_records' itineraries, so that the client can store them while the rest is still being transferred.
+def stream_snapshot(snapshot, offset=0, compress=False, flush_records=100, compress_level=6):
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31) if compress else None
+
+    def chunks():
+        yield _json_line({'type': 'snapshot', 'snapshot_id': snapshot.snapshot_id, 'count': len(snapshot.lines), 'offset': offset})
+        for start in range(offset, len(snapshot.lines), flush_records):
+            yield b''.join(snapshot.lines[start:start + flush_records])
+        yield _json_line({'type': 'end', 'sync_token': snapshot.sync_token, 'ids': snapshot.ids})
+
+    for chunk in chunks():
+        if compressor is None:
+            yield chunk
+        else:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if compressor is not None:
+        yield compressor.flush()
@@ -7,6 +7,7 @@ document.addEventListener("DOMContentLoaded", function () {
     var searchButton = document.getElementById("button-search");
     var mostViewedRadio = document.getElementById("most-viewed-radio");
     var mostLikedRadio = document.getElementById("most-liked-radio");
+    var trendingRadio = document.getElementById("trending-radio");
     
     if (searchButton) {
         var originalSearchButtonColor = window.getComputedStyle(searchButton).backgroundColor;
@@ -27,8 +28,9 @@ document.addEventListener("DOMContentLoaded", function () {
         var searchText = searchInput.value;
         var mostViewedChecked = mostViewedRadio.checked;
         var mostLikedChecked = mostLikedRadio.checked;
+        var trendingChecked = trendingRadio.checked;
 
-        if (!searchText && !mostViewedChecked && !mostLikedChecked) {
+        if (!searchText && !mostViewedChecked && !mostLikedChecked && !trendingChecked) {
             alert("Enter a search term or select at least one sorting option.");
             return;
         }
@@ -36,10 +38,11 @@ document.addEventListener("DOMContentLoaded", function () {
         // Store search criteria in session storage and construct the search URL.
         sessionStorage.setItem("mostViewedChecked", mostViewedChecked);
         sessionStorage.setItem("mostLikedChecked", mostLikedChecked);
+        sessionStorage.setItem("trendingChecked", trendingChecked);
         sessionStorage.setItem("searchText", searchText);
 
         var searchUrl = '/search?q=' + encodeURIComponent(searchText) +
-            '&filters=' + JSON.stringify({ mostViewed: mostViewedChecked, mostLiked: mostLikedChecked });
+            '&filters=' + JSON.stringify({ mostViewed: mostViewedChecked, mostLiked: mostLikedChecked, trending: trendingChecked });
 
         window.location.href = searchUrl;
 
@@ -54,12 +57,16 @@ document.addEventListener("DOMContentLoaded", function () {
     if (urlSearchParams.has('q') || urlSearchParams.has('filters')) {
         var savedMostViewedChecked = sessionStorage.getItem("mostViewedChecked");
         var savedMostLikedChecked = sessionStorage.getItem("mostLikedChecked");
+        var savedTrendingChecked = sessionStorage.getItem("trendingChecked");
         if (savedMostViewedChecked !== null) {
             mostViewedRadio.checked = savedMostViewedChecked === "true";
         }
         if (savedMostLikedChecked !== null) {
             mostLikedRadio.checked = savedMostLikedChecked === "true";
         }
+        if (savedTrendingChecked !== null) {
+            trendingRadio.checked = savedTrendingChecked === "true";
+        }
 
         var savedSearchText = sessionStorage.getItem("searchText");
         if (savedSearchText) {
@@ -71,7 +78,9 @@ document.addEventListener("DOMContentLoaded", function () {
         if (resultTitle) {
             var searchResultText = savedSearchText ? `Search results for "${savedSearchText}"` : 'Recent Itineraries';
 
-            if (!savedSearchText && (savedMostViewedChecked === "true" || savedMostLikedChecked === "true")) {
+            if (!savedSearchText && savedTrendingChecked === "true") {
+                searchResultText = 'Trending itineraries';
+            } else if (!savedSearchText && (savedMostViewedChecked === "true" || savedMostLikedChecked === "true")) {
                 searchResultText = `Search results for ${savedMostViewedChecked === "true" ? 'Most viewed' : 'Most liked'} itineraries`;
             }
 
@@ -80,6 +89,106 @@ document.addEventListener("DOMContentLoaded", function () {
             document.title = `MapMingle - ${searchResultText}`;
         }
     }
-});
 
+    /* Infinite scroll for the home feed. When the 'Load more' link becomes visible (or is clicked), the next page of itineraries
+       is requested from the feed API using the cursor of the last page, and the returned cards are appended to the list. */
+    var loadMore = document.getElementById("load-more");
+    var itineraryList = document.getElementById("itinerary-list");
+    var isLoading = false;
+
+    function createCard(itinerary) {
+        var column = document.createElement("div");
+        column.className = "col-md-6 mb-4";
+
+        var card = document.createElement("div");
+        card.className = "card h-100";
+        card.style.cursor = "pointer";
+        if (itinerary.image_url) {
+            card.style.backgroundImage = 'url("' + itinerary.image_url + '")';
+        }
+        card.addEventListener("click", function () {
+            window.location.href = itinerary.url;
+        });
+
+        var body = document.createElement("div");
+        body.className = "card-body";
+        var header = document.createElement("div");
+        header.className = "d-flex justify-content-between";
+        var title = document.createElement("h5");
+        title.className = "card-title mb-0";
+        title.textContent = itinerary.name;
+        var date = document.createElement("span");
+        date.className = "date-created";
+        date.textContent = itinerary.time_since_upload;
+        header.appendChild(title);
+        header.appendChild(date);
+        var text = document.createElement("p");
+        text.className = "card-text";
+        if (itinerary.description) {
+            text.textContent = itinerary.description;
+        } else {
+            text.innerHTML = "<i>No description provided</i>";
+        }
+        body.appendChild(header);
+        body.appendChild(text);
+
+        var footer = document.createElement("div");
+        footer.className = "card-footer";
+        footer.addEventListener("click", function (event) {
+            event.stopPropagation();
+        });
+        footer.innerHTML = '<div class="itinerary-info">' +
+            '<img src="/static/icons/views-icon.svg" alt="Views" class="icon-medium mr-1"> <span class="views"></span> ' +
+            '<img src="/static/icons/' + (itinerary.has_liked ? 'unlike-icon.svg' : 'likes-icon.svg') + '" alt="Likes" class="icon-medium mr-1"> <span class="likes"></span>' +
+            '</div>';
+        footer.querySelector(".views").textContent = itinerary.views;
+        footer.querySelector(".likes").textContent = itinerary.likes;
+
+        card.appendChild(body);
+        card.appendChild(footer);
+        column.appendChild(card);
+        return column;
+    }
+
+    function loadNextPage() {
+        var cursor = loadMore.getAttribute("data-next-cursor");
+        if (isLoading || !cursor) {
+            return;
+        }
+        isLoading = true;
+
+        fetch('/api/itineraries?cursor=' + encodeURIComponent(cursor))
+            .then(response => response.json())
+            .then(data => {
+                data.itineraries.forEach(function (itinerary) {
+                    itineraryList.appendChild(createCard(itinerary));
+                });
+                if (data.next_cursor) {
+                    loadMore.setAttribute("data-next-cursor", data.next_cursor);
+                    loadMore.href = '/?cursor=' + encodeURIComponent(data.next_cursor);
+                } else {
+                    loadMore.parentNode.removeChild(loadMore);
+                    loadMore.removeAttribute("data-next-cursor");
+                }
+            })
+            .catch(error => console.error('Error loading more itineraries:', error))
+            .finally(() => {
+                isLoading = false;
+            });
+    }
 
+    if (loadMore && itineraryList) {
+        loadMore.addEventListener("click", function (event) {
+            event.preventDefault();
+            loadNextPage();
+        });
+
+        if ('IntersectionObserver' in window) {
+            new IntersectionObserver(function (entries) {
+                if (entries[0].isIntersecting) {
+                    loadNextPage();
+                }
+            }, { rootMargin: '200px' }).observe(loadMore);
+        }
+    }
+});
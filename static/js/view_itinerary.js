@@ -190,14 +190,10 @@ function toggleLike(itineraryId) {
         .then(data => {
             if (data.success) {
 
+                likesCountElement.innerHTML = data.likesCount;
                 if (data.liked) {
-                    console.log("unlike");
-                    likesCountElement.innerHTML = parseInt(likesCountElement.innerHTML) + 1;
                     likeImg.src = "/static/icons/unlike-icon.svg";
-
                 } else {
-                    console.log("like");
-                    likesCountElement.innerHTML = parseInt(likesCountElement.innerHTML) - 1;
                     likeImg.src = "/static/icons/likes-icon.svg";
                 }
             } else {
@@ -0,0 +1,215 @@
+# Fingerprinted and precompressed static assets, and compression of dynamic responses.
+# At startup, every file under static/ is hashed and gets a fingerprinted URL embedding its hash (e.g. '/static/css/base.1a2b3c4d5e6f.css'),
+# which 'url_for('static', ...)' and the 'asset_url()' template function return. Content behind such a URL never changes, so it is served
+# with 'Cache-Control: immutable' and browsers never ask for it again; a changed file simply gets a new URL. Text files are compressed once
+# with gzip (and Brotli, if the 'brotli' package is installed), the first time it is requested or by 'compress_all()' (which the production
+# server runs once, before forking its workers), and served in the best encoding the client accepts. Unfingerprinted URLs,
+# such as those built by scripts or used by the offline pages, keep working and are revalidated with their ETag.
+# The same hash map is the precache manifest of the service worker, which is served with it prepended (see 'service_worker()').
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from flask import Response, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Types of files worth compressing. Images other than SVG are already compressed.
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'image/svg+xml'
+}
+
+# Length of the hash embedded in fingerprinted file names, in hexadecimal digits.
+FINGERPRINT_LENGTH = 12
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+# Returns the fingerprinted version of a file name: 'css/base.css' becomes 'css/base.<hash>.css'.
+def fingerprinted_name(filename, digest):
+    root, extension = os.path.splitext(filename)
+    return f'{root}.{digest[:FINGERPRINT_LENGTH]}{extension}'
+
+
+def _compress(data, encoding, brotli_quality=11, gzip_level=9):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    # A fixed modification time makes the output depend only on the content.
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+class Asset:
+    def __init__(self, filename, digest, mimetype):
+        self.filename = filename
+        self.digest = digest
+        self.mimetype = mimetype
+        self.fingerprinted = fingerprinted_name(filename, digest)
+        self.compressible = False
+        # Compressed contents by encoding, computed on first use (see 'StaticAssets.compressed()').
+        self.encodings = None
+
+
+class StaticAssets:
+    def __init__(self, fingerprint=True, precompress=True, compress_min_size=1024, compress_level=6, brotli_quality=11):
+        self.fingerprint = fingerprint
+        self.precompress = precompress
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self.assets = {}
+        self.fingerprinted = {}
+        self.version = None
+        self.static_folder = None
+        self.static_url_path = None
+        self._lock = threading.Lock()
+
+    # Builds the asset map and registers, on the app: the fingerprinting of 'url_for('static', ...)' URLs, the 'asset_url()' template
+    # function, the static file view serving fingerprinted and precompressed files, and the compression of dynamic responses.
+    # Options not given to the constructor are read from the app's configuration (STATIC_* and COMPRESS_* settings, see config.py).
+    def init_app(self, app):
+        self.fingerprint = app.config.get('STATIC_FINGERPRINT', self.fingerprint)
+        self.precompress = app.config.get('STATIC_PRECOMPRESS', self.precompress)
+        self.compress_min_size = app.config.get('COMPRESS_MIN_SIZE', self.compress_min_size)
+        self.compress_level = app.config.get('COMPRESS_LEVEL', self.compress_level)
+        self.brotli_quality = app.config.get('STATIC_BROTLI_QUALITY', self.brotli_quality)
+        self.static_folder = app.static_folder
+        self.static_url_path = app.static_url_path
+        self.build()
+
+        @app.url_defaults
+        def fingerprint_static_url(endpoint, values):
+            if endpoint == 'static' and self.fingerprint:
+                asset = self.assets.get(values.get('filename'))
+                if asset is not None:
+                    values['filename'] = asset.fingerprinted
+
+        app.jinja_env.globals['asset_url'] = self.url
+        app.view_functions['static'] = self.serve
+        app.after_request(self.compress_response)
+
+    # Hashes every file under the static folder (skipping hidden files). Compression is left for later (see 'compressed()').
+    def build(self):
+        assets = {}
+        for directory, subdirectories, files in os.walk(self.static_folder):
+            subdirectories[:] = sorted(name for name in subdirectories if not name.startswith('.'))
+            for name in sorted(files):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as file:
+                    data = file.read()
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                asset = Asset(filename, hashlib.sha256(data).hexdigest(), mimetype)
+                asset.compressible = self.precompress and mimetype in COMPRESSIBLE_TYPES and len(data) >= self.compress_min_size
+                assets[filename] = asset
+
+        self.assets = assets
+        self.fingerprinted = {asset.fingerprinted: asset for asset in assets.values()}
+        self.version = hashlib.sha256(''.join(f'{name}:{asset.digest}\n' for name, asset in sorted(assets.items())).encode('utf-8')).hexdigest()[:FINGERPRINT_LENGTH]
+
+    # Returns the compressed contents of an asset by encoding (empty if it is not worth compressing), compressing it on first use.
+    def compressed(self, asset):
+        if asset.encodings is not None:
+            return asset.encodings
+        with self._lock:
+            if asset.encodings is None:
+                encodings = {}
+                if asset.compressible:
+                    with open(os.path.join(self.static_folder, asset.filename), 'rb') as file:
+                        data = file.read()
+                    for encoding in self.encodings:
+                        compressed = _compress(data, encoding, brotli_quality=self.brotli_quality)
+                        if len(compressed) < len(data):
+                            encodings[encoding] = compressed
+                asset.encodings = encodings
+        return asset.encodings
+
+    # Compresses every asset not compressed yet, so that processes forked afterwards share the result.
+    def compress_all(self):
+        for asset in self.assets.values():
+            self.compressed(asset)
+
+    # Returns the URL of a static file, fingerprinted if the file exists and fingerprinting is enabled.
+    def url(self, filename):
+        asset = self.assets.get(filename)
+        if asset is not None and self.fingerprint:
+            filename = asset.fingerprinted
+        return f'{self.static_url_path}/{filename}'
+
+    # Returns the precache manifest of the service worker: the URL of every static file, mapped to the URL from which it is cached.
+    def precache_manifest(self):
+        return {f'{self.static_url_path}/{filename}': self.url(filename) for filename in self.assets}
+
+    # Static file view. Files under their fingerprinted name are served with immutable caching; under their plain name, they are revalidated.
+    # Files added after startup are not in the asset map and are served as they are.
+    def serve(self, filename):
+        asset = self.fingerprinted.get(filename)
+        immutable = asset is not None
+        if asset is None:
+            asset = self.assets.get(filename)
+        if asset is None:
+            return send_from_directory(self.static_folder, filename)
+
+        encodings = self.compressed(asset)
+        encoding = request.accept_encodings.best_match(list(encodings)) if encodings else None
+        if encoding:
+            response = Response(encodings[encoding], mimetype=asset.mimetype)
+            response.headers['Content-Encoding'] = encoding
+            response.set_etag(f'{asset.digest[:FINGERPRINT_LENGTH]}-{encoding}')
+            response = response.make_conditional(request)
+        else:
+            response = send_from_directory(self.static_folder, asset.filename, mimetype=asset.mimetype, etag=asset.digest[:FINGERPRINT_LENGTH])
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE if immutable else 'no-cache'
+        return response
+
+    # Returns the service worker script at 'path', preceded by the definitions of its precache manifest and of a version that changes with
+    # any static file. The script therefore changes whenever an asset does, which makes browsers install the new worker and refresh its cache.
+    def service_worker(self, path):
+        with open(path, encoding='utf-8') as file:
+            script = file.read()
+        prelude = (
+            "// Generated by the server (see static_assets.py): version of the static assets and URLs from which they are precached.\n"
+            f"const PRECACHE_VERSION = '{self.version}';\n"
+            f"const PRECACHE_ASSETS = {json.dumps(self.precache_manifest(), indent=2, sort_keys=True)};\n\n"
+        )
+        response = Response(prelude + script, mimetype='application/javascript')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    # Compresses dynamic responses (pages, JSON) of at least 'compress_min_size' bytes with the best encoding the client accepts.
+    # Streamed responses (such as the change stream) and file responses are left alone.
+    def compress_response(self, response):
+        if (response.direct_passthrough or response.is_streamed or response.status_code < 200 or response.status_code in (204, 304)
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        data = response.get_data()
+        if not encoding or len(data) < self.compress_min_size:
+            return response
+
+        # Dynamic responses favour speed over compression ratio.
+        response.set_data(_compress(data, encoding, brotli_quality=min(self.brotli_quality, 4), gzip_level=self.compress_level))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
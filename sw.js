@@ -2,72 +2,34 @@
    This script is responsible for caching static assets, handling offline requests,
    and synchronizing user itineraries with the server when online. */
 
-// Define the cache name and URLs to cache
-const CACHE_NAME = 'mapster-cache';
-const urlsToCache = [
-  '/static/manifest.json',
-  '/static/css/base.css',
-  '/static/css/login.css',
-  '/static/css/signup.css',
-  '/static/css/myitineraries.css',
-  '/static/css/create_itinerary.css',
-  '/static/css/view_itinerary.css',
-  '/static/css/index.css',
-  '/static/css/leaflet-gesture-handling.min.css',
-  '/static/css/leaflet.css',
-  '/static/css/bootstrap.min.css',
-  '/static/css/images/marker-shadow.png',
-  '/static/css/images/markers-shadow.png',
-  '/static/css/images/marker-icon.png',
-  '/static/js/login.js',
-  '/static/js/signup.js',
-  '/static/js/base.js',
-  '/static/js/create_itinerary.js',
-  '/static/js/myitineraries.js',
-  '/static/js/view_itinerary.js',
-  '/static/js/index.js',
-  '/static/js/myitineraries_offline.js',
-  '/static/js/view_itinerary_offline.js',
-  '/static/js/leaflet.js',
-  '/static/js/leaflet-gesture-handling.js',
-  '/static/js/Sortable.min.js',
-  '/static/js/html2canvas.min.js',
-  '/static/js/bootstrap.bundle.min.js',
-  '/static/js/dexie.min.js',
-  '/static/icons/download-icon.svg',
-  '/static/icons/bin-icon.svg',
-  '/static/icons/edit-icon.svg',
-  '/static/icons/likes-icon.svg',
-  '/static/icons/views-icon.svg',
-  '/static/icons/add-icon.svg',
-  '/static/icons/send-icon.svg',
-  '/static/icons/walking-icon.svg',
-  '/static/icons/car-icon.svg',
-  '/static/icons/biking-icon.svg',
-  '/static/icons/user-icon.svg',
-  '/static/icons/unlike-icon.svg',
-  '/static/icons/calendar-icon.svg',
-  '/static/icons/icon-192x192.png',
-  '/static/icons/icon-256x256.png',
-  '/static/icons/icon-384x384.png',
-  '/static/icons/icon-512x512.png',
-  '/static/icons/transp-icon-256x256.png',
-  '/static/icons/navigate-icon.svg',
-  '/static/icons/google-logo.png',
-  '/static/icons/offline-icon.svg',
-  '/static/html/myitineraries_offline.html',
-  '/static/html/offline.html',
-  '/static/html/view_itinerary_offline.html',
-];
+/* Define the cache name and URLs to cache. PRECACHE_VERSION and PRECACHE_ASSETS are prepended to this script by the server
+   (see static_assets.py): PRECACHE_ASSETS maps the URL of every static file to its fingerprinted URL, from which it is cached,
+   and PRECACHE_VERSION changes whenever a static file does, so that a new cache replaces the old one. */
+const CACHE_NAME = 'mapster-cache-' + PRECACHE_VERSION;
+const urlsToCache = Object.values(PRECACHE_ASSETS);
+
+// Function returning the URL under which a static file is cached, for requests using its plain URL (e.g. from the offline pages)
+function cachedUrl(url) {
+  return PRECACHE_ASSETS[url] || url;
+}
+
 // URL for the offline page
 const OFFLINE_URL = '/static/html/offline.html';
 
 // Variable to track user login status
 let isUserLoggedIn = false;
 
-// Timer to periodically sync itineraries
+// Timer to periodically sync itineraries (fallback used while the change stream is not connected)
 let syncTimer = null;
 
+// Controller used to close the change stream, and whether the stream is currently connected
+let changeStreamController = null;
+let changeStreamConnected = false;
+
+// Promise of the synchronization in progress, and whether another one was requested meanwhile
+let syncInProgress = null;
+let syncRequested = false;
+
 // Install event: Caches static assets for offline use
 self.addEventListener('install', (event) => {
   console.log('[Service Worker] Install event');
@@ -77,7 +39,7 @@ self.addEventListener('install', (event) => {
         console.log('[Service Worker] Caching all');
         cache.addAll(urlsToCache);
 
-        return cache.addAll([OFFLINE_URL]);
+        return cache.addAll([cachedUrl(OFFLINE_URL)]);
       })
   );
 });
@@ -109,18 +71,19 @@ self.addEventListener('fetch', (event) => {
     // Se la richiesta è per la pagina dinamica view_itinerary_offline.html, gestiscila in modo specifico
     event.respondWith(
       fetch(event.request).catch(() => {
-        return caches.match('/static/html/view_itinerary_offline.html').then(response => {
-          return response || caches.match(OFFLINE_URL);
+        return caches.match(cachedUrl('/static/html/view_itinerary_offline.html')).then(response => {
+          return response || caches.match(cachedUrl(OFFLINE_URL));
         });
       })
     );
   } else {
-    // Per tutte le altre richieste, prova a recuperare dalla cache se disponibile
+    // Per tutte le altre richieste, prova a recuperare dalla cache se disponibile (static files requested by their plain URL are looked up under their fingerprinted one)
+    const precachedUrl = requestUrl.origin === self.location.origin && PRECACHE_ASSETS[requestUrl.pathname];
     event.respondWith(
-      caches.match(event.request).then((response) => {
+      caches.match(precachedUrl || event.request).then((response) => {
         return response || fetch(event.request).catch(() => {
           // Se la richiesta online fallisce, restituisci la pagina offline
-          return caches.match(OFFLINE_URL);
+          return caches.match(cachedUrl(OFFLINE_URL));
         });
       })
     );
@@ -129,7 +92,7 @@ self.addEventListener('fetch', (event) => {
 
 
 // Importing Dexie for local IndexedDB database management, enabling offline data storage and synchronization.
-importScripts('/static/js/dexie.min.js');
+importScripts(cachedUrl('/static/js/dexie.min.js'));
 
 // Create a local database for itineraries
 const db = new Dexie('ItinerariesDatabase');
@@ -137,69 +100,222 @@ db.version(1).stores({
   itineraries: '_id, user_id, name, description, waypoints, upload_datetime, last_modified, num_views, likes, image, image_format, deleted'
 });
 
-// Function to get the last synchronization time
-async function getLastSyncTime() {
-  const lastSync = await db.itineraries.orderBy('last_modified').reverse().first();
-  if (lastSync && lastSync.last_modified) {
-    const date = new Date(lastSync.last_modified + 'Z');
-    return date.toISOString().substring(0, 19).replace('T', ' ');
-  } else {
-    return '0001-01-01 00:00:00';
+// Separate local database holding the synchronization state (the sync token returned by the server)
+const syncStateDb = new Dexie('SyncStateDatabase');
+syncStateDb.version(1).stores({
+  meta: 'key'
+});
+
+// Function to get the sync token of the last synchronization (null before the first one)
+async function getSyncToken() {
+  const entry = await syncStateDb.meta.get('sync_token');
+  return entry ? entry.value : null;
+}
+
+// Function to store the sync token returned by the server
+async function setSyncToken(token) {
+  await syncStateDb.meta.put({ key: 'sync_token', value: token });
+}
+
+// Function to get the progress of an interrupted snapshot download (null if there is none)
+async function getSnapshotProgress() {
+  const entry = await syncStateDb.meta.get('snapshot_progress');
+  return entry ? entry.value : null;
+}
+
+// Function to store the progress of a snapshot download (null once it is complete)
+async function setSnapshotProgress(progress) {
+  await syncStateDb.meta.put({ key: 'snapshot_progress', value: progress });
+}
+
+/* Function to download an itinerary image and convert it to base64, the format in which images are stored locally
+   and displayed by the offline pages. */
+async function fetchImageAsBase64(url) {
+  const response = await fetch(url);
+  if (!response.ok) {
+    return null;
   }
+  const bytes = new Uint8Array(await response.arrayBuffer());
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+  }
+  return btoa(binary);
 }
 
-// Function to save itineraries to the local database
-async function saveItinerariesToLocalDatabase(itineraries) {
+// Function to save itineraries to the local database and remove the ones deleted on the server
+async function saveItinerariesToLocalDatabase(itineraries, deletedIds) {
   // Check if there are itineraries to update
-  if (itineraries.length === 0) {
+  if (itineraries.length === 0 && deletedIds.length === 0) {
     console.log('[Service worker] No itineraries to update in IndexedDB');
     return;
   }
 
   try {
-    const mappedItineraries = itineraries.map(itinerary => {
+    const existing = await db.itineraries.bulkGet(itineraries.map(itinerary => itinerary._id));
+
+    const mappedItineraries = await Promise.all(itineraries.map(async (itinerary, index) => {
+      // Images are only downloaded when they changed since the copy stored locally
       let image = null;
-      if (itinerary.image) {
-        if (typeof itinerary.image === 'string') {
-          image = itinerary.image;
-        } else if (itinerary.image.$binary) {
-          image = itinerary.image.$binary.base64;
-        }
+      const local = existing[index];
+      if (local && local.image && local.image_hash === itinerary.image_hash) {
+        image = local.image;
+      } else if (itinerary.image_url) {
+        image = await fetchImageAsBase64(itinerary.image_url);
       }
 
       return {
-        _id: itinerary._id.$oid || itinerary._id,
+        _id: itinerary._id,
         user_id: itinerary.user_id,
         name: itinerary.name,
         description: itinerary.description,
         waypoints: itinerary.waypoints,
         upload_datetime: itinerary.upload_datetime,
         last_modified: itinerary.last_modified,
-        num_views: itinerary.num_views.$numberInt || itinerary.num_views,
-        likes: itinerary.likes,
+        num_views: itinerary.num_views,
+        likes_count: itinerary.likes_count,
         image: image,
         image_format: itinerary.image_format,
+        image_hash: itinerary.image_hash,
+        route_length: itinerary.route_length,
+        route_bbox: itinerary.route_bbox,
+        route_centroid: itinerary.route_centroid,
+        route_polyline: itinerary.route_polyline,
         deleted: itinerary.deleted
       };
-    });
+    }));
 
     await db.itineraries.bulkPut(mappedItineraries);
+    await db.itineraries.bulkDelete(deletedIds);
     console.log('[Service worker] IndexedDB: Updated with itineraries received from synchronization');
   } catch (error) {
     console.log(`[Service worker] Error updating IndexedDB with itineraries: ${error}`);
+    throw error;
+  }
+}
+
+
+/* Function to request a synchronization. Requests arriving while a synchronization is running are coalesced
+   into a single follow-up synchronization, so bursts of change notifications do not cause bursts of requests. */
+function requestSync() {
+  if (syncInProgress) {
+    syncRequested = true;
+    return syncInProgress;
   }
+  syncInProgress = syncItineraries().finally(() => {
+    syncInProgress = null;
+    if (syncRequested) {
+      syncRequested = false;
+      requestSync();
+    }
+  });
+  return syncInProgress;
 }
 
+/* Function to load the snapshot of all the user's itineraries, streamed by the server as NDJSON (one JSON object per line).
+   Itineraries are saved locally in batches while the download proceeds, and the number received is stored, so that an interrupted
+   download resumes where it stopped at the next synchronization (unless the user's itineraries changed meanwhile, in which case the
+   server answers 410 and the snapshot is downloaded again). Once complete, local itineraries missing from the snapshot are removed,
+   and the sync token from which incremental synchronization continues is returned. */
+async function loadSnapshot() {
+  const baseUrl = '/api/sync-snapshot?image_size=small';
+  const progress = await getSnapshotProgress();
+  let response = await fetch(progress
+    ? `${baseUrl}&snapshot=${encodeURIComponent(progress.snapshotId)}&offset=${progress.offset}`
+    : baseUrl);
+  if (response.status === 410) {
+    console.log("[Service worker] Snapshot changed since the interrupted download, downloading it again");
+    await setSnapshotProgress(null);
+    response = await fetch(baseUrl);
+  }
+  if (!response.ok || !response.body) {
+    throw new Error(`Snapshot request failed with status ${response.status}`);
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = '';
+  let snapshotId = null;
+  let offset = 0;
+  let batch = [];
+  const saveBatch = async () => {
+    if (batch.length > 0) {
+      await saveItinerariesToLocalDatabase(batch, []);
+      offset += batch.length;
+      batch = [];
+      await setSnapshotProgress({ snapshotId: snapshotId, offset: offset });
+    }
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += value;
+    let newline;
+    while ((newline = buffer.indexOf('\n')) >= 0) {
+      const record = JSON.parse(buffer.slice(0, newline));
+      buffer = buffer.slice(newline + 1);
+      if (record.type === 'snapshot') {
+        snapshotId = record.snapshot_id;
+        offset = record.offset;
+        console.log(`[Service worker] Loading snapshot of ${record.count} itineraries from ${offset}`);
+      } else if (record.type === 'end') {
+        await saveBatch();
+        const snapshotIds = new Set(record.ids);
+        const localIds = await db.itineraries.toCollection().primaryKeys();
+        await db.itineraries.bulkDelete(localIds.filter(id => !snapshotIds.has(id)));
+        await setSnapshotProgress(null);
+        return record.sync_token;
+      } else {
+        batch.push(record);
+        if (batch.length >= 50) {
+          await saveBatch();
+        }
+      }
+    }
+  }
+  await saveBatch();
+  throw new Error('Snapshot download interrupted');
+}
 
-// Function to synchronize itineraries with the server
+/* Function to synchronize itineraries with the server.
+   Without a sync token (first synchronization), all itineraries are loaded from a snapshot first (see loadSnapshot()).
+   Then requests the changes made since the stored sync token, batch after batch while the server reports more changes,
+   and advances the stored token only after each batch has been saved locally.
+   Images are only displayed offline as card backgrounds, so their small variant is requested.
+   If the server answers that the token is too old (deletions it depends on were purged), the snapshot is loaded again. */
 async function syncItineraries() {
   console.log("[Service worker] Attempting synchronization...");
   try {
-    const lastSyncTime = await getLastSyncTime();
-    const response = await fetch('/api/sync-itineraries?lastSyncTime=' + encodeURIComponent(lastSyncTime));
-    const itineraries = await response.json();
-    console.log("[Service worker] Itineraries received from synchronization:", itineraries);
-    await saveItinerariesToLocalDatabase(itineraries);
+    let token = await getSyncToken();
+    if (!token) {
+      token = await loadSnapshot();
+      await setSyncToken(token);
+    }
+    let hasMore = true;
+    while (hasMore) {
+      const url = '/api/sync-itineraries?image_size=small' + (token ? '&since=' + encodeURIComponent(token) : '');
+      const response = await fetch(url);
+      if (!response.ok) {
+        throw new Error(`Synchronization request failed with status ${response.status}`);
+      }
+      const changes = await response.json();
+      if (changes.resync) {
+        console.log("[Service worker] Sync token expired, starting a full resynchronization");
+        await setSnapshotProgress(null);
+        token = await loadSnapshot();
+        await setSyncToken(token);
+        continue;
+      }
+      console.log("[Service worker] Changes received from synchronization:", changes);
+      await saveItinerariesToLocalDatabase(changes.items, changes.deleted);
+      if (changes.sync_token) {
+        token = changes.sync_token;
+        await setSyncToken(token);
+      }
+      hasMore = changes.has_more;
+    }
   } catch (error) {
     console.error('Failed to sync itineraries:', error);
   }
@@ -210,13 +326,15 @@ async function syncItineraries() {
    For 'LOGIN_STATUS' messages, updates 'isUserLoggedIn' and manages synchronization timers accordingly. */
 self.addEventListener('message', (event) => {
   if (event.data && event.data.action === 'sync-itineraries') {
-    syncItineraries();
+    requestSync();
   } else if (event.data && event.data.type === 'LOGIN_STATUS') {
     isUserLoggedIn = event.data.isLoggedIn;
 
     if (isUserLoggedIn) {
+      openChangeStream();
       startSyncTimer();
     } else {
+      closeChangeStream();
       stopSyncTimer();
 
       clearIndexedDB();
@@ -229,10 +347,79 @@ self.addEventListener('message', (event) => {
 function startSyncTimer() {
   if (!syncTimer) {
     syncTimer = setInterval(() => {
+      if (isUserLoggedIn && !changeStreamConnected) {
+        requestSync();
+      }
+    }, 60000); // Synchronize itineraries every 60 seconds while no change stream is connected.
+  }
+}
+
+/* Function to open the change stream, a Server-Sent Events response on which the server notifies changes to the user's itineraries.
+   The stream is read with fetch() because EventSource is not available in service workers. A synchronization is requested when the
+   stream connects (to catch up on changes made while disconnected) and on every 'change' event; when the stream ends or fails,
+   it is reopened after a delay (the one given by the server's Retry-After header when it refuses the stream because it already
+   serves too many), and the periodic synchronization takes over in the meantime. */
+async function openChangeStream() {
+  if (changeStreamController) {
+    return;
+  }
+  const controller = new AbortController();
+  changeStreamController = controller;
+  let reconnectDelay = 5000;
+
+  try {
+    const response = await fetch('/api/changes', {
+      headers: { 'Accept': 'text/event-stream' },
+      signal: controller.signal
+    });
+    if (response.status === 503) {
+      reconnectDelay = (parseInt(response.headers.get('Retry-After'), 10) || 60) * 1000;
+    }
+    if (!response.ok || !response.body) {
+      throw new Error(`Change stream request failed with status ${response.status}`);
+    }
+
+    changeStreamConnected = true;
+    requestSync();
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) {
+        break;
+      }
+      buffer += value;
+      let separator;
+      while ((separator = buffer.indexOf('\n\n')) >= 0) {
+        const message = buffer.slice(0, separator);
+        buffer = buffer.slice(separator + 2);
+        if (message.split('\n').includes('event: change')) {
+          requestSync();
+        }
+      }
+    }
+  } catch (error) {
+    if (!controller.signal.aborted) {
+      console.log('[Service worker] Change stream disconnected:', error);
+    }
+  } finally {
+    changeStreamConnected = false;
+    if (changeStreamController === controller) {
+      changeStreamController = null;
       if (isUserLoggedIn) {
-        syncItineraries();
+        setTimeout(openChangeStream, reconnectDelay);
       }
-    }, 60000); // Synchronize itineraries every 60 seconds.
+    }
+  }
+}
+
+// Function to close the change stream, used when the user logs out.
+function closeChangeStream() {
+  if (changeStreamController) {
+    const controller = changeStreamController;
+    changeStreamController = null;
+    controller.abort();
   }
 }
 
@@ -252,6 +439,7 @@ function stopSyncTimer() {
 async function clearIndexedDB() {
   try {
     await db.itineraries.clear();
+    await syncStateDb.meta.clear();
     console.log('[Service worker] IndexedDB: Data successfully deleted.');
   } catch (error) {
     console.error('[Service worker] Error while deleting data from IndexedDB:', error);
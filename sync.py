@@ -0,0 +1,159 @@
+# Helpers for the itinerary synchronization protocol used by the service worker (see '/api/sync-itineraries').
+# Every write to an itinerary stamps it with a 'sync_seq' value taken from a global, monotonically increasing counter.
+# Clients keep the position of the last change they received as an opaque sync token and ask only for what came after it.
+# A value is taken from the counter before the write carrying it, so concurrent writes can become visible out of sequence order:
+# while a write is in flight, clients must not receive changes with higher values, or their token would pass the pending change,
+# which they would then never receive. Every write therefore runs within 'sync_write()', which records it in the 'sync_writes'
+# collection until it completes, and changes are only returned up to 'committed_sync_seq()'.
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import url_for
+from bson import ObjectId, BSON
+from pymongo import ReturnDocument, UpdateOne
+from timestamps import format_timestamp
+
+
+# Seconds after which the record of a write that never completed (e.g. because its process was killed) expires, so that it stops
+# holding back synchronization (see the 'expiry' index on 'sync_writes' in indexes.py).
+SYNC_WRITE_TIMEOUT = 60
+
+
+def _sync_seq_counter(mongo):
+    counter = mongo.db.counters.find_one({'_id': 'sync_seq'})
+    return counter['value'] if counter else 0
+
+
+# Reserves 'count' consecutive values of the global sync sequence with a single write and yields the first one; bulk writes stamp
+# each written itinerary with its own value. The write stamped with them must be made within the 'with' block.
+# The write is recorded, before the values are taken, with the counter value read beforehand: the values it takes are above it,
+# so synchronization stops at that value until the write completes.
+@contextmanager
+def sync_write(mongo, count=1):
+    floor = _sync_seq_counter(mongo)
+    pending = mongo.db.sync_writes.insert_one({'floor': floor, 'expires_at': datetime.utcnow() + timedelta(seconds=SYNC_WRITE_TIMEOUT)})
+    try:
+        counter = mongo.db.counters.find_one_and_update(
+            {'_id': 'sync_seq'},
+            {'$inc': {'value': count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        yield counter['value'] - count + 1
+    finally:
+        mongo.db.sync_writes.delete_one({'_id': pending.inserted_id})
+
+
+# Returns the highest sync sequence value up to which every write has completed. The counter is read before the writes in flight:
+# a write recorded after it was read takes values above it, and one recorded before holds it at that write's floor.
+def committed_sync_seq(mongo):
+    committed = _sync_seq_counter(mongo)
+    pending = mongo.db.sync_writes.find_one({}, {'floor': 1}, sort=[('floor', 1)])
+    return min(committed, pending['floor']) if pending else committed
+
+
+# Returns the user's sync horizon: the highest sync sequence value of the user's tombstones deleted by maintenance (see maintenance.py).
+# A client of the user whose sync token is below it may have missed deletions and must synchronize from scratch. Horizons are kept
+# per user in the 'sync_horizons' collection, so purging the tombstones of one user never makes the clients of others start over.
+def get_sync_horizon(mongo, user_id):
+    horizon = mongo.db.sync_horizons.find_one({'_id': user_id})
+    return horizon['seq'] if horizon else 0
+
+
+# Moves the sync horizons of users up to the given values (never down), given as a dictionary from user ID to sync sequence value.
+def advance_sync_horizons(mongo, horizons):
+    if horizons:
+        mongo.db.sync_horizons.bulk_write([UpdateOne({'_id': user_id}, {'$max': {'seq': sync_seq}}, upsert=True) for user_id, sync_seq in horizons.items()])
+
+
+# Encodes the (sync_seq, _id) position of a change into a sync token.
+def encode_sync_token(sync_seq, itinerary_id):
+    return f"{sync_seq}-{itinerary_id}"
+
+
+# Decodes a token produced by 'encode_sync_token()'. Raises ValueError if the token is malformed.
+def decode_sync_token(token):
+    try:
+        sync_seq, itinerary_id = token.split('-', 1)
+        return int(sync_seq), ObjectId(itinerary_id)
+    except Exception as e:
+        raise ValueError(f"Invalid sync token: {token}") from e
+
+
+# Converts an itinerary document into its synchronization payload. The image is referenced by a hash-versioned URL
+# rather than embedded, so the client downloads it only when 'image_hash' differs from the copy it already has.
+# 'image_size' selects a reduced-size variant of the image (see thumbnails.py) instead of the original.
+def serialize_sync_item(itinerary, image_size=None):
+    image_url = None
+    if itinerary.get('image_format'):
+        image_url = url_for('itineraries.itinerary_image', itinerary_id=str(itinerary['_id']), v=itinerary.get('image_hash'), size=image_size)
+
+    return {
+        '_id': str(itinerary['_id']),
+        'user_id': itinerary['user_id'],
+        'name': itinerary.get('name', ''),
+        'description': itinerary.get('description', ''),
+        'waypoints': itinerary.get('waypoints', []),
+        'upload_datetime': format_timestamp(itinerary.get('upload_datetime')),
+        'last_modified': format_timestamp(itinerary.get('last_modified')),
+        'num_views': itinerary.get('num_views', 0),
+        'likes_count': itinerary.get('likes_count', 0),
+        'image_format': itinerary.get('image_format', ''),
+        'image_hash': itinerary.get('image_hash', ''),
+        'image_url': image_url,
+        'route_length': itinerary.get('route_length'),
+        'route_bbox': itinerary.get('route_bbox'),
+        'route_centroid': itinerary.get('route_centroid'),
+        'route_polyline': itinerary.get('route_polyline'),
+        'deleted': 0
+    }
+
+
+# Returns the changes made to the user's itineraries after the position 'token' (all itineraries when 'token' is None).
+# Changes are read in (sync_seq, _id) order from the 'sync_changes' index, so each poll costs only the changes it returns.
+# A batch stops after 'batch_size' changes or once 'max_bytes' of BSON have been read, whichever comes first; in that case
+# 'has_more' is set and the returned token continues from the last change of the batch.
+# Deleted itineraries are reported as bare IDs (tombstones). If 'token' is older than the user's sync horizon, the tombstones the client
+# still needed may have been purged, so no changes are returned and 'resync' is set: the client must start over without a token.
+# Only changes up to 'committed_sync_seq()' are returned; those after it are returned by a later call, once the writes before them completed.
+# Itineraries written before sync sequences existed must have been stamped by the '0002_sync_seq' migration (see migrations/).
+def fetch_changes(mongo, user_id, token=None, batch_size=100, max_bytes=1024 * 1024, image_size=None):
+    query = {'user_id': user_id, 'sync_seq': {'$lte': committed_sync_seq(mongo)}}
+    horizon = get_sync_horizon(mongo, user_id)
+    if token:
+        sync_seq, itinerary_id = decode_sync_token(token)
+        if sync_seq < horizon:
+            return {'items': [], 'deleted': [], 'sync_token': None, 'has_more': False, 'resync': True}
+        query['$or'] = [
+            {'sync_seq': {'$gt': sync_seq}},
+            {'sync_seq': sync_seq, '_id': {'$gt': itinerary_id}}
+        ]
+
+    changes = mongo.db.itineraries.find(query, {'image': 0, 'likes': 0}).sort([('sync_seq', 1), ('_id', 1)]).limit(batch_size + 1)
+
+    items, deleted, last_change = [], [], None
+    batch_bytes, has_more = 0, False
+    for itinerary in changes:
+        if last_change is not None and (len(items) + len(deleted) >= batch_size or batch_bytes >= max_bytes):
+            has_more = True
+            break
+        batch_bytes += len(BSON.encode(itinerary))
+        if itinerary.get('deleted'):
+            deleted.append(str(itinerary['_id']))
+        else:
+            items.append(serialize_sync_item(itinerary, image_size))
+        last_change = itinerary
+
+    sync_token = encode_sync_token(last_change['sync_seq'], last_change['_id']) if last_change else token
+    # Once the client is up to date, a token below the horizon (a user whose last change is older than the purged tombstones)
+    # is moved up to it, as nothing up to the horizon remains to be read: otherwise every later synchronization would start over.
+    if not has_more and horizon and (sync_token is None or decode_sync_token(sync_token)[0] < horizon):
+        sync_token = encode_sync_token(horizon, ObjectId('0' * 24))
+
+    return {
+        'items': items,
+        'deleted': deleted,
+        'sync_token': sync_token,
+        'has_more': has_more,
+        'resync': False
+    }
@@ -0,0 +1,105 @@
+# Generation of reduced-size variants of itinerary map images, so that list pages and the service worker do not download
+# full-size images to display small cards.
+# Variants are generated off the request thread by a small pool of worker threads, stored in the image store like any other
+# image and recorded on the original image's reference (see image_store.py). Until a variant exists, the original is served.
+# Resizing requires Pillow; without it no variants are generated and originals are always served.
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Maximum width in pixels of each variant. Images already narrower than a variant are used as that variant unchanged.
+VARIANTS = {
+    'small': 480,
+    'medium': 1024
+}
+
+PILLOW_FORMATS = {'jpg': 'JPEG', 'webp': 'WEBP'}
+
+
+class ThumbnailGenerator:
+    def __init__(self, image_store, logger, max_workers=2, quality=80):
+        self.image_store = image_store
+        self.logger = logger
+        self.max_workers = max_workers
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        if Image is None:
+            self.logger.warning("Pillow is not installed: map image variants will not be generated.")
+
+    # Queues the generation of the variants of an image and returns immediately.
+    def schedule(self, image_hash, image_format):
+        if Image is None or not image_hash:
+            return
+        self._get_executor().submit(self.generate, image_hash, image_format)
+
+    # Generates the variants of an image that do not exist yet. Errors are logged, as nobody waits for the result.
+    def generate(self, image_hash, image_format):
+        if Image is None:
+            return
+        try:
+            missing = [name for name in VARIANTS if not self.image_store.variant(image_hash, name)]
+            if not missing:
+                return
+            image_file = self.image_store.open(image_hash)
+            if image_file is None:
+                return
+            with image_file:
+                image = Image.open(BytesIO(image_file.read()))
+                image.load()
+
+            for name in missing:
+                width = VARIANTS[name]
+                if image.width <= width:
+                    self.image_store.add_variant(image_hash, name, image_hash)
+                    continue
+
+                variant = image.copy()
+                variant.thumbnail((width, image.height))
+                if image_format != 'webp' and variant.mode not in ('RGB', 'L'):
+                    variant = variant.convert('RGB')
+                output = BytesIO()
+                variant.save(output, PILLOW_FORMATS.get(image_format, 'JPEG'), quality=self.quality)
+                output.seek(0)
+                variant_hash = self.image_store.store(output, image_format)
+                self.image_store.add_variant(image_hash, name, variant_hash)
+        except Exception as e:
+            self.logger.error(f"Error generating variants of image {image_hash}: {e}")
+
+    # Waits for the queued generations to complete and stops the worker pool of this process.
+    def stop(self):
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+            self._pid = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    # Creates the worker pool on first use. A forked worker process does not inherit the parent's threads, so a new pool is created there.
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='thumbnails')
+                    self._pid = os.getpid()
+        return self._executor
+
+
+# Generates, synchronously, the missing variants of the images of all itineraries, e.g. those saved before variants existed
+# or whose generation was interrupted. Returns the number of images processed.
+def generate_missing_variants(mongo, thumbnail_generator):
+    processed = set()
+    for itinerary in mongo.db.itineraries.find({'deleted': 0, 'image_hash': {'$nin': ['', None]}}, {'image_hash': 1, 'image_format': 1}):
+        if itinerary['image_hash'] not in processed:
+            thumbnail_generator.generate(itinerary['image_hash'], itinerary.get('image_format'))
+            processed.add(itinerary['image_hash'])
+    return len(processed)
@@ -0,0 +1,52 @@
+# Itinerary dates ('upload_datetime', 'last_modified'). They are stored as BSON dates (naive datetimes in UTC, to the second);
+# earlier versions stored them as "%Y-%m-%d %H:%M:%S" strings, converted by the first migration (see migrations/). Until every
+# itinerary has been migrated, readers accept both forms through the helpers below.
+# In MongoDB's sort order all strings come before all dates, so in a descending sort by date the migrated itineraries (and those
+# written since) come first, followed by the remaining strings in their own order: queries on these fields match both forms accordingly.
+
+from datetime import datetime
+
+
+# Format of the dates stored as strings by earlier versions, and still used to present dates in the synchronization API.
+LEGACY_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# Returns the current UTC time, as itinerary dates are stored.
+def utc_now():
+    return datetime.utcnow().replace(microsecond=0)
+
+
+# Converts a stored date, in either form, to a naive UTC datetime. Returns None for missing, empty or unparseable values.
+def to_datetime(value):
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None) if value.tzinfo is not None else value
+    if isinstance(value, str) and value:
+        try:
+            return datetime.strptime(value, LEGACY_FORMAT)
+        except ValueError:
+            return None
+    return None
+
+
+# Formats a stored date, in either form, as a "%Y-%m-%d %H:%M:%S" string ('' if missing), as the synchronization API returns dates.
+def format_timestamp(value):
+    parsed = to_datetime(value)
+    return parsed.strftime(LEGACY_FORMAT) if parsed else ''
+
+
+# Returns the query condition matching values of 'field', in either form, at or after 'since' (a datetime).
+def since_condition(field, since):
+    return {'$or': [{field: {'$gte': since}}, {field: {'$gte': since.strftime(LEGACY_FORMAT)}}]}
+
+
+# Returns the conditions matching the documents that follow the position ('value', 'document_id') in a descending sort on
+# ('field', '_id'), for keyset pagination. Strings compare only with strings and dates with dates, so the conditions follow the
+# sort order across both forms: after a date, the earlier dates and then every string; after a string, only the earlier strings.
+def before_position(field, value, document_id):
+    conditions = [
+        {field: {'$lt': value}},
+        {field: value, '_id': {'$lt': document_id}}
+    ]
+    if isinstance(value, datetime):
+        conditions.append({field: {'$type': 'string'}})
+    return conditions
@@ -0,0 +1,50 @@
+# Precomputed "trending" leaderboard of itineraries.
+# The leaderboard is computed from the recent itineraries' counters and stored as a single document in the 'leaderboards'
+# collection, so serving it costs one lookup by ID. It is recomputed when older than the configured refresh interval.
+
+from datetime import datetime, timedelta
+from cache import SingleFlight
+from feed import CARD_PROJECTION, FEED_SORT
+from timestamps import to_datetime, since_condition
+
+
+LEADERBOARD_ID = 'trending'
+
+# Concurrent requests finding the leaderboard stale in the same process wait for a single recomputation (see cache.py).
+_refresh_flight = SingleFlight()
+
+
+# Scores an itinerary by its likes and views, decayed by its age so that recent activity outranks old popularity.
+def trending_score(itinerary, now):
+    uploaded = to_datetime(itinerary.get('upload_datetime'))
+    age_hours = max((now - uploaded).total_seconds() / 3600, 0) if uploaded else 0
+    points = 3 * itinerary.get('likes_count', 0) + itinerary.get('num_views', 0)
+    return points / (age_hours + 2) ** 1.5
+
+
+# Computes the leaderboard from the itineraries uploaded in the last 'window_days' days (at most 'candidate_limit' of them,
+# read from the 'feed_recent' index) and stores its top 'size' entries. Returns the stored entries.
+def refresh_trending(mongo, size=20, window_days=30, candidate_limit=1000):
+    now = datetime.utcnow()
+    since = now - timedelta(days=window_days)
+    candidates = mongo.db.itineraries.find(
+        dict(since_condition('upload_datetime', since), deleted=0),
+        CARD_PROJECTION
+    ).sort(FEED_SORT).limit(candidate_limit)
+
+    items = sorted(candidates, key=lambda itinerary: trending_score(itinerary, now), reverse=True)[:size]
+    mongo.db.leaderboards.replace_one(
+        {'_id': LEADERBOARD_ID},
+        {'_id': LEADERBOARD_ID, 'computed_at': now, 'items': items},
+        upsert=True
+    )
+    return items
+
+
+# Returns the stored leaderboard entries, recomputing them first if they are missing or older than 'max_age_seconds'.
+def get_trending(mongo, max_age_seconds=300, **refresh_options):
+    leaderboard = mongo.db.leaderboards.find_one({'_id': LEADERBOARD_ID})
+    if not leaderboard or datetime.utcnow() - leaderboard['computed_at'] > timedelta(seconds=max_age_seconds):
+        return _refresh_flight.do((id(mongo), LEADERBOARD_ID), lambda: refresh_trending(mongo, **refresh_options))
+    return leaderboard['items']
+
@@ -6,3 +6,12 @@ class User(UserMixin):
     def __init__(self, username, name=None):
         self.id = username
         self.name = name
+
+
+# Returns the public data of a user ('username' and 'name', never the password hash), or None if the user does not exist.
+# Results are kept in 'user_cache' (see cache.py), which must be invalidated whenever a user is created or modified.
+def get_user_data(mongo, user_cache, username):
+    return user_cache.get_or_load(
+        username,
+        lambda: mongo.db.users.find_one({'username': username}, {'_id': 0, 'username': 1, 'name': 1})
+    )
@@ -0,0 +1,110 @@
+# Write-behind aggregation of itinerary view counts.
+# Viewing an itinerary only increments an in-memory counter; a background thread periodically writes the accumulated
+# increments to MongoDB with a single 'bulk_write' of '$inc' operations, so page views never wait for a database write.
+
+import atexit
+import os
+import threading
+from collections import Counter
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+class ViewCounter:
+    def __init__(self, mongo, logger, flush_interval=10, flush_threshold=500):
+        self.mongo = mongo
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._pending_total = 0
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self._listeners = []
+        atexit.register(self.stop)
+
+    # Registers a function called with the views written by every successful flush, as a Counter of views by itinerary ID
+    # (e.g. to update cached counts).
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    # Records one view of an itinerary. Wakes the flush thread early once 'flush_threshold' views are pending.
+    def increment(self, itinerary_id):
+        self._ensure_started()
+        with self._lock:
+            self._pending[itinerary_id] += 1
+            self._pending_total += 1
+            threshold_reached = self._pending_total >= self.flush_threshold
+        if threshold_reached:
+            self._wakeup.set()
+
+    # Returns the views of an itinerary recorded but not yet written to the database.
+    def pending(self, itinerary_id):
+        with self._lock:
+            return self._pending.get(itinerary_id, 0)
+
+    # Writes all pending views to the database. If the write fails, the views are kept and retried at the next flush; if only some
+    # of its operations fail, only the views of those itineraries are kept, as the others were written.
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._pending_total = 0
+        if not pending:
+            return
+
+        itinerary_ids = list(pending)
+        try:
+            self.mongo.db.itineraries.bulk_write(
+                [UpdateOne({'_id': itinerary_id}, {'$inc': {'num_views': pending[itinerary_id]}}) for itinerary_id in itinerary_ids],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            failed = Counter({itinerary_ids[error['index']]: pending[itinerary_ids[error['index']]] for error in e.details.get('writeErrors', [])})
+            self.logger.error(f"Error writing {sum(failed.values())} pending itinerary views: {e}")
+            self._requeue(failed)
+            written = pending - failed
+        except PyMongoError as e:
+            self.logger.error(f"Error writing {sum(pending.values())} pending itinerary views: {e}")
+            self._requeue(pending)
+            return
+        else:
+            written = pending
+
+        if written:
+            for listener in self._listeners:
+                listener(written)
+
+    # Adds views whose write failed back to those recorded since, to be retried at the next flush.
+    def _requeue(self, views):
+        with self._lock:
+            for itinerary_id, count in views.items():
+                self._pending[itinerary_id] = self._pending.get(itinerary_id, 0) + count
+            self._pending_total += sum(views.values())
+
+    # Stops the flush thread and writes the remaining views. Registered to run when the process exits.
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    # Starts the flush thread on first use. A forked worker process does not inherit the parent's thread, so a new one is started there.
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='view-counter-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()